@@ -0,0 +1,233 @@
+import asyncio
+import sys
+from collections import namedtuple
+from logging import getLogger
+from pytelemetry import Pytelemetry
+from pytelemetrycli.topics import Topics
+from pytelemetrycli.runner import Runner, WAIT_TIMEOUT, MIN_SLEEP
+
+if sys.version_info < (3, 7):
+    raise ImportError("pytelemetrycli.aio requires python 3.7+")
+
+logger = getLogger('aio')
+
+# A sample received under a topic. index is None for linear samples.
+Sample = namedtuple('Sample', ['value', 'index'])
+
+class TopicStream:
+    """
+Asynchronous iterator over the samples received under a topic, from the
+moment the stream is opened. With a `maxsize`, the oldest samples are
+dropped when the consumer falls behind, and counted in `dropped`.
+    """
+    def __init__(self, topics, topic, maxsize=0):
+        self.topics = topics
+        self.topic = topic
+        self.maxsize = maxsize
+        self.queue = asyncio.Queue()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, sample):
+        if self.maxsize and self.queue.qsize() >= self.maxsize:
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(sample)
+
+    def close(self):
+        # Ends the iteration once the samples already received are consumed
+        if not self.closed:
+            self.closed = True
+            self.topics.unstream(self)
+            self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        sample = await self.queue.get()
+        if sample is None:
+            raise StopAsyncIteration
+        return sample
+
+class AsyncTopics(Topics):
+    """
+`Topics` whose samples can also be awaited with `stream()`.
+All calls must happen on the thread running the event loop.
+    """
+    def __init__(self):
+        self.streams = dict()
+        Topics.__init__(self)
+
+    def stream(self, topic, maxsize=0):
+        """
+Returns a `TopicStream` of the samples received under `topic` :
+
+    async for sample in topics.stream("imu"):
+        print(sample.value)
+        """
+        stream = TopicStream(self, topic, maxsize)
+        self.streams.setdefault(topic, []).append(stream)
+        return stream
+
+    def unstream(self, stream):
+        streams = self.streams.get(stream.topic, [])
+        if stream in streams:
+            streams.remove(stream)
+        if not streams:
+            self.streams.pop(stream.topic, None)
+
+    def process(self, topic, payload, options=None):
+        Topics.process(self, topic, payload, options)
+        for stream in self.streams.get(topic, ()):
+            stream.put(Sample(payload, options['index'] if options else None))
+
+    def process_batch(self, topic, payloads, indexes=None, now=None):
+        Topics.process_batch(self, topic, payloads, indexes, now)
+        streams = self.streams.get(topic)
+        if not streams:
+            return
+        if indexes is None:
+            indexes = [None] * len(payloads)
+        for stream in streams:
+            for payload, index in zip(payloads, indexes):
+                stream.put(Sample(payload, index))
+
+class Engine:
+    """
+Telemetry engine running on an asyncio event loop, an alternative to the
+threaded `Runner` used by the command-line interface. Several engines
+(one per connection) can share the same loop and `AsyncTopics`.
+
+Received bytes are read when the event loop reports the serial port as
+readable. Transports without a file descriptor (replay, Windows serial
+ports) are polled with a back-off sleep. Plot control pipes are watched
+by the event loop as well. Nothing blocks the loop : published samples are
+sent by the writer thread of the runner, and reading is paused while the
+consumers of 'block' subscriptions are waited for from an executor.
+    """
+    def __init__(self, transport, topics=None, loop=None):
+        self.transport = transport
+        self.topics = topics if topics is not None else AsyncTopics()
+        self.loop = loop
+        self.telemetry = Pytelemetry(transport)
+        self.plots = []
+        # The runner is only used for decoding and stats, from the loop thread
+        self.runner = Runner(transport, self.telemetry, None, self.topics)
+        self.telemetry.subscribe(None, self.runner.collect)
+        self.fileno = None
+        self.task = None
+        # Task waiting for the 'block' subscribers, reading is paused meanwhile
+        self.throttling = None
+
+    async def connect(self, port, bauds=9600):
+        self.loop = self.loop or asyncio.get_running_loop()
+        self.runner.open(port, bauds)
+        self.runner.publisher.start()
+        self.fileno = self.runner._fileno()
+        if self.fileno is not None:
+            self.loop.add_reader(self.fileno, self._on_readable)
+        self.task = self.loop.create_task(self._serve())
+
+    async def disconnect(self):
+        if self.fileno is not None:
+            self.loop.remove_reader(self.fileno)
+            self.fileno = None
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.throttling is not None:
+            self.throttling.cancel()
+            self.throttling = None
+        self.runner.publisher.stop()
+        self.runner.flush(throttle=False)
+        self.transport.disconnect()
+
+    async def close(self):
+        await self.disconnect()
+        for entry in list(self.plots):
+            entry['ctrl'].send("exit")
+            self._remove_plot(entry)
+
+    def publish(self, topic, value, datatype):
+        # Queued, written to the transport by the writer thread
+        self.runner.publisher.publish(topic, value, datatype)
+
+    def _on_readable(self):
+        self.runner.decode()
+        self.runner.flush(throttle=False)
+        if self.throttling is None and self.topics.congested():
+            self.throttling = self.loop.create_task(self._throttle())
+
+    async def _throttle(self):
+        # Waits for the 'block' subscribers off the loop, without reading meanwhile
+        if self.fileno is not None:
+            self.loop.remove_reader(self.fileno)
+        try:
+            await self.loop.run_in_executor(None, self.topics.throttle)
+        finally:
+            self.throttling = None
+            if self.fileno is not None:
+                self.loop.add_reader(self.fileno, self._on_readable)
+
+    async def _serve(self):
+        # Stats, and reading of the transports the loop can't watch
+        sleep = MIN_SLEEP
+        while True:
+            if self.fileno is None and self.throttling is None:
+                if self.transport.readable():
+                    self._on_readable()
+                    sleep = MIN_SLEEP
+                else:
+                    sleep = min(sleep * 2, WAIT_TIMEOUT)
+            else:
+                sleep = WAIT_TIMEOUT
+            self.runner.computeStats()
+            # Send the samples held back while the plots were behind
+            for entry in self.plots:
+                entry['plot'].flush()
+            await asyncio.sleep(sleep)
+
+    def plot(self, *topics, channel='queue', layout='shared'):
+        """
+Plots `topics` in a new graph window. Returns the `Superplot`.
+        """
+        from pytelemetrycli.ui.superplot import Superplot, PlotType
+
+        self.loop = self.loop or asyncio.get_running_loop()
+        p = Superplot(", ".join(topics), channel=channel, layout=layout)
+        q, ctrl = p.start()
+        entry = {'plot': p, 'queue': q, 'ctrl': ctrl}
+        self.plots.append(entry)
+        self.loop.add_reader(ctrl.fileno(), self._on_plot_message, entry)
+
+        for topic in topics:
+            if self.topics.has_indexed_data(topic):
+                plotType, transferType = PlotType.indexed, "indexed"
+            else:
+                plotType, transferType = PlotType.linear, "linear"
+            channel = self.runner.pipeline.timed(p.add_curve(topic, plotType))
+            self.topics.transfer(topic, channel, transfer_type=transferType, owner=p)
+        return p
+
+    def _on_plot_message(self, entry):
+        try:
+            msg = entry['ctrl'].recv()
+        except (EOFError, OSError):
+            msg = "closing"
+        if msg == "closing":
+            self._remove_plot(entry)
+
+    def _remove_plot(self, entry):
+        if entry not in self.plots:
+            return
+        self.plots.remove(entry)
+        self.loop.remove_reader(entry['ctrl'].fileno())
+        entry['ctrl'].close()
+        for topic in entry['plot'].channels:
+            self.topics.untransfer(topic, entry['plot'])
+        entry['plot'].release()
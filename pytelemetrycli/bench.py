@@ -0,0 +1,359 @@
+"""
+Benchmarks of the ingest and plot pipelines, and of the startup of the cli.
+Run with python -m pytelemetrycli.bench [options]
+
+Usage: bench [options]
+
+Options:
+-n N, --samples N       Amount of samples to send [default: 100000]
+-t N, --topics N        Amount of topics the samples are spread over [default: 4]
+--type T                Payload type : uint8 | int32 | float32 | string ... [default: float32]
+--indexed               Send indexed samples (topic:index) instead of linear ones.
+-r R, --rate R          Samples per second sent by the synthetic device, 0 sends
+                        everything at once [default: 0]
+-b N, --batch N         Samples per batch sent to the plot [default: 64]
+--seed N                Seed of the generated values [default: 0]
+--startup-runs N        Fresh interpreters importing the cli, the fastest one
+                        is kept. 0 skips the startup benchmark [default: 3]
+-o FILE, --output FILE  Writes the results as JSON to FILE instead of stdout.
+--compare FILE          Compares samples/s and startup time with the results saved
+                        in FILE, fails if a benchmark is slower by more than the tolerance.
+--tolerance X           Relative slowdown tolerated by --compare [default: 0.1]
+"""
+from docopt import docopt
+from pytelemetry import Pytelemetry
+import gc
+import io
+import json
+import platform
+import queue
+import random
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None # Windows
+
+INT_RANGES = {'uint8': (0, 255), 'uint16': (0, 65535), 'uint32': (0, 2**32 - 1),
+              'int8': (-128, 127), 'int16': (-32768, 32767), 'int32': (-2**31, 2**31 - 1)}
+INDEXES = 64
+
+# Modules of the plotting stack, that the cli must not load at startup
+GUI_MODULES = ('numpy', 'pyqtgraph', 'PyQt4', 'PyQt5', 'PyQt6', 'PySide', 'PySide2', 'PySide6')
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import pytelemetrycli.cli
+print(time.perf_counter() - start)
+print(','.join(m for m in {0!r} if m in sys.modules))
+"""
+
+class CaptureTransport:
+    # Collects the frames encoded by Pytelemetry
+    def __init__(self):
+        self.frames = []
+    def write(self, data):
+        self.frames.append(bytes(data))
+    def writeable(self):
+        return True
+    def readable(self):
+        return 0
+    def read(self, maxbytes=1):
+        return b''
+
+def generate(samples, topics, datatype, indexed=False, seed=0):
+    """
+Returns the list of pytelemetry frames of `samples` samples spread over
+`topics` topics, one frame per sample.
+    """
+    rng = random.Random(seed)
+    transport = CaptureTransport()
+    telemetry = Pytelemetry(transport)
+    for i in range(samples):
+        topic = "topic{0}".format(i % topics)
+        if indexed:
+            topic = "{0}:{1}".format(topic, (i // topics) % INDEXES)
+        if datatype == 'string':
+            value = "sample{0}".format(i)
+        elif datatype in INT_RANGES:
+            value = rng.randint(*INT_RANGES[datatype])
+        else:
+            value = rng.uniform(-1000, 1000)
+        telemetry.publish(topic, value, datatype)
+    return transport.frames
+
+class SyntheticTransport:
+    """
+Transport replaying generated frames, at `rate` frames per second
+(0 makes all of them readable at once).
+    """
+    def __init__(self, frames, rate=0):
+        self.data = b''.join(frames)
+        # End offset of each frame, to release whole frames at the given rate
+        self.ends = []
+        end = 0
+        for frame in frames:
+            end += len(frame)
+            self.ends.append(end)
+        self.rate = rate
+        self.pos = 0
+        self.start = None
+        self.resetStats()
+
+    def connect(self, options):
+        self.start = time.monotonic()
+
+    def disconnect(self):
+        pass
+
+    def resetStats(self, averaging_window=100):
+        self.measurements = {"rx_bytes": 0, "tx_bytes": 0, "rx_chunks": 0, "tx_chunks": 0,
+                             "rx_in_waiting": 0, "rx_in_waiting_avg": 0, "rx_in_waiting_max": 0}
+
+    def stats(self):
+        return self.measurements
+
+    def _available(self):
+        if not self.rate:
+            return len(self.data)
+        due = int((time.monotonic() - self.start) * self.rate)
+        if due <= 0:
+            return 0
+        return self.ends[min(due, len(self.ends)) - 1]
+
+    def finished(self):
+        return self.pos >= len(self.data)
+
+    def readable(self):
+        amount = self._available() - self.pos
+        self.measurements['rx_in_waiting'] = amount
+        self.measurements['rx_in_waiting_max'] = max(amount, self.measurements['rx_in_waiting_max'])
+        return amount
+
+    def wait_readable(self, timeout):
+        # Sleeps until the next frame is due
+        if self.rate and not self.finished():
+            time.sleep(min(1.0 / self.rate, timeout))
+
+    def read(self, maxbytes=1):
+        data = self.data[self.pos:self.pos + maxbytes]
+        self.pos += len(data)
+        self.measurements['rx_bytes'] += len(data)
+        self.measurements['rx_chunks'] += 1
+        return data
+
+    def write(self, data):
+        return 0
+
+    def writeable(self):
+        return True
+
+def peak_rss():
+    # Peak resident memory of the process in kilobytes, None if unknown
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+class Measure:
+    """
+Measures the duration, allocated blocks and garbage collections of a
+benchmark run, as a context manager.
+    """
+    def __enter__(self):
+        gc.collect()
+        self.collections = sum(s['collections'] for s in gc.get_stats())
+        self.blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.allocated_blocks = sys.getallocatedblocks() - self.blocks
+        self.gc_collections = sum(s['collections'] for s in gc.get_stats()) - self.collections
+
+    def results(self, samples):
+        return {
+            'samples': samples,
+            'seconds': self.seconds,
+            'samples_per_s': samples / self.seconds if self.seconds else None,
+            'us_per_sample': self.seconds * 1e6 / samples if samples else None,
+            'allocated_blocks': self.allocated_blocks,
+            'gc_collections': self.gc_collections,
+            'peak_rss_kb': peak_rss()
+        }
+
+def bench_ingest(frames, rate=0):
+    """
+Feeds the frames through `Application`, its `Runner` and `Topics`, the
+same way the runner thread does.
+    """
+    from pytelemetrycli.cli import Application
+
+    transport = SyntheticTransport(frames, rate)
+    app = Application(transport=transport, stdout=io.StringIO())
+    runner = app.runner
+    runner.open("synthetic", 115200)
+
+    with Measure() as m:
+        while not transport.finished():
+            runner.wait()
+            runner.update()
+            runner.computeStats()
+
+    received = app.telemetry.stats()['protocol']['rx_decoded_frames']
+    results = m.results(received)
+    results['pipeline'] = dict((stage, runner.pipeline.stats(stage)) for stage in runner.pipeline.stages)
+    return results
+
+class PipeStub:
+    def poll(self):
+        return False
+    def send(self, msg):
+        pass
+
+class ItemStub:
+    def setData(self, *args):
+        pass
+
+class WindowStub:
+    def setWindowTitle(self, title):
+        pass
+
+class CounterStub:
+    value = 0
+
+def bench_plot(samples, topics, indexed=False, batch=64, seed=0):
+    """
+Sends batches of samples to a headless `Superplot` and measures its
+`_update`, as run by the plot process.
+    """
+    from pytelemetrycli.ui.superplot import Superplot, PlotType
+    from pytelemetrycli.ui.channels import TaggedQueue, PlotFeed
+
+    plottype = PlotType.indexed if indexed else PlotType.linear
+    plot = Superplot("bench")
+    plot.q = queue.Queue()
+    plot.consumed = CounterStub()
+    # Large enough for no sample to be skipped
+    feed = PlotFeed(plot.q, plot.consumed, capacity=samples)
+    plot.in_process_pipe = PipeStub()
+    plot.win = WindowStub()
+    def attach(curve):
+        curve.item = ItemStub()
+    plot._attach = attach
+
+    channels = []
+    for key in range(topics):
+        plot._process_msg(("add", key, "topic{0}".format(key), plottype, None))
+        channels.append(TaggedQueue(feed, key))
+
+    rng = random.Random(seed)
+    batches = []
+    for start in range(0, samples, batch):
+        n = min(batch, samples - start)
+        if indexed:
+            xs = [(start + i) % INDEXES for i in range(n)]
+        else:
+            xs = list(range(start, start + n))
+        batches.append([xs, [rng.uniform(-1000, 1000) for i in range(n)]])
+
+    with Measure() as m:
+        for i, item in enumerate(batches):
+            channels[i % topics].put(item)
+            # About one redraw per topic batch, as with the 50ms plot timer
+            if i % topics == topics - 1:
+                plot._update()
+        plot._update()
+
+    return m.results(samples)
+
+def bench_startup(runs=3):
+    """
+Imports the cli in `runs` fresh interpreters. Returns the fastest import
+time and process time (interpreter startup included), and the modules of
+the plotting stack loaded by the import, which should be none.
+    """
+    imports = []
+    processes = []
+    for i in range(runs):
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT.format(GUI_MODULES)],
+                                         universal_newlines=True)
+        processes.append(time.perf_counter() - start)
+        lines = output.splitlines()
+        imports.append(float(lines[0]))
+        loaded = [m for m in lines[1].split(',') if m] if len(lines) > 1 else []
+    return {'runs': runs, 'import_s': min(imports), 'process_s': min(processes), 'gui_modules': loaded}
+
+def run(samples=100000, topics=4, datatype='float32', indexed=False, rate=0, batch=64, seed=0, startup_runs=3):
+    frames = generate(samples, topics, datatype, indexed, seed)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'samples': samples, 'topics': topics, 'type': datatype,
+                       'indexed': indexed, 'rate': rate, 'batch': batch, 'seed': seed},
+        'benchmarks': {'ingest': bench_ingest(frames, rate)}
+    }
+    if datatype != 'string':
+        results['benchmarks']['plot'] = bench_plot(samples, topics, indexed, batch, seed)
+    if startup_runs:
+        results['startup'] = bench_startup(startup_runs)
+    return results
+
+def compare(results, baseline, tolerance=0.1):
+    """
+Returns the list of benchmarks slower than in `baseline` by more than
+`tolerance`, as (name, samples/s, baseline samples/s), and ('startup',
+seconds, baseline seconds) if the cli takes longer to import.
+    """
+    regressions = []
+    for name, bench in results['benchmarks'].items():
+        reference = baseline.get('benchmarks', {}).get(name)
+        if not reference or not reference.get('samples_per_s'):
+            continue
+        if bench['samples_per_s'] < reference['samples_per_s'] * (1 - tolerance):
+            regressions.append((name, bench['samples_per_s'], reference['samples_per_s']))
+
+    startup = results.get('startup')
+    reference = baseline.get('startup')
+    if startup and reference and startup['import_s'] > reference['import_s'] * (1 + tolerance):
+        regressions.append(('startup', startup['import_s'], reference['import_s']))
+    return regressions
+
+def main(argv=None):
+    arg = docopt(__doc__, argv)
+    results = run(samples=int(arg['--samples']),
+                  topics=int(arg['--topics']),
+                  datatype=arg['--type'],
+                  indexed=arg['--indexed'],
+                  rate=float(arg['--rate']),
+                  batch=int(arg['--batch']),
+                  seed=int(arg['--seed']),
+                  startup_runs=int(arg['--startup-runs']))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if arg['--output']:
+        with open(arg['--output'], 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if arg['--compare']:
+        with open(arg['--compare']) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, float(arg['--tolerance']))
+        for name, speed, reference in regressions:
+            if name == 'startup':
+                sys.stderr.write("startup : {0:.3f} s, baseline {1:.3f} s\n".format(speed, reference))
+            else:
+                sys.stderr.write("{0} : {1:.0f} samples/s, baseline {2:.0f} samples/s\n".format(name, speed, reference))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
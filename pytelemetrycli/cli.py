@@ -4,24 +4,31 @@ import cmd
 from docopt import docopt, DocoptExit
 from pytelemetry import Pytelemetry
 import pytelemetry.transports.serialtransport as transports
-from pytelemetrycli.topics import Topics
+from pytelemetrycli.topics import Topics, Retention
+from pytelemetrycli.storage import SessionStore
 from pytelemetrycli.runner import Runner
-from pytelemetrycli.tools import isclose
+from pytelemetrycli.connections import ConnectionPool
+from pytelemetrycli.server import StreamServer
+from pytelemetrycli.publisher import read_script
+from pytelemetrycli.recording import RecordingTransport, ReplayTransport
+from pytelemetrycli.tools import isclose, parse_duration
 from serial.tools import list_ports
-from serial import SerialTimeoutException
-from pytelemetrycli.ui.superplot import Superplot, PlotType
-from threading import Lock
+from serial import SerialTimeoutException, SerialException
+from pytelemetrycli.ui.monitor import PlotMonitor
 from pytelemetrycli.initialization import init_logging
 import logging
 from logging import getLogger
 import os
+import struct
+import time
+from fnmatch import fnmatchcase
 
 logger = getLogger('cli')
 
 def docopt_cmd(func):
     def fn(self, arg):
         try:
-            if fn.__name__ == "do_pub":
+            if fn.__name__ in ("do_pub", "do_derive"):
                 # Fix for negative numbers
                 opt = docopt(fn.__doc__, arg, options_first=True)
             else:
@@ -45,9 +52,11 @@ def docopt_cmd(func):
     return fn
 
 class Application (cmd.Cmd):
-    def __init__(self, transport=None, stdout=None):
+    def __init__(self, transport=None, stdout=None, transport_factory=None, headless=False):
         # cmd Initialization and configuration
         cmd.Cmd.__init__(self,stdout=stdout)
+        # Without GUI, the plotting stack (Qt, pyqtgraph, NumPy) is never loaded
+        self.headless = headless
         self.intro = 'pytelemetry terminal started.' \
                  + ' (type help for a list of commands.)'
         self.prompt = ':> '
@@ -55,21 +64,27 @@ class Application (cmd.Cmd):
 
         # pytelemetry setup
         if not transport:
-            self.transport = transports.SerialTransport()
-        else:
-            self.transport = transport
+            transport = transports.SerialTransport()
+        # Transport used by `serial`, `replay` attaches another one temporarily
+        self.default_transport = transport
+        self.transport = RecordingTransport(transport)
         self.telemetry = Pytelemetry(self.transport)
 
         self.topics = Topics()
-        self.plots = []
-        self.plotsLock = Lock()
+        self.plots = PlotMonitor()
+        self.exports = []
+        self.server = None
+        self.next_plot = 0
         self.runner = Runner(self.transport,
                              self.telemetry,
                              self.plots,
-                             self.plotsLock,
                              self.topics)
 
-        self.telemetry.subscribe(None,self.topics.process)
+        self.telemetry.subscribe(None,self.runner.collect)
+
+        # Named connections, each with a new transport
+        self.connections = ConnectionPool(self.topics, transport_factory or transports.SerialTransport,
+                                          self.plots)
 
         self.types_lookup = {'--s'    :  'string',
                              '--u8'   :  'uint8',
@@ -93,10 +108,19 @@ class Application (cmd.Cmd):
         """
 List serial ports or connect to one of them.
 
+With --as, connects to another device along with the current connections.
+Topics of that device are prefixed with its name (ex : left.imu).
+Without --as, all topics are cleared, named connections must be closed first.
+
 Usage: serial ((-l | --list) | <port> [options])
 
 Options:
 -b X, --bauds X         Connection speed in bauds  [default: 9600]
+--as NAME               Name of the connection, keeps the other connections and topics
+-c N, --capacity N      Keep at most N samples per topic
+-a S, --max-age S       Keep samples for at most S seconds
+-m MB, --memory MB      Keep at most MB megabytes of samples for all topics
+-s DIR, --session DIR   Store received samples on disk in session directory DIR
         """
         if arg['--list'] or arg['-l']:
             self.stdout.write("Available COM ports:\n")
@@ -104,6 +128,13 @@ Options:
                 self.stdout.write("%s \t %s\n" % (port,desc))
             return
 
+        if arg['--as'] is not None:
+            self._connect_named(arg)
+            return
+
+        if self._named_connections_open():
+            return
+
         try:
             self.runner.disconnect()
             logger.warn("User requested connect without desconnecting first.")
@@ -112,13 +143,19 @@ Options:
                          .format(e))
             pass
 
-        self.topics.clear()
-        logger.info("Cleared all topics for new session.")
+        if not self._apply_retention(arg):
+            return
 
-        self.transport.resetStats(averaging_window=10)
-        self.runner.resetStats()
-        self.telemetry.resetStats()
-        logger.info("Cleared all stats for new session.")
+        self._new_session(self.default_transport)
+
+        if arg['--session']:
+            try:
+                self.topics.use_store(arg['--session'])
+            except (IOError, ValueError) as e:
+                s = "Could not use session {0} : {1}\n".format(arg['--session'], e)
+                self.stdout.write(s)
+                logger.warning(s)
+                return
 
         try:
             b = int(arg['--bauds'])
@@ -134,6 +171,297 @@ Options:
             self.stdout.write(s)
             logger.info(s)
 
+    def _connect_named(self, arg):
+        name = arg['--as']
+        if not name.isidentifier():
+            s = "Invalid connection name '{0}', use letters, digits and _.\n".format(name)
+            self.stdout.write(s)
+            logger.warning(s)
+            return
+
+        if not self._apply_retention(arg):
+            return
+
+        if arg['--session'] and self.topics.store is None:
+            try:
+                self.topics.use_store(arg['--session'])
+            except (IOError, ValueError) as e:
+                s = "Could not use session {0} : {1}\n".format(arg['--session'], e)
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+
+        try:
+            b = int(arg['--bauds'])
+            self.connections.open(name, arg['<port>'], b)
+        except (IOError, ValueError) as e:
+            s = "Failed to connect {0} to {1} at {2} (bauds).\n".format(name, arg['<port>'], arg['--bauds'])
+            self.stdout.write(s)
+            logger.warning("{0}E : {1}".format(s, e))
+        else:
+            s = "Connected {0} to {1} at {2} (bauds).\n".format(name, arg['<port>'], b)
+            self.stdout.write(s)
+            logger.info(s)
+
+    def _named_connections_open(self):
+        # A new session clears all topics, including the ones the named connections still write to
+        if not self.connections.names():
+            return False
+        s = ("Named connections are open : {0}. Disconnect them first, "
+             "or connect another device with --as.".format(", ".join(self.connections.names())))
+        self.stdout.write(s + "\n")
+        logger.warning(s)
+        return True
+
+    def _new_session(self, transport):
+        self.transport.attach(transport)
+
+        self.topics.clear()
+        logger.info("Cleared all topics for new session.")
+
+        self.transport.resetStats(averaging_window=10)
+        self.runner.resetStats()
+        self.telemetry.resetStats()
+        logger.info("Cleared all stats for new session.")
+
+    @docopt_cmd
+    def do_record(self, arg):
+        """
+Records all received bytes to <file>, until `record --stop`.
+Recordings can be decoded again later with the `replay` command.
+
+Usage: record (<file> | --stop)
+        """
+        if arg['--stop']:
+            recorder = self.transport.stop()
+            if recorder is None:
+                s = "Not recording."
+            else:
+                s = "Stopped recording to {0} ({1} bytes).".format(recorder.path, recorder.size)
+            self.stdout.write(s + "\n")
+            logger.info(s)
+            return
+
+        try:
+            self.transport.record(arg['<file>'])
+        except IOError as e:
+            s = "Could not record to {0} : {1}".format(arg['<file>'], e)
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            return
+
+        s = "Recording received data to {0}.".format(arg['<file>'])
+        self.stdout.write(s + "\n")
+        logger.info(s)
+
+    @docopt_cmd
+    def do_open(self, arg):
+        """
+Opens a session stored on disk with `serial <port> --session <session>`.
+All current topics are replaced by the ones of the session.
+
+Usage: open <session>
+        """
+        path = arg['<session>']
+        if not os.path.isfile(os.path.join(path, SessionStore.MANIFEST)):
+            s = "No session found in {0}.".format(path)
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            return
+
+        if self._named_connections_open():
+            return
+
+        try:
+            self.runner.disconnect()
+        except (IOError,AttributeError) as e:
+            logger.warn("Already disconnected. Continuing happily. E : {0}"
+                         .format(e))
+
+        self._new_session(self.default_transport)
+
+        try:
+            self.topics.open_session(path)
+        except (IOError, ValueError, KeyError) as e:
+            s = "Could not open session {0} : {1}".format(path, e)
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            return
+
+        s = "Opened session {0} : {1} topics.".format(path, len(self.topics.ls()))
+        self.stdout.write(s + "\n")
+        logger.info(s)
+
+    @docopt_cmd
+    def do_replay(self, arg):
+        """
+Decodes a recording made with the `record` command, as if received from a device.
+Use `serial` to connect to a device again.
+
+Usage: replay <file> [options]
+
+Options:
+-s X, --speed X         Replay speed, 1 is real time, 0 as fast as possible [default: 1]
+-b X, --bauds X         Baudrate of the recorded link, for stats [default: 9600]
+        """
+        try:
+            speed = float(arg['--speed'])
+            b = int(arg['--bauds'])
+        except ValueError as e:
+            s = "Invalid replay option : {0}".format(e)
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            return
+
+        if self._named_connections_open():
+            return
+
+        try:
+            self.runner.disconnect()
+        except (IOError,AttributeError) as e:
+            logger.warn("Already disconnected. Continuing happily. E : {0}"
+                         .format(e))
+
+        self._new_session(ReplayTransport(speed=speed))
+
+        try:
+            self.runner.connect(arg['<file>'],b)
+        except IOError as e:
+            s = "Failed to replay {0} : {1}".format(arg['<file>'], e)
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            self.transport.attach(self.default_transport)
+        else:
+            s = "Replaying {0} at speed {1}.".format(arg['<file>'], speed)
+            self.stdout.write(s + "\n")
+            logger.info(s)
+
+    def _apply_retention(self, arg, topic=None):
+        # Applies the retention options from a command on top of the current settings
+        if topic is None:
+            current = self.topics.retention
+        else:
+            current = self.topics.topic_list[topic]
+
+        capacity = current.capacity
+        max_age = current.max_age
+        budget = getattr(current, 'budget', None)
+        policy = arg.get('--policy')
+
+        try:
+            if arg['--capacity'] is not None:
+                capacity = int(arg['--capacity']) or None
+            if arg['--max-age'] is not None:
+                max_age = float(arg['--max-age']) or None
+            if arg['--memory'] is not None:
+                budget = int(float(arg['--memory']) * 1024 * 1024) or None
+        except ValueError as e:
+            s = "Invalid retention option : {0}\n".format(e)
+            self.stdout.write(s)
+            logger.warning(s)
+            return False
+
+        if topic is not None:
+            self.topics.set_retention(topic, capacity=capacity, max_age=max_age)
+            return True
+
+        try:
+            self.topics.set_retention(capacity=capacity, max_age=max_age,
+                                      budget=budget, policy=policy)
+        except ValueError as e:
+            s = "{0}. Use one of : {1}.\n".format(e, ", ".join(Retention.policies))
+            self.stdout.write(s)
+            logger.warning(s)
+            return False
+        return True
+
+    @docopt_cmd
+    def do_retention(self, arg):
+        """
+Displays or changes how many received samples are kept in memory.
+Without options, prints the current retention settings.
+With <topic>, capacity and max age only apply to that topic, and are kept
+when the settings of all topics change afterwards.
+
+Usage: retention [<topic>] [options]
+
+Options:
+-c N, --capacity N      Keep at most N samples per topic. 0 keeps all samples.
+-a S, --max-age S       Keep samples for at most S seconds. 0 keeps all samples.
+-m MB, --memory MB      Keep at most MB megabytes of samples for all topics. 0 disables the budget.
+-p P, --policy P        Topics evicted first to fit the memory budget : oldest | lru
+        """
+        topic = arg['<topic>']
+        if topic is not None and not self.topics.exists(topic):
+            s = "Topic '{0}' unknown. Type 'ls' to list all available topics.\n".format(topic)
+            self.stdout.write(s)
+            logger.warn(s)
+            return
+
+        options = ('--capacity', '--max-age', '--memory', '--policy')
+        if any(arg[o] is not None for o in options):
+            if topic is not None and (arg['--memory'] is not None or arg['--policy'] is not None):
+                self.stdout.write("--memory and --policy apply to all topics, ignored.\n")
+            if not self._apply_retention(arg, topic):
+                return
+
+        if topic is None:
+            current = self.topics.retention
+        else:
+            current = self.topics.topic_list[topic]
+
+        self.stdout.write("capacity : {0}\n".format(
+            "{0} samples".format(current.capacity) if current.capacity else "unlimited"))
+        self.stdout.write("max age : {0}\n".format(
+            "{0} s".format(current.max_age) if current.max_age else "unlimited"))
+
+        if topic is None:
+            used = self.topics.nbytes() / (1024 * 1024)
+            if current.budget:
+                budget = "{0:.1f} MB".format(current.budget / (1024 * 1024))
+            else:
+                budget = "unlimited"
+            self.stdout.write("memory : {0} ({1:.1f} MB used)\n".format(budget, used))
+            self.stdout.write("policy : {0}\n".format(current.policy))
+        else:
+            self.stdout.write("retained : {0} / {1} samples\n".format(
+                self.topics.count(topic), self.topics.received(topic)))
+
+    @docopt_cmd
+    def do_trace(self, arg):
+        """
+Controls the trace of received samples in the session logs (samples-<date>.log).
+Tracing every sample slows down reception at high data rates, prefer tracing
+one sample out of N in that case.
+
+Usage: trace [(on | off | every <N>)]
+        """
+        if arg['on']:
+            self.topics.set_trace(1)
+        elif arg['off']:
+            self.topics.set_trace(0)
+        elif arg['every']:
+            try:
+                every = int(arg['<N>'])
+                if every < 1:
+                    raise ValueError
+            except ValueError:
+                s = "Could not cast <N> = '{0}' to a positive integer.\n".format(arg['<N>'])
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+            self.topics.set_trace(every)
+
+        every = self.topics.trace_every
+        if every == 0:
+            s = "Sample trace : off"
+        elif every == 1:
+            s = "Sample trace : all samples"
+        else:
+            s = "Sample trace : 1 sample out of {0}".format(every)
+        self.stdout.write(s + "\n")
+        logger.info(s)
+
     @docopt_cmd
     def do_print(self, arg):
         """
@@ -144,6 +472,7 @@ Usage: print <topic> [options]
 Options:
 -a, --all        Display all received samples under <topic>
 -l X, --limit X  Display X last received samples under <topic> [default: 1]
+-s X, --since X  Display samples received in the last X (ex : 10s, 500ms, 2m)
 
         """
         topic = arg['<topic>']
@@ -164,21 +493,99 @@ Options:
             logger.warn(s)
             amount = 1
 
+        if arg['--since'] is not None:
+            try:
+                since = time.monotonic() - parse_duration(arg['--since'])
+            except ValueError:
+                s = "Could not parse --since = '{0}'. Use a duration like 10s, 500ms or 2m.\n".format(arg['--since'])
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+            for i in self.topics.samples(topic, since=since):
+                self.stdout.write("{0}\n".format(i))
+            return
+
         s = self.topics.samples(topic,amount)
 
+        received = self.topics.received(topic)
+        retained = self.topics.count(topic)
+        if received > retained and (amount == 0 or amount > retained):
+            self.stdout.write("(showing {0} retained samples out of {1} received)\n"
+                              .format(retained, received))
+
         if s is not None:
             for i in s:
                 self.stdout.write("{0}\n".format(i))
         else:
             logger.error("Could not retrieve {0} sample(s) under topic '{1}'.\n".format(amount,topic))
 
+    @docopt_cmd
+    def do_export(self, arg):
+        """
+Exports one or several <topic> to <file>, in the background.
+The format follows the file extension : .csv, .npz or .parquet (requires pyarrow).
+With --live, keeps exporting newly received samples until `export --stop`,
+which only stops the live exports.
+
+Usage: export <file> <topic>... [--live]
+       export --stop
+        """
+        if arg['--stop']:
+            # Exports of the samples received so far complete on their own
+            live = [e for e in self.exports if e.live]
+            if not live:
+                self.stdout.write("No live export.\n")
+                return
+            for exporter in live:
+                exporter.stop()
+                s = "Export to {0} stopped, {1} samples written.\n".format(exporter.path, exporter.written)
+                self.stdout.write(s)
+                logger.info(s)
+            self.exports = [e for e in self.exports if not e.live]
+            return
+
+        # NumPy is only loaded once needed
+        from pytelemetrycli.export import Exporter, format_for
+
+        path = arg['<file>']
+        if format_for(path) is None:
+            s = "Unknown export format for {0}. Use one of : .csv, .npz, .parquet.\n".format(path)
+            self.stdout.write(s)
+            logger.warning(s)
+            return
+
+        for topic in arg['<topic>']:
+            if not self.topics.exists(topic):
+                s = "Topic '{0}' unknown. Type 'ls' to list all available topics.\n".format(topic)
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+
+        try:
+            exporter = Exporter(self.topics, arg['<topic>'], path, live=arg['--live'])
+        except (IOError, ImportError) as e:
+            s = "Could not export to {0} : {1}\n".format(path, e)
+            self.stdout.write(s)
+            logger.warning(s)
+            return
+
+        # Forget the exports that are done
+        self.exports = [e for e in self.exports if e.running()]
+        self.exports.append(exporter)
+        exporter.start()
+
+        s = "Exporting {0} topic(s) to {1}{2}.\n".format(len(arg['<topic>']), path,
+                                                        " until export --stop" if arg['--live'] else "")
+        self.stdout.write(s)
+        logger.info(s)
+
     @docopt_cmd
     def do_ls(self, arg):
         """
 Prints available topics. Topics are basically labels under which data is available (for display, plot, etc).
 Data can come from remote source (a connected embedded device) or the command-line interface itself (reception speed, etc).
 
-Without flags, prints a list of remote topics.
+Without flags, prints a list of remote and derived topics.
 
 Usage: ls [options]
 
@@ -190,69 +597,207 @@ Options:
                 self.stdout.write("%s\n" % topic)
             return
 
-        for topic in self.topics.ls(source='remote'):
+        for topic in sorted(self.topics.ls(source='remote') + self.topics.ls(source='derived')):
             self.stdout.write("%s\n" % topic)
 
 
     @docopt_cmd
     def do_plot(self, arg):
         """
-Plots <topic> in a graph window.
-
-Usage: plot <topic>
-        """
+Plots one or several <topic> in a graph window.
+Topics are drawn on the same plot, or in stacked plots sharing the
+x axis with --stack. Use --in to add topics to an opened graph window.
+When the window falls behind, samples waiting to be drawn are limited to
+--capacity, the others are skipped. The lag and the amount of skipped
+samples are shown in the window title.
 
-        topic = arg['<topic>']
+Usage: plot <topic>... [options]
 
-        if not self.topics.exists(topic):
-            s = "Topic '{0}' unknown. Type 'ls' to list all available topics.\n".format(topic)
+Options:
+-c X, --channel X       Channel sending data to the plot : queue | shm [default: queue]
+                        shm (shared memory) sustains higher data rates.
+-s, --stack             One plot per topic, stacked vertically.
+-t, --time              Use the receive time of linear samples as x axis (s).
+-i N, --in N            Number of the opened graph window to add topics to.
+-b N, --capacity N      Most samples waiting to be drawn, for the window (queue)
+                        or for each topic (shm) [default: 262144]
+-o P, --overflow P      Samples skipped once behind : decimate | drop [default: decimate]
+                        decimate keeps every other sample, drop only the most recent.
+        """
+        if self.headless:
+            s = "Plots are not available in headless mode.\n"
             self.stdout.write(s)
-            logger.warn(s)
+            logger.warning(s)
             return
 
-        if self.topics.intransfer(topic):
-            s = "Topic '{0}' already plotting.\n".format(topic)
+        topics = arg['<topic>']
+
+        for topic in topics:
+            if not self.topics.exists(topic):
+                s = "Topic '{0}' unknown. Type 'ls' to list all available topics.\n".format(topic)
+                self.stdout.write(s)
+                logger.warn(s)
+                return
+
+        # A topic has a single curve per window
+        for topic in topics:
+            if topics.count(topic) > 1:
+                s = "Topic '{0}' given more than once.\n".format(topic)
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+
+        # The plotting stack is only loaded with the first plot
+        from pytelemetrycli.ui.superplot import Superplot, PlotType
+        from pytelemetrycli.ui.channels import PlotFeed
+
+        if arg['--channel'] not in ('queue', 'shm'):
+            s = "Unknown plot channel '{0}'. Use one of : queue, shm.\n".format(arg['--channel'])
             self.stdout.write(s)
-            logger.warn(s)
+            logger.warning(s)
             return
 
-        has_indexes = self.topics.has_indexed_data(arg['<topic>'])
-
-        if has_indexes:
-            plotType = PlotType.indexed
-            transferType = "indexed"
+        if arg['--in'] is not None:
+            entry = self.plots.find('id', arg['--in'])
+            if entry is None:
+                s = "No graph window '{0}' opened.\n".format(arg['--in'])
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+            for topic in topics:
+                if topic in entry['plot'].channels:
+                    s = "Topic '{0}' already plotting in window {1}.\n".format(topic, entry['id'])
+                    self.stdout.write(s)
+                    logger.warning(s)
+                    return
         else:
-            plotType = PlotType.linear
-            transferType = "linear"
-
-        p = Superplot(topic,plotType)
-        q, ctrl = p.start()
+            if arg['--overflow'] not in PlotFeed.policies:
+                s = "Unknown overflow policy '{0}'. Use one of : {1}.\n".format(arg['--overflow'], ", ".join(PlotFeed.policies))
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+            try:
+                capacity = int(arg['--capacity'])
+                if capacity < 1:
+                    raise ValueError
+            except ValueError:
+                s = "Could not cast --capacity = '{0}' to a positive integer.\n".format(arg['--capacity'])
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+
+            layout = 'stack' if arg['--stack'] else 'shared'
+            p = Superplot(", ".join(topics), channel=arg['--channel'], layout=layout,
+                          capacity=capacity, overflow=arg['--overflow'])
+            try:
+                q, ctrl = p.start()
+            except RuntimeError as e:
+                s = "Could not start plot : {0}\n".format(e)
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+
+            self.next_plot += 1
+            entry = {
+                'id': str(self.next_plot), # Number of the graph window
+                'plot': p,     # Plot handler
+                'queue': q,    # Data queue
+                'ctrl': ctrl   # Plot control pipe
+            }
+            self.plots.add(entry)
+
+        for topic in topics:
+            if self.topics.has_indexed_data(topic):
+                plotType = PlotType.indexed
+                transferType = "indexed"
+            else:
+                plotType = PlotType.linear
+                transferType = "time" if arg['--time'] else "linear"
 
-        # Protect self.plots from modifications from the runner thread
-        self.plotsLock.acquire()
+            channel = entry['plot'].add_curve(topic, plotType)
+            # Time spent sending samples to the plot is measured by the runner feeding the topic
+            connection, local = self.connections.route(topic)
+            runner = self.runner if connection is None else connection.runner
+            channel = runner.pipeline.timed(channel)
+            self.topics.transfer(topic, channel, transfer_type=transferType, owner=entry['plot'])
 
-        self.plots.append({
-            'topic': topic,
-            'plot': p,     # Plot handler
-            'queue': q,    # Data queue
-            'ctrl': ctrl   # Plot control pipe
-        })
+            s = "Plotting '{0}' in mode [{1}] in window {2}.\n".format(topic,transferType,entry['id'])
+            logger.info(s)
+            self.stdout.write(s)
 
-        self.plotsLock.release()
+    @docopt_cmd
+    def do_unplot(self, arg):
+        """
+Removes one or several <topic> from their graph windows, or only from window N.
 
-        self.topics.transfer(topic,q, transfer_type=transferType)
+Usage: unplot <topic>... [options]
 
-        s = "Plotting '{0}' in mode [{1}].\n".format(topic,transferType)
-        logger.info(s)
-        self.stdout.write(s)
+Options:
+-i N, --in N            Number of the graph window to remove topics from.
+        """
+        for topic in arg['<topic>']:
+            entries = [p for p in self.plots.plots() if topic in p['plot'].channels
+                       and arg['--in'] in (None, p['id'])]
+
+            if not entries:
+                s = "Topic '{0}' is not plotted.\n".format(topic)
+                self.stdout.write(s)
+                logger.warning(s)
+                continue
+
+            for entry in entries:
+                # The runners may be sending samples to the data channel
+                with self.topics.lock:
+                    self.topics.untransfer(topic, entry['plot'])
+                    entry['plot'].remove_curve(topic)
+                s = "Removed '{0}' from window {1}.\n".format(topic, entry['id'])
+                logger.info(s)
+                self.stdout.write(s)
 
     @docopt_cmd
     def do_pub(self, arg):
         """
 Publishes a (value | string) on <topic>.
+Topics prefixed with the name of a connection (ex : left.led) are published to that device.
+Once connected, samples are sent by a writer thread and pub returns right away.
+With --file, publishes the timed samples of a CSV file, one row time,topic,type,value
+per sample, time in seconds from now and type u8 | u16 | u32 | i8 | i16 | i32 | f32 | s.
+--rate limits the samples sent per second (0 for no limit), --cancel drops the
+samples waiting to be sent.
 
 Usage: pub (--u8 | --u16 | --u32 | --i8 | --i16 | --i32 | --f32 | --s) <topic> <value>
+       pub --file <file>
+       pub --rate <R>
+       pub --cancel
         """
+        if arg['--file']:
+            self._pub_file(arg['<file>'])
+            return
+
+        publishers = [self.runner.publisher] + [c.runner.publisher for c in self.connections.connections.values()]
+        if arg['--rate']:
+            try:
+                rate = float(arg['<R>'])
+                if rate < 0:
+                    raise ValueError
+            except ValueError:
+                s = "Could not cast <R> = '{0}' to a positive number.".format(arg['<R>'])
+                self.stdout.write(s + "\n")
+                logger.warning(s)
+                return
+            for publisher in publishers:
+                publisher.set_rate(rate or None)
+            s = "Publish rate limit : {0}".format("{0:g} samples/s".format(rate) if rate else "none")
+            self.stdout.write(s + "\n")
+            logger.info(s)
+            return
+
+        if arg['--cancel']:
+            amount = sum(publisher.cancel() for publisher in publishers)
+            s = "Cancelled {0} queued samples.".format(amount)
+            self.stdout.write(s + "\n")
+            logger.info(s)
+            return
 
         if arg['--f32']:
             arg['<value>'] = float(arg['<value>'])
@@ -286,13 +831,18 @@ Usage: pub (--u8 | --u16 | --u32 | --i8 | --i16 | --i32 | --f32 | --s) <topic> <
                 .format(arg))
             return
 
+        # Topics of named connections are published to their device
+        connection, topic = self.connections.route(arg['<topic>'])
+        runner = self.runner if connection is None else connection.runner
+
         try:
-            self.telemetry.publish(arg['<topic>'],arg['<value>'],valtype)
+            runner.publisher.publish(topic,arg['<value>'],valtype)
         except SerialTimeoutException as e:
             self.stdout.write("Pub failed. Connection most likely terminated.")
             logger.error("Pub failed. Connection most likely terminated. exception : %s" % e)
             return
-        except AttributeError as e:
+        except (AttributeError, SerialException) as e:
+            # No port opened yet, or closed by disconnect
             self.stdout.write("Pub failed because you are not connected to any device. Connect first using `serial` command.")
             logger.warning("Trying to publish while not connected. exception : %s" % e)
             return
@@ -301,28 +851,236 @@ Usage: pub (--u8 | --u16 | --u32 | --i8 | --i16 | --i32 | --f32 | --s) <topic> <
         self.stdout.write(s + "\n")
         logger.info(s)
 
+    def _pub_file(self, path):
+        try:
+            rows = read_script(path)
+        except (IOError, ValueError) as e:
+            s = "Could not read {0} : {1}".format(path, e)
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            return
+
+        # Rows of each connection, all of them starting now
+        scripts = dict()
+        for t, topic, value, datatype in rows:
+            connection, topic = self.connections.route(topic)
+            runner = self.runner if connection is None else connection.runner
+            scripts.setdefault(runner.publisher, []).append((t, topic, value, datatype))
+
+        if not all(publisher.running for publisher in scripts):
+            s = "Pub failed because you are not connected to any device. Connect first using `serial` command."
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            return
+
+        start = time.monotonic()
+        try:
+            for publisher, script in scripts.items():
+                publisher.schedule(script, start)
+        except (IndexError, ValueError, struct.error) as e:
+            s = "Could not publish {0} : {1}".format(path, e)
+            self.stdout.write(s + "\n")
+            logger.warning(s)
+            return
+
+        duration = rows[-1][0] if rows else 0
+        s = "Publishing {0} samples from {1} over {2:g} s.".format(len(rows), path, duration)
+        self.stdout.write(s + "\n")
+        logger.info(s)
+
     @docopt_cmd
     def do_count(self, arg):
         """
 Prints a count of received samples for each topic.
+If samples were evicted, also prints the amount of retained samples.
 
 Usage: count
         """
         for topic in self.topics.ls():
-            self.stdout.write("{0} : {1}\n".format(topic, self.topics.count(topic)))
+            received = self.topics.received(topic)
+            retained = self.topics.count(topic)
+            if received > retained:
+                self.stdout.write("{0} : {1} ({2} retained)\n".format(topic, received, retained))
+            else:
+                self.stdout.write("{0} : {1}\n".format(topic, received))
+
+    @docopt_cmd
+    def do_summary(self, arg):
+        """
+Prints the count, min, max, mean, standard deviation and approximate
+percentiles of numeric topics. <topic> can be a glob pattern (ex : imu*).
+Figures cover all the samples received, including evicted ones.
+
+Usage: summary <topic>...
+        """
+        names = []
+        for pattern in arg['<topic>']:
+            matched = [t for t in self.topics.ls(source=None) if fnmatchcase(t, pattern)]
+            if not matched:
+                s = "Topic '{0}' unknown. Type 'ls' to list all available topics.\n".format(pattern)
+                self.stdout.write(s)
+                logger.warning(s)
+            names.extend(t for t in matched if t not in names)
+
+        for topic in names:
+            # Quantiles compress the digest, which the runners update
+            with self.topics.lock:
+                stats = self.topics.summary(topic).stats()
+            if not stats['count']:
+                self.stdout.write("{0} : no numeric samples\n".format(topic))
+                continue
+            values = ["count {0}".format(stats.pop('count'))]
+            for key in ('min', 'max', 'mean', 'std', 'p50', 'p90', 'p99'):
+                if stats[key] is not None:
+                    values.append("{0} {1:.6g}".format(key, stats[key]))
+            self.stdout.write("{0} : {1}\n".format(topic, ", ".join(values)))
+
+    @docopt_cmd
+    def do_derive(self, arg):
+        """
+Defines the topic <name>, computed from other topics with <expr> as samples
+are received (ex : derive power = voltage * current).
+<expr> is an arithmetic expression over topic names, with the functions
+sqrt, abs, exp, log, sin, cos, arctan2, hypot, minimum, maximum, clip, where...
+One sample is computed per sample of the first topic of <expr>, or of the
+topic given with --on. The other topics use their latest sample.
+Without arguments, lists the derived topics.
+
+Usage: derive [options] <name> = <expr>...
+       derive --remove <name>
+       derive
+
+Options:
+-o T, --on T    Topic whose samples drive the computation.
+-r, --remove    Stops computing <name>, its samples are kept.
+        """
+        if arg['--remove']:
+            if not any(d.name == arg['<name>'] for d in self.topics.derived):
+                s = "Topic '{0}' is not derived.\n".format(arg['<name>'])
+                self.stdout.write(s)
+                logger.warning(s)
+                return
+            self.topics.underive(arg['<name>'])
+            return
+
+        if arg['<name>'] is None:
+            for derived in self.topics.derived:
+                self.stdout.write("{0} = {1}\n".format(derived.name, derived.expression))
+            return
+
+        expression = " ".join(arg['<expr>'])
+        try:
+            self.topics.derive(arg['<name>'], expression, arg['--on'])
+        except ValueError as e:
+            s = "{0}.\n".format(e)
+            self.stdout.write(s)
+            logger.warning(s)
+            return
+        s = "Derived topic '{0}' = {1}".format(arg['<name>'], expression)
+        self.stdout.write(s + "\n")
+        logger.info(s)
+
+    @docopt_cmd
+    def do_connections(self, arg):
+        """
+Lists the named connections opened with `serial <port> --as <name>`.
+
+Usage: connections
+        """
+        for name in self.connections.names():
+            connection = self.connections.connections[name]
+            received = connection.transport.stats()['rx_bytes']
+            self.stdout.write("{0} : {1} at {2} (bauds), {3} bytes received\n"
+                              .format(name, connection.port, connection.bauds, received))
+
+    @docopt_cmd
+    def do_serve(self, arg):
+        """
+Serves the topics to remote clients over TCP, in the background : topic
+list, stored samples and live subscriptions (see pytelemetrycli.server).
+Use --host 0.0.0.0 to serve the local network. Each client has its own
+send buffer of --buffer samples, its oldest samples are dropped when it
+does not keep up. Without options, shows the connected clients.
+
+Usage: serve [options]
+       serve --stop
+
+Options:
+-H HOST, --host HOST    Address to listen on [default: 127.0.0.1]
+-p PORT, --port PORT    TCP port [default: 7878]
+-b N, --buffer N        Most samples buffered for each client [default: 65536]
+        """
+        if arg['--stop']:
+            if self.server is None:
+                s = "Not serving."
+            else:
+                s = "Server stopped, {0} clients disconnected.".format(self.server.stop())
+                self.server = None
+            self.stdout.write(s + "\n")
+            logger.info(s)
+            return
+
+        if self.server is not None:
+            host, port = self.server.address()
+            self.stdout.write("Serving topics on {0}:{1}, {2} clients.\n".format(host, port, len(self.server.clients())))
+            for session in self.server.clients():
+                subscription = session.subscription
+                pending = dropped = 0
+                if subscription is not None:
+                    pending, dropped = subscription.pending(), subscription.dropped
+                self.stdout.write("\t%s : %s bytes sent, pending %s, dropped %s\n"
+                                  % (session.name, session.sent, pending, dropped))
+            return
+
+        try:
+            port = int(arg['--port'])
+            buffer = int(arg['--buffer'])
+            if buffer < 1:
+                raise ValueError("buffer must be positive")
+        except ValueError as e:
+            s = "Invalid serve option : {0}\n".format(e)
+            self.stdout.write(s)
+            logger.warning(s)
+            return
+
+        server = StreamServer(self.topics, arg['--host'], port, buffer)
+        try:
+            server.start()
+        except (IOError, OSError) as e:
+            s = "Could not serve on {0}:{1} : {2}\n".format(arg['--host'], port, e)
+            self.stdout.write(s)
+            logger.warning(s)
+            return
+
+        self.server = server
+        s = "Serving topics on {0}:{1}.\n".format(*server.address())
+        self.stdout.write(s)
+        logger.info(s)
 
     @docopt_cmd
     def do_disconnect(self, arg):
         """
-Disconnects from any open connection.
+Disconnects from any open connection, or only from the connection <name>.
 
-Usage: disconnect
+Usage: disconnect [<name>]
         """
+        if arg['<name>'] is not None:
+            if self.connections.close(arg['<name>']):
+                s = "Disconnected {0}.".format(arg['<name>'])
+            else:
+                s = "No connection named {0}.".format(arg['<name>'])
+            self.stdout.write(s + "\n")
+            logger.info(s)
+            return
+
+        self.connections.close_all()
         try:
             self.runner.disconnect()
             self.stdout.write("Disconnected.\n")
             logger.info("Disconnected.")
 
+            self.topics.sync()
+
             measures = self.transport.stats()
 
             for key,item in measures.items():
@@ -366,9 +1124,17 @@ Usage: info
 Displays different metrics about the active transport (ex : serial port).
 This allows you to know if for instance corrupted frames are received, what fraction
 of the maximum baudrate is being used, etc.
+With --pipeline, displays the time spent in each stage of the processing
+of received data (in microseconds), and the state of the plots.
+Without it, also displays the subscriptions to the topics (ex : live exports)
+with the samples waiting to be consumed and the ones dropped.
 
-Usage: stats
+Usage: stats [--pipeline]
         """
+        if arg['--pipeline']:
+            self._pipeline_stats()
+            return
+
         measures = self.transport.stats()
 
         self.stdout.write("Raw IO:\n")
@@ -391,6 +1157,30 @@ Usage: stats
         for key,item in measures['protocol'].items():
             self.stdout.write("\t%s : %s\n" % (key,item))
 
+        subscriptions = list(self.topics.subscriptions)
+        if subscriptions:
+            self.stdout.write("Subscriptions:\n")
+            for subscription in subscriptions:
+                self.stdout.write("\t%s : %s, pending %s, dropped %s\n" % (subscription.name, subscription.policy,
+                                  subscription.pending(), subscription.dropped))
+
+    def _pipeline_stats(self):
+        pipeline = self.runner.pipeline
+
+        self.stdout.write("Pipeline (us):\n")
+        for stage in pipeline.stages:
+            stats = pipeline.stats(stage)
+            values = ["count {0}".format(stats.pop('count'))]
+            for key in ('p50', 'p90', 'p99', 'max'):
+                if stats[key] is not None:
+                    values.append("{0} {1:.1f}".format(key, stats[key] * 1e6))
+            self.stdout.write("\t%s : %s\n" % (stage, ", ".join(values)))
+
+        self.stdout.write("Plots:\n")
+        for name, stats in sorted(pipeline.plots.items()):
+            lag = "-" if stats['lag'] is None else "{0:.1f} ms".format(stats['lag'] * 1e3)
+            self.stdout.write("\t%s : depth %s, lag %s, skipped %s\n" % (name, stats['depth'], lag, stats['skipped']))
+
     def do_quit(self, arg):
         """
 Exits the terminal application.
@@ -398,16 +1188,37 @@ Exits the terminal application.
 Usage: quit
         """
         self.runner.terminate()
+        self.connections.close_all()
+        self.plots.stop()
+        for exporter in self.exports:
+            exporter.stop()
+        if self.server is not None:
+            self.server.stop()
+        self.transport.stop()
         self.do_disconnect("")
+        self.topics.close_store()
         self.stdout.write("Good Bye!\n")
         logger.info("Application quit.")
         exit()
 
 # Main function to start from script or from entry point
-def pytlm():
+def pytlm(argv=None):
+    """
+Command-line interface for data visualization and communication with
+embedded devices. Commands are read from the prompt, or from the standard
+input when it is redirected (ex : pytlm --headless < session.txt).
+
+Usage: pytlm [options]
+
+Options:
+-h, --help          Shows this help.
+--headless          Disables plots, the GUI stack (Qt, pyqtgraph) is never loaded.
+                    For machines without display.
+    """
+    arg = docopt(pytlm.__doc__, argv)
     init_logging()
     try:
-        Application().cmdloop()
+        Application(headless=arg['--headless']).cmdloop()
     except SystemExit:
         pass
     except KeyboardInterrupt:
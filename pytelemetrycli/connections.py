@@ -0,0 +1,79 @@
+from logging import getLogger
+from pytelemetry import Pytelemetry
+from pytelemetrycli.runner import Runner
+
+logger = getLogger('cli')
+
+class Connection:
+    """
+A named connection to a device : its transport, its own decoder and the
+`Runner` thread reading it.
+    """
+    def __init__(self, name, transport, topics, port, bauds, monitor=None):
+        self.name = name
+        self.port = port
+        self.bauds = bauds
+        self.transport = transport
+        self.telemetry = Pytelemetry(transport)
+        self.runner = Runner(transport, self.telemetry, monitor, topics, namespace=name)
+        self.telemetry.subscribe(None, self.runner.collect)
+
+class ConnectionPool:
+    """
+Connections to several devices captured together, by name.
+
+Each connection is read and decoded by its own runner thread, so slow or
+bursty devices do not delay each other. All runners add their samples to
+the shared `Topics`, holding its lock only while storing a decoded batch.
+Receive times come from the same monotonic clock for every device.
+Topics of a connection are prefixed with its name : `left.imu`.
+The plots of `monitor` are looked after by every runner, so they are
+released and flushed even without the main connection.
+    """
+    def __init__(self, topics, factory, monitor=None):
+        self.topics = topics
+        # Creates a new transport for each connection
+        self.factory = factory
+        self.monitor = monitor
+        self.connections = dict()
+
+    def open(self, name, port, bauds):
+        """
+Connects `name` to `port`, replacing the previous connection under that
+name. Raises IOError.
+        """
+        self.close(name)
+        connection = Connection(name, self.factory(), self.topics, port, bauds, self.monitor)
+        connection.runner.connect(port, bauds)
+        self.connections[name] = connection
+        logger.info("Connection {0} opened on {1} at {2} (bauds).".format(name, port, bauds))
+        return connection
+
+    def close(self, name):
+        # Returns False if there is no connection under `name`
+        connection = self.connections.pop(name, None)
+        if connection is None:
+            return False
+        connection.runner.terminate()
+        logger.info("Connection {0} closed.".format(name))
+        return True
+
+    def close_all(self):
+        for name in list(self.connections):
+            self.close(name)
+
+    def route(self, topic):
+        """
+Returns the connection of a prefixed topic and the topic on the device,
+or (None, topic) if the topic does not belong to a named connection.
+        """
+        name, sep, local = topic.partition('.')
+        if sep and name in self.connections:
+            return self.connections[name], local
+        return None, topic
+
+    def names(self):
+        return sorted(self.connections)
+
+    def __contains__(self, name):
+        return name in self.connections
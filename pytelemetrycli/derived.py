@@ -0,0 +1,170 @@
+import ast
+import numpy as np
+
+# Functions and constants available in expressions
+FUNCTIONS = dict((name, getattr(np, name)) for name in (
+    'abs', 'sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan', 'arcsin', 'arccos',
+    'arctan', 'arctan2', 'hypot', 'degrees', 'radians', 'floor', 'ceil', 'round',
+    'sign', 'minimum', 'maximum', 'clip', 'where'))
+CONSTANTS = {'pi': np.pi, 'e': np.e}
+
+OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+             ast.USub, ast.UAdd, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name,
+         ast.Attribute, ast.Load, ast.Constant) + OPERATORS
+
+def _dotted(node):
+    # Topic name of a Name or of a chain of attributes (left.imu), None otherwise
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        base = _dotted(node.value)
+        return None if base is None else base + '.' + node.attr
+    return None
+
+class _TopicNames(ast.NodeTransformer):
+    # Replaces the topic names, in order of appearance, with the variables _t0, _t1...
+    def __init__(self):
+        self.inputs = []
+
+    def _variable(self, node):
+        name = _dotted(node)
+        if name is None:
+            raise ValueError("Attributes are not allowed in expressions")
+        if name in FUNCTIONS or name in CONSTANTS:
+            return node
+        if name not in self.inputs:
+            self.inputs.append(name)
+        variable = ast.Name(id='_t{0}'.format(self.inputs.index(name)), ctx=ast.Load())
+        return ast.copy_location(variable, node)
+
+    def visit_Name(self, node):
+        return self._variable(node)
+
+    def visit_Attribute(self, node):
+        return self._variable(node)
+
+    def visit_Call(self, node):
+        node.args = [self.visit(a) for a in node.args]
+        return node
+
+def parse(expression):
+    """
+Parses an arithmetic expression over topics. Topics of named connections
+are written with their prefix (left.imu). Returns the compiled code and the
+names of the topics used, in order of appearance. The topic at position i
+is the variable `_t<i>` of the code. Raises ValueError.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError("Invalid expression '{0}'".format(expression))
+
+    for node in ast.walk(tree):
+        if not isinstance(node, NODES):
+            raise ValueError("'{0}' is not allowed in expressions".format(type(node).__name__))
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("Only numeric constants are allowed in expressions")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError("Unknown function in '{0}'. Use one of : {1}"
+                                 .format(expression, ", ".join(sorted(FUNCTIONS))))
+
+    names = _TopicNames()
+    tree = ast.fix_missing_locations(names.visit(tree))
+    return compile(tree, '<derive>', 'eval'), names.inputs
+
+def _array(views):
+    # Concatenates the views of a column as a float64 array
+    arrays = [np.asarray(v, dtype=np.float64) for v in views]
+    if not arrays:
+        return np.empty(0)
+    return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+class Derived:
+    """
+Virtual topic computed from other topics with a NumPy expression, like
+`voltage * current`.
+
+`update()` evaluates the expression over the samples received since the
+last update, as whole arrays. One sample is produced per sample of the
+driving topic (the first one of the expression, or `on`). The other topics
+are aligned on its receive times : each one takes its latest sample
+received at or before. Samples received at the same time (in the same
+batch) are paired by rank, so topics sent together at the same rate are
+combined sample by sample.
+    """
+    def __init__(self, name, expression, on=None):
+        self.name = name
+        self.expression = expression
+        self.code, self.inputs = parse(expression)
+        if not self.inputs:
+            raise ValueError("Expression '{0}' does not use any topic".format(expression))
+        if name in self.inputs:
+            raise ValueError("Topic '{0}' can not be derived from itself".format(name))
+        if on is not None and on not in self.inputs:
+            raise ValueError("Topic '{0}' is not used by the expression".format(on))
+        self.on = on if on is not None else self.inputs[0]
+        # Next position to read in each input, since the creation of the topic
+        self.positions = dict((i, 0) for i in self.inputs)
+        # Latest value of each input, None until received
+        self.last = dict((i, None) for i in self.inputs)
+
+    def _read(self, topic, name):
+        # Values and receive times of the samples received since the last update
+        start = max(self.positions[name], topic.raw.dropped, topic.times.dropped)
+        stop = min(topic.raw.received(), topic.times.received())
+        self.positions[name] = max(stop, start)
+        if stop <= start:
+            return np.empty(0), np.empty(0)
+        values = _array(topic.raw.views(start - topic.raw.dropped, stop - topic.raw.dropped))
+        times = _array(topic.times.views(start - topic.times.dropped, stop - topic.times.dropped))
+        return values, times
+
+    def update(self, topic_list):
+        """
+Returns the list of new derived samples. `topic_list` maps names to `Topic`s.
+Raises ValueError if an input holds non numeric samples.
+        """
+        new = dict((name, self._read(topic_list[name], name)) for name in self.inputs)
+
+        values, times = new[self.on]
+        if not len(times):
+            return []
+
+        # Rank and size of the group of driving samples received at the same time
+        first = np.searchsorted(times, times, side='left')
+        size = np.searchsorted(times, times, side='right') - first
+        rank = np.arange(len(times)) - first
+
+        columns = dict()
+        valid = np.ones(len(times), dtype=bool)
+        for name in self.inputs:
+            v, t = new[name]
+            if name == self.on:
+                columns[name] = v
+            else:
+                low = np.searchsorted(t, times, side='left')
+                count = np.searchsorted(t, times, side='right') - low
+                # Latest sample before, or the matching one of the same batch
+                index = np.where(count > 0, low + (rank * count) // size, low - 1)
+                before = index < 0
+                column = v[np.maximum(index, 0)] if len(v) else np.empty(len(times))
+                if self.last[name] is None:
+                    valid &= ~before
+                else:
+                    column = np.where(before, self.last[name], column)
+                columns[name] = column
+            if len(v):
+                self.last[name] = v[-1]
+
+        if not valid.all():
+            columns = dict((name, c[valid]) for name, c in columns.items())
+        namespace = dict(FUNCTIONS)
+        namespace.update(CONSTANTS)
+        for i, name in enumerate(self.inputs):
+            namespace['_t{0}'.format(i)] = columns[name]
+        with np.errstate(all='ignore'):
+            result = eval(self.code, {'__builtins__': {}}, namespace)
+        result = np.broadcast_to(np.asarray(result, dtype=np.float64), (int(valid.sum()),))
+        return result.tolist()
@@ -0,0 +1,239 @@
+from logging import getLogger
+from itertools import repeat
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+import numpy as np
+
+logger = getLogger('cli')
+
+# Seconds between two writes of live samples
+LIVE_PERIOD = 0.2
+
+class CsvWriter:
+    """
+Writes samples as rows of `topic,index,value`. The index is the position
+of the sample for linear samples, its index for indexed samples.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(('topic', 'index', 'value'))
+
+    def write(self, topic, indexes, values):
+        self.writer.writerows(zip(repeat(topic), indexes, values))
+
+    def close(self):
+        self.file.close()
+
+class NumericWriter:
+    # Base of the writers storing numeric values only, as float64
+    def write(self, topic, indexes, values):
+        try:
+            values = np.asarray(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            if topic not in self.skipped:
+                self.skipped.add(topic)
+                logger.warning("Export of non numeric topic {0} skipped.".format(topic))
+            return
+        self.write_arrays(topic, np.asarray(indexes, dtype=np.int64), values)
+
+class NpzWriter(NumericWriter):
+    """
+Writes a NumPy `.npz` archive holding, for each topic, the arrays
+`<topic>/values` and `<topic>/index`, which never collide whatever the topic
+names. Samples are appended to temporary files while exporting and packed
+in the archive on `close()`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        self.files = dict()
+        self.sizes = dict()
+        self.skipped = set()
+
+    def write_arrays(self, topic, indexes, values):
+        if topic not in self.files:
+            i = len(self.files)
+            self.files[topic] = (open(os.path.join(self.tmpdir, '{0}.index'.format(i)), 'w+b'),
+                                 open(os.path.join(self.tmpdir, '{0}.values'.format(i)), 'w+b'))
+            self.sizes[topic] = 0
+        index_file, values_file = self.files[topic]
+        index_file.write(indexes.tobytes())
+        values_file.write(values.tobytes())
+        self.sizes[topic] += len(values)
+
+    def close(self):
+        with zipfile.ZipFile(self.path, 'w', allowZip64=True) as archive:
+            for topic, files in self.files.items():
+                for name, f, dtype in ((topic + '/index', files[0], np.int64),
+                                       (topic + '/values', files[1], np.float64)):
+                    header = {'descr': np.dtype(dtype).str,
+                              'fortran_order': False,
+                              'shape': (self.sizes[topic],)}
+                    f.seek(0)
+                    with archive.open(name + '.npy', 'w', force_zip64=True) as entry:
+                        np.lib.format.write_array_header_2_0(entry, header)
+                        shutil.copyfileobj(f, entry)
+                    f.close()
+        shutil.rmtree(self.tmpdir)
+
+class ParquetWriter(NumericWriter):
+    """
+Writes a Parquet file with the columns `topic`, `index` and `value`, one
+row group per written block. Requires pyarrow.
+    """
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet export requires pyarrow. Install it with 'pip install pyarrow'.")
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([('topic', pyarrow.string()),
+                                      ('index', pyarrow.int64()),
+                                      ('value', pyarrow.float64())])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.skipped = set()
+
+    def write_arrays(self, topic, indexes, values):
+        pa = self.pa
+        table = pa.Table.from_arrays([pa.array([topic] * len(values), pa.string()),
+                                      pa.array(indexes), pa.array(values)],
+                                     schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+formats = {'csv': CsvWriter, 'npz': NpzWriter, 'parquet': ParquetWriter}
+
+def format_for(path):
+    # Export format from the file extension, None if unknown
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return extension if extension in formats else None
+
+class Exporter:
+    """
+Exports topics to a file from a background thread.
+
+The samples received so far are copied chunk by chunk from the topic
+storage. With `live`, samples received afterwards are exported as well,
+until `stop()` is called. Live samples are received through a 'block'
+subscription (see `Topics.subscribe`), their position avoids gaps and
+duplicates with the samples of the history.
+    """
+    def __init__(self, topics, names, path, live=False):
+        self.topics = topics
+        self.names = names
+        self.path = path
+        self.live = live
+        self.writer = formats[format_for(path)](path)
+        self.subscription = None
+        self.stopping = threading.Event()
+        self.written = 0
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        # Subscribe first, then note where the history ends
+        self.history = dict()
+        if self.live:
+            self.subscription = self.topics.subscribe(self.names, policy='block',
+                                                      name="export {0}".format(self.path))
+        for name in self.names:
+            topic = self.topics.topic_list[name]
+            self.history[name] = (topic.received(), self._indexes(topic))
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def _indexes(self, topic):
+        # Copy of the indexed samples, that the runner thread may update
+        while True:
+            try:
+                return list(topic.indexes.items())
+            except RuntimeError:
+                pass
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        try:
+            for name in self.names:
+                self._export_history(name)
+            while self.live and not self.stopping.is_set():
+                self._export_live(LIVE_PERIOD)
+            self._export_live(0)
+        except Exception as e:
+            self.error = e
+            logger.error("Export to {0} failed : {1}".format(self.path, e))
+        finally:
+            if self.subscription is not None:
+                self.subscription.close()
+            self.writer.close()
+            logger.info("Export to {0} done, {1} samples.".format(self.path, self.written))
+
+    def _export_history(self, name):
+        stop, indexes = self.history[name]
+        column = self.topics.topic_list[name].raw
+        position, chunks = column.snapshot()
+        # Samples before were dropped by the retention
+        start = column.dropped
+        for chunk in chunks:
+            if self.stopping.is_set() or position >= stop:
+                break
+            size = chunk.size
+            low = max(start - position, 0)
+            high = min(stop - position, size)
+            if high > low:
+                self.writer.write(name, range(position + low, position + high), chunk.view(low, high))
+                self.written += high - low
+            position += size
+
+        if indexes:
+            self.writer.write(name, [i for i, v in indexes], [v for i, v in indexes])
+            self.written += len(indexes)
+
+    def _export_live(self, timeout):
+        if self.subscription is None:
+            return
+        item = self.subscription.get(timeout)
+        items = []
+        while item is not None:
+            items.append(item)
+            item = self.subscription.get_nowait()
+
+        for topic, payloads, indexes, start in items:
+            if indexes is None:
+                indexes = [None] * len(payloads)
+            linear_x = []
+            linear_y = []
+            indexed_x = []
+            indexed_y = []
+            position = start
+            history_end = self.history[topic][0]
+            for payload, index in zip(payloads, indexes):
+                if index is not None:
+                    indexed_x.append(index)
+                    indexed_y.append(payload)
+                else:
+                    # Already exported with the history
+                    if position >= history_end:
+                        linear_x.append(position)
+                        linear_y.append(payload)
+                    position += 1
+            if linear_x:
+                self.writer.write(topic, linear_x, linear_y)
+            if indexed_x:
+                self.writer.write(topic, indexed_x, indexed_y)
+            self.written += len(linear_x) + len(indexed_x)
@@ -1,8 +1,41 @@
 from logging import getLogger, Formatter, FileHandler, StreamHandler
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import logging
 import datetime
 import os
+import queue
+import atexit
+
+class SampleQueueHandler(QueueHandler):
+    """
+QueueHandler that leaves record formatting to the listener thread.
+Sample records only carry immutable arguments, so they can be enqueued as is.
+    """
+    def prepare(self, record):
+        return record
+
+def init_sample_trace(path):
+    """
+Writes the records of the 'topics.samples' logger to `path`.
+Records are written by a background thread so that file I/O never
+blocks the thread receiving the samples.
+    """
+    handler = FileHandler(path)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(Formatter('%(asctime)s | %(message)s'))
+
+    records = queue.Queue(-1)
+    listener = QueueListener(records, handler)
+
+    samples = getLogger('topics.samples')
+    samples.setLevel(logging.DEBUG)
+    # Do not forward samples to the synchronous handlers of the 'topics' logger
+    samples.propagate = False
+    samples.addHandler(SampleQueueHandler(records))
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 def init_logging():
     # Disable default stderr handler
@@ -39,6 +72,8 @@ def init_logging():
     tx_handler.setLevel(logging.DEBUG)
     tx_handler.setFormatter(formatter)
 
+    init_sample_trace('logs/{0}/samples-{0}.log'.format(dateTag))
+
     app_handler = FileHandler('logs/{0}/cli-{0}.log'.format(dateTag))
     app_handler.setLevel(logging.DEBUG)
     app_handler.setFormatter(sharedformatter)
@@ -0,0 +1,157 @@
+from math import frexp
+import time
+
+# Durations are sorted in buckets 4 per power of two, from ~1ns to ~1min
+SUB_BUCKETS = 4
+MIN_EXP = -30
+MAX_EXP = 6
+BUCKETS = (MAX_EXP - MIN_EXP) * SUB_BUCKETS
+
+# Period (s) of the pipeline topics
+PUBLISH_PERIOD = 1.0
+PERCENTILES = (50, 90, 99)
+
+class Histogram:
+    """
+Histogram of durations (s) with logarithmic buckets. Percentiles are
+estimated with the upper bound of their bucket, within 20%.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if duration <= 0:
+            self.counts[0] += 1
+            return
+        mantissa, exponent = frexp(duration)
+        i = (exponent - MIN_EXP) * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+        self.counts[min(max(i, 0), BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def upper_bound(self, i):
+        exponent, sub = divmod(i, SUB_BUCKETS)
+        return 2.0 ** (exponent + MIN_EXP) * (0.5 + (sub + 1) / (2 * SUB_BUCKETS))
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper_bound(i), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+class TimedChannel:
+    """
+Data channel measuring the time spent handing samples over to the
+channel it wraps.
+    """
+    def __init__(self, channel, pipeline):
+        self.channel = channel
+        self.pipeline = pipeline
+
+    def put(self, item):
+        start = time.perf_counter()
+        self.channel.put(item)
+        self.pipeline.add_handoff(time.perf_counter() - start)
+
+    def close(self):
+        self.channel.close()
+
+class Pipeline:
+    """
+Timings of the stages samples go through, from the transport to the plots :
+decode (framing and protocol), ingest (storage in the topics) and handoff
+(sending to the plot channels). Each stage has a histogram over the
+current period, published as `cli` topics, and one since the start.
+Topic names start with `prefix`, for named connections.
+    """
+    stages = ('decode', 'ingest', 'handoff')
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.reset()
+
+    def reset(self):
+        self.window = dict((stage, Histogram()) for stage in self.stages)
+        self.totals = dict((stage, Histogram()) for stage in self.stages)
+        # Sum of the handoff durations, to remove them from the ingest time
+        self.handoff_time = 0.0
+        self.plots = dict()
+        self.last_publish = time.monotonic()
+
+    def add(self, stage, duration):
+        self.window[stage].add(duration)
+
+    def add_handoff(self, duration):
+        self.handoff_time += duration
+        self.window['handoff'].add(duration)
+
+    def timed(self, channel):
+        return TimedChannel(channel, self)
+
+    def stats(self, stage):
+        h = self.totals[stage]
+        s = dict(count=h.count + self.window[stage].count)
+        merged = Histogram()
+        merged.merge(h)
+        merged.merge(self.window[stage])
+        for p in PERCENTILES:
+            s['p{0}'.format(p)] = merged.percentile(p)
+        s['max'] = merged.max if merged.count else None
+        return s
+
+    def publish(self, topics, plots=(), now=None):
+        """
+Publishes the percentiles (in microseconds) of each stage over the last
+period, and the depth and lag of each plot, as `cli` topics.
+        """
+        now = time.monotonic() if now is None else now
+        if now - self.last_publish < PUBLISH_PERIOD:
+            return
+        self.last_publish = now
+
+        for stage in self.stages:
+            window = self.window[stage]
+            if window.count:
+                for p in PERCENTILES:
+                    name = "{0}{1}_p{2}_us".format(self.prefix, stage, p)
+                    topics.create(name, source="cli")
+                    topics.process(name, window.percentile(p) * 1e6)
+            self.totals[stage].merge(window)
+            window.reset()
+
+        self.plots = dict()
+        for entry in plots:
+            name = "plot{0}".format(entry.get('id', ''))
+            depth = entry['plot'].depth()
+            lag = entry.get('stats', {}).get('lag')
+            skipped = entry.get('stats', {}).get('skipped', 0)
+            self.plots[name] = dict(depth=depth, lag=lag, skipped=skipped)
+            if depth is not None:
+                topics.create(name + "_depth", source="cli")
+                topics.process(name + "_depth", depth)
+            if lag is not None:
+                topics.create(name + "_lag_ms", source="cli")
+                topics.process(name + "_lag_ms", lag * 1e3)
@@ -0,0 +1,205 @@
+from logging import getLogger
+import csv
+import heapq
+import threading
+import time
+
+logger = getLogger('cli')
+
+# Most frames sent in a single transport write
+MAX_BATCH = 256
+# Frames that can be sent at once under a rate limit, in seconds of the rate
+BURST = 0.05
+
+# Types of the publish files, as the flags of the pub command or in full
+FILE_TYPES = {'u8': 'uint8', 'u16': 'uint16', 'u32': 'uint32',
+              'i8': 'int8', 'i16': 'int16', 'i32': 'int32',
+              'f32': 'float32', 's': 'string'}
+
+def read_script(path):
+    """
+Reads a file of timed publishes, one `time,topic,type,value` row per
+publish, where time is in seconds from the start of the script and type
+is one of u8, u16, u32, i8, i16, i32, f32, s (or uint8, ..., string).
+Empty lines and lines starting with # are ignored, as well as a header row.
+Returns the list of (time, topic, value, type) sorted by time.
+Raises ValueError with the number of the invalid line.
+    """
+    rows = []
+    with open(path, newline='') as f:
+        for number, row in enumerate(csv.reader(f), 1):
+            if not row or not ''.join(row).strip() or row[0].lstrip().startswith('#'):
+                continue
+            if number == 1 and row[0].strip().lower() == 'time':
+                continue
+            try:
+                if len(row) < 4:
+                    raise ValueError("expected time,topic,type,value")
+                t = float(row[0])
+                topic = row[1].strip()
+                datatype = row[2].strip().lower()
+                datatype = FILE_TYPES.get(datatype, datatype)
+                # The value may contain commas for strings
+                value = ','.join(row[3:]).strip()
+                if datatype == 'float32':
+                    value = float(value)
+                elif datatype == 'string':
+                    pass
+                elif datatype in FILE_TYPES.values():
+                    value = int(value)
+                else:
+                    raise ValueError("unknown type '{0}'".format(row[2].strip()))
+            except ValueError as e:
+                raise ValueError("line {0} : {1}".format(number, e))
+            rows.append((t, topic, value, datatype))
+    rows.sort(key=lambda r: r[0])
+    return rows
+
+class Publisher:
+    """
+Sends published samples to the device from a writer thread, so a slow or
+blocked transport does not stall the caller.
+
+Samples are encoded (and checked) by the caller, with the pytelemetry
+instance of the connection, then queued by due time. The writer thread
+sends all the frames due at once in a single transport write, at most
+`rate` frames per second if a rate limit is set.
+
+Until `start()` is called, frames are written right away by the caller and
+transport errors are raised to it.
+    """
+    def __init__(self, transport, telemetry, rate=None):
+        self.transport = transport
+        self.telemetry = telemetry
+        self.rate = rate
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.frames = 0
+        self.writes = 0
+        self.errors = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Frames still queued are dropped
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def set_rate(self, rate):
+        # Frames per second, None removes the limit
+        with self.condition:
+            self.rate = rate
+            self.tokens = 0.0
+            self.last_refill = time.monotonic()
+            self.condition.notify()
+
+    def pending(self):
+        return len(self.queue)
+
+    def cancel(self):
+        # Drops the queued frames, returns their amount
+        with self.condition:
+            amount = len(self.queue)
+            self.queue = []
+        return amount
+
+    def encode(self, topic, value, datatype):
+        api = self.telemetry.api
+        if not datatype in api.types:
+            raise IndexError("Provided datatype {0} not found for ({1}, {2})".format(datatype, topic, value))
+        return bytes(api.delimiter.encode(api._encode_frame(topic, value, datatype)))
+
+    def publish(self, topic, value, datatype, due=None):
+        """
+Publishes `value` on `topic`, at the monotonic time `due` or as soon as
+possible.
+        """
+        if getattr(self.telemetry.api, 'delimiter', None) is None:
+            # Encoder writing to the transport itself
+            self.telemetry.publish(topic, value, datatype)
+            return
+
+        frame = self.encode(topic, value, datatype)
+        if not self.running:
+            self.transport.write(frame)
+            return
+        self._push([(due, frame)])
+
+    def schedule(self, rows, start=None):
+        """
+Queues the (time, topic, value, type) `rows`, time being in seconds from
+`start` (monotonic, now by default). All rows are encoded first, nothing
+is queued if one of them is invalid.
+        """
+        start = time.monotonic() if start is None else start
+        frames = [(start + t, self.encode(topic, value, datatype)) for t, topic, value, datatype in rows]
+        self._push(frames)
+
+    def _push(self, frames):
+        with self.condition:
+            now = time.monotonic()
+            for due, frame in frames:
+                self.sequence += 1
+                heapq.heappush(self.queue, (now if due is None else due, self.sequence, frame))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                frames = self._next_frames()
+                if frames is None:
+                    return
+            if not frames:
+                continue
+            try:
+                self.transport.write(b''.join(frames))
+                self.frames += len(frames)
+                self.writes += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error("Pub failed, {0} frames lost. Connection most likely terminated. exception : {1}"
+                             .format(len(frames), e))
+
+    def _next_frames(self):
+        # Waits for the frames due, returns None once stopped. Called with the condition held.
+        if not self.running:
+            return None
+        if not self.queue:
+            self.condition.wait()
+            return []
+
+        now = time.monotonic()
+        due = self.queue[0][0]
+        if due > now:
+            self.condition.wait(due - now)
+            return []
+
+        limit = MAX_BATCH
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, max(1.0, self.rate * BURST))
+            self.last_refill = now
+            if self.tokens < 1:
+                self.condition.wait((1 - self.tokens) / self.rate)
+                return []
+            limit = min(limit, int(self.tokens))
+
+        frames = []
+        while self.queue and self.queue[0][0] <= now and len(frames) < limit:
+            frames.append(heapq.heappop(self.queue)[2])
+        if self.rate:
+            self.tokens -= len(frames)
+        return frames
@@ -0,0 +1,236 @@
+from logging import getLogger
+import struct
+import threading
+import time
+
+logger = getLogger('cli')
+
+# File signature, followed by records made of a header and the received bytes
+MAGIC = b'PTLMREC1'
+# Record header : time since start of the recording (s), amount of bytes
+RECORD_HEADER = struct.Struct('<dI')
+
+# Bytes received within this delay (s) are stored in the same record
+RECORD_RESOLUTION = 0.001
+MAX_RECORD_SIZE = 65536
+
+def read_records(f):
+    """
+Yields (timestamp, data) for each record of an opened recording file.
+    """
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp, size = RECORD_HEADER.unpack(header)
+        data = f.read(size)
+        if len(data) < size:
+            logger.warning("Recording truncated, last record ignored.")
+            return
+        yield timestamp, data
+
+class Recorder:
+    """
+Writes received bytes to an append-only binary file, with the time at
+which they were received.
+    """
+    def __init__(self, path, resolution=RECORD_RESOLUTION):
+        self.path = path
+        self.resolution = resolution
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.pending = bytearray()
+        self.pending_time = 0.0
+        self.size = 0
+        # Writes happen on the runner thread, close on the main thread
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        if not data:
+            return
+        now = time.monotonic() - self.start
+        with self.lock:
+            if self.file is None:
+                return
+            if self.pending and (now - self.pending_time > self.resolution or
+                                 len(self.pending) >= MAX_RECORD_SIZE):
+                self._flush()
+            if not self.pending:
+                self.pending_time = now
+            self.pending.extend(data)
+
+    def _flush(self):
+        self.file.write(RECORD_HEADER.pack(self.pending_time, len(self.pending)))
+        self.file.write(self.pending)
+        self.size += len(self.pending)
+        self.pending = bytearray()
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            if self.pending:
+                self._flush()
+            self.file.close()
+            self.file = None
+
+class RecordingTransport:
+    """
+Transport forwarding all calls to the transport it wraps.
+While recording, received bytes are also written to a `Recorder`.
+The wrapped transport can be swapped with `attach()`, for instance to
+replay a recording through the same `Pytelemetry` instance.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.recorder = None
+
+    def attach(self, transport):
+        self.transport = transport
+
+    def record(self, path):
+        self.stop()
+        self.recorder = Recorder(path)
+
+    def stop(self):
+        # Returns the stopped recorder, if any
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
+            recorder.close()
+        return recorder
+
+    def connect(self, options):
+        return self.transport.connect(options)
+
+    def disconnect(self):
+        return self.transport.disconnect()
+
+    def read(self, maxbytes=1):
+        data = self.transport.read(maxbytes=maxbytes)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write(data)
+        return data
+
+    def readable(self):
+        return self.transport.readable()
+
+    def write(self, data):
+        return self.transport.write(data)
+
+    def writeable(self):
+        return self.transport.writeable()
+
+    def resetStats(self, averaging_window=100):
+        return self.transport.resetStats(averaging_window=averaging_window)
+
+    def stats(self):
+        return self.transport.stats()
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+class ReplayTransport:
+    """
+Transport reading bytes from a recording made with `Recorder`.
+`options['port']` passed to `connect` is the path of the recording.
+Bytes become readable at the pace they were recorded, multiplied by `speed`.
+A speed of 0 replays the recording as fast as possible.
+    """
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.file = None
+        self.records = iter(())
+        self.next = None
+        self.buffer = bytearray()
+        self.pos = 0
+        self.resetStats()
+
+    def resetStats(self, averaging_window=100):
+        self.measurements = {
+            "rx_bytes"  : 0,
+            "tx_bytes"  : 0,
+            "rx_chunks" : 0,
+            "tx_chunks"  : 0,
+            "rx_in_waiting" : 0,
+            "rx_in_waiting_avg" : 0,
+            "rx_in_waiting_max" : 0
+        }
+        self.averaging_window = averaging_window
+
+    def stats(self):
+        return self.measurements
+
+    def connect(self, options):
+        f = open(options['port'], 'rb')
+        if f.read(len(MAGIC)) != MAGIC:
+            f.close()
+            raise IOError("{0} is not a pytelemetry recording".format(options['port']))
+        self.file = f
+        self.records = read_records(f)
+        self.next = next(self.records, None)
+        self.buffer = bytearray()
+        self.pos = 0
+        self.start = time.monotonic()
+
+    def disconnect(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.records = iter(())
+        self.next = None
+
+    def finished(self):
+        return self.next is None and self.pos >= len(self.buffer)
+
+    def _fill(self):
+        # Move the records that are due from the file to the read buffer
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+        elapsed = (time.monotonic() - self.start) * self.speed
+        while self.next is not None:
+            if self.speed and self.next[0] > elapsed:
+                break
+            if not self.speed and len(self.buffer) >= MAX_RECORD_SIZE:
+                break
+            self.buffer.extend(self.next[1])
+            self.next = next(self.records, None)
+
+    def readable(self):
+        if self.pos >= len(self.buffer):
+            self._fill()
+
+        in_waiting = len(self.buffer) - self.pos
+        self.measurements['rx_in_waiting'] = in_waiting
+        self.measurements['rx_in_waiting_max'] = max(self.measurements['rx_in_waiting_max'], in_waiting)
+        self.measurements['rx_in_waiting_avg'] = (in_waiting + self.averaging_window * self.measurements['rx_in_waiting_avg']) / (self.averaging_window + 1)
+        return in_waiting
+
+    def wait_readable(self, timeout):
+        # Sleeps until the next record is due, at most `timeout` (s)
+        if self.pos < len(self.buffer) or not self.speed:
+            return
+        delay = timeout
+        if self.next is not None:
+            delay = self.next[0] / self.speed - (time.monotonic() - self.start)
+        time.sleep(min(max(delay, 0), timeout))
+
+    def read(self, maxbytes=1):
+        data = bytes(self.buffer[self.pos:self.pos + maxbytes])
+        self.pos += len(data)
+        self.measurements['rx_bytes'] += len(data)
+        self.measurements['rx_chunks'] += 1
+        return data
+
+    def write(self, data):
+        # Nothing to send data to, discard it
+        self.measurements['tx_bytes'] += len(data)
+        self.measurements['tx_chunks'] += 1
+        return 0
+
+    def writeable(self):
+        return 1
@@ -1,15 +1,49 @@
+from pytelemetrycli.instrumentation import Pipeline
+from pytelemetrycli.publisher import Publisher
+from logging import getLogger
+import select
 import threading
 import time
 
+# Longest time (s) the event loop blocks waiting for data, bounds the latency
+# of the stats and of the plots housekeeping
+WAIT_TIMEOUT = 0.05
+# Shortest sleep (s) of the back-off used when the transport can't be waited on
+MIN_SLEEP = 0.001
+# Bounds (bytes) of the adaptive read size
+MIN_READ = 64
+MAX_READ = 65536
+
+logger = getLogger('cli')
+
+CLI_TOPICS = ("baudspeed", "baudspeed_avg", "rx_in_waiting", "rx_in_waiting_max", "rx_in_waiting_avg")
+
 # Main class
 class Runner:
-    def __init__(self, transport, telemetry, plots, plotsLock, topics):
+    # event : block until the transport is readable, poll : busy loop
+    modes = ('event', 'poll')
+
+    def __init__(self, transport, telemetry, monitor, topics, mode='event', namespace=None):
 
         self.transport = transport
         self.telemetryWrapper = telemetry
-        self.plots = plots
-        self.plotsLock = plotsLock
+        # PlotMonitor of the opened plots, None if plots are not used
+        self.monitor = monitor
         self.topics = topics
+        self.mode = mode
+        # Topics of a named connection are prefixed with its name (left.imu)
+        self.prefix = namespace + '.' if namespace else ''
+
+        # Bytes read from the transport at once, follows the amount waiting
+        self.block = MIN_READ
+        self.sleep = MIN_SLEEP
+        # Timings of the decode, ingest and handoff stages
+        self.pipeline = Pipeline(self.prefix)
+        # Sends published samples from its own thread once connected
+        self.publisher = Publisher(transport, telemetry)
+
+        # Samples decoded during an update, grouped per topic until flushed
+        self.batches = dict()
 
         self.thread = None
         self.running = threading.Event()
@@ -21,12 +55,14 @@ class Runner:
         self.resetStats()
 
     def connect(self,port,bauds):
+        self.open(port,bauds)
+        self._start_thread()
+
+    def open(self,port,bauds):
         # Create monitoring topics
-        self.topics.create("baudspeed",source="cli")
-        self.topics.create("baudspeed_avg",source="cli")
-        self.topics.create("rx_in_waiting",source="cli")
-        self.topics.create("rx_in_waiting_max",source="cli")
-        self.topics.create("rx_in_waiting_avg",source="cli")
+        with self.topics.lock:
+            for name in CLI_TOPICS:
+                self.topics.create(self.prefix + name,source="cli")
 
         # Connection options
         options = dict()
@@ -36,18 +72,20 @@ class Runner:
         self.baudrate = bauds
         self.transport.connect(options)
 
-        self._start_thread()
-        
     def _start_thread(self):
         self.connected.set()
         self.thread = threading.Thread(target=self.run)
         self.thread.start()
+        self.publisher.start()
 
     def disconnect(self):
+        # Queued samples are dropped, publishing writes to the transport again
+        self.publisher.stop()
         self.connected.clear()
         self.transport.disconnect()
 
     def terminate(self):
+        self.publisher.stop()
         self.running.clear()
         if self.thread:
             self.thread.join()
@@ -70,31 +108,122 @@ class Runner:
         self.lasttime = time.time()
         self.lastamount = 0.0
         self.baudspeed_avg = 0.0
+        self.pipeline.reset()
 
-    def update(self):
-        # Update protocol decoding
-        self.telemetryWrapper.update()
+    def collect(self, topic, payload, options=None):
+        # Telemetry callback. Stores the decoded sample until the next flush.
+        batch = self.batches.get(topic)
+        if batch is None:
+            batch = self.batches[topic] = ([], [])
+        batch[0].append(payload)
+        batch[1].append(options['index'] if options else None)
 
-        # Protect the self.plots data structure from
-        # being modified from the main thread
-        self.plotsLock.acquire()
+    def flush(self, throttle=True):
+        # Send all samples decoded since the last flush to the topics, per topic
+        batches = self.batches
+        if not batches:
+            return
+        self.batches = dict()
 
-        # Poll each poll pipe to see if user closed them
-        plotToDelete = None
-        for p, i in zip(self.plots,range(len(self.plots))):
-            if p['ctrl'].poll():
-                if p['ctrl'].recv() == "closing":
-                    plotToDelete = i
-                    break
+        start = time.perf_counter()
+        handoff = self.pipeline.handoff_time
+        prefix = self.prefix
+        with self.topics.lock:
+            # Samples decoded together share their receive time, on the clock of all connections
+            now = time.monotonic()
+            for topic, (payloads, indexes) in batches.items():
+                try:
+                    self.topics.process_batch(prefix + topic, payloads, indexes, now)
+                except OSError as e:
+                    # Session files could not be written, keep receiving the other topics
+                    logger.error("Could not store {0} samples of '{1}' : {2}"
+                                 .format(len(payloads), prefix + topic, e))
+            if self.topics.derived:
+                self.topics.update_derived(now)
+        # Handoff to the plots is measured separately
+        handoff = self.pipeline.handoff_time - handoff
+        self.pipeline.add('ingest', time.perf_counter() - start - handoff)
+        # Exports and other lossless consumers are waited for without holding the lock
+        if throttle:
+            self.topics.throttle()
 
-        # Delete a plot if needed
-        if plotToDelete is not None:
-            self.plots[plotToDelete]['ctrl'].close()
-            topic = self.plots[plotToDelete]['topic']
-            self.topics.untransfer(topic)
-            self.plots.pop(plotToDelete)
+    def wait(self, timeout=WAIT_TIMEOUT):
+        """
+Blocks until the transport has bytes to read, or `timeout` (s) elapsed.
+Returns the amount of bytes waiting.
+        """
+        amount = self.transport.readable()
+        if amount:
+            self.sleep = MIN_SLEEP
+            return amount
 
-        self.plotsLock.release()
+        try:
+            waiter = getattr(self.transport, 'wait_readable', None)
+            fileno = self._fileno()
+            if waiter is not None:
+                waiter(timeout)
+            elif fileno is not None:
+                select.select([fileno], [], [], timeout)
+            else:
+                # Nothing to block on, back off up to the timeout
+                time.sleep(self.sleep)
+                self.sleep = min(self.sleep * 2, timeout)
+        except (OSError, ValueError):
+            return 0 # Transport closed meanwhile
+        return self.transport.readable()
+
+    def _fileno(self):
+        # File descriptor of the serial port, on platforms that have one
+        driver = getattr(self.transport, 'driver', None)
+        try:
+            return driver.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def decode(self):
+        """
+Reads and decodes the bytes waiting in the transport, in blocks whose size
+follows the backlog : it doubles while more bytes than a block are waiting,
+and halves when the backlog is less than a quarter of a block.
+        """
+        delimiter = getattr(self.telemetryWrapper.api, 'delimiter', None)
+        if delimiter is None:
+            # Decoder reading from the transport itself
+            self.telemetryWrapper.update()
+            return
+
+        amount = self.transport.readable()
+        if amount > self.block:
+            self.block = min(self.block * 2, MAX_READ)
+        elif amount < self.block // 4:
+            self.block = max(self.block // 2, MIN_READ)
+
+        if amount <= 0:
+            return
+
+        start = time.perf_counter()
+        while amount > 0:
+            data = self.transport.read(maxbytes=min(amount, self.block))
+            if not data:
+                break
+            delimiter.decode(data)
+            amount -= len(data)
+        self.pipeline.add('decode', time.perf_counter() - start)
+
+    def update(self):
+        # Update protocol decoding
+        self.decode()
+        self.flush()
+
+        if self.monitor is not None:
+            # The runners of all connections look after the plots, one at a time
+            with self.topics.lock:
+                # Stop transfers to the plots closed since the last update
+                if self.monitor.closed:
+                    self.monitor.release_closed(self.topics)
+                # Send the samples held back while the plots were behind
+                for entry in self.monitor.plots():
+                    entry['plot'].flush()
 
     def computeStats(self):
 
@@ -115,17 +244,26 @@ class Runner:
             self.baudspeed_avg = (self.baudspeed + n * self.baudspeed_avg) / (n + 1)
 
             # Send cli system data to the topics so that they can be plotted.
-            self.topics.process("baudspeed",self.baudspeed)
-            self.topics.process("baudspeed_avg",self.baudspeed_avg)
-            self.topics.process("rx_in_waiting",measures['rx_in_waiting'])
-            self.topics.process("rx_in_waiting_max",measures['rx_in_waiting_max'])
-            self.topics.process("rx_in_waiting_avg",measures['rx_in_waiting_avg'])
+            prefix = self.prefix
+            with self.topics.lock:
+                self.topics.process(prefix + "baudspeed",self.baudspeed)
+                self.topics.process(prefix + "baudspeed_avg",self.baudspeed_avg)
+                self.topics.process(prefix + "rx_in_waiting",measures['rx_in_waiting'])
+                self.topics.process(prefix + "rx_in_waiting_max",measures['rx_in_waiting_max'])
+                self.topics.process(prefix + "rx_in_waiting_avg",measures['rx_in_waiting_avg'])
+
+                # Plot topics are not prefixed, only the main runner publishes them
+                plots = self.monitor.plots() if self.monitor is not None and not self.prefix else ()
+                self.pipeline.publish(self.topics, plots)
 
 
     def run(self):
         while self.running.is_set():
             if self.connected.is_set():
+                if self.mode == 'event':
+                    self.wait()
                 self.update()
                 self.computeStats()
             else:
-                time.sleep(0.5)
+                self.connected.wait(0.5)
+
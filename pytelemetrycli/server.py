@@ -0,0 +1,438 @@
+from array import array
+from collections import deque
+from logging import getLogger
+from pytelemetrycli.topics import SUBSCRIPTION_SIZE
+import json
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+logger = getLogger('cli')
+
+DEFAULT_PORT = 7878
+
+# Kinds of frames
+REQUEST = 1 # client -> server, JSON object with an 'op'
+REPLY = 2   # server -> client, JSON object, 'error' if the request failed
+LIVE = 3    # server -> client, batch of samples received since subscribing
+HISTORY = 4 # server -> client, batch of stored samples, answer of a 'range' request
+
+# Overflow policies of remote clients, 'block' would let a client slow down ingest
+REMOTE_POLICIES = ('drop-oldest', 'latest')
+
+# Frame header : kind, payload length
+HEADER = struct.Struct('<BI')
+# Batch header, after the topic name : flags, amount of samples, position of the first linear sample
+BATCH = struct.Struct('<BIq')
+# Flags of batches
+INDEXED = 1 # int64 index of each sample follows the values, -1 for linear samples
+TIMED = 2   # float64 receive time of each sample (unix time) follows
+STRINGS = 4 # values are a JSON list instead of float64
+
+# Largest request accepted from a client, in bytes
+MAX_REQUEST = 1 << 16
+# Most samples in a single history batch
+HISTORY_CHUNK = 65536
+# Most bytes of live batches gathered in a single write to a client
+MAX_WRITE = 1 << 18
+# Seconds between two checks of the closing of a client
+POLL_PERIOD = 0.5
+
+def _pack(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+def _unpack(typecode, data, offset, count):
+    a = array(typecode)
+    a.frombytes(data[offset:offset + count * a.itemsize])
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tolist(), offset + count * a.itemsize
+
+def encode_frame(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+def encode_json(kind, obj):
+    return encode_frame(kind, json.dumps(obj).encode('utf-8'))
+
+def encode_batch(topic, values, indexes=None, start=0, times=None):
+    """
+Encodes a batch of samples of `topic` : the name, a `BATCH` header, the
+values as float64 (a JSON list if one of them is not a number), then
+the optional indexes (int64, -1 for linear samples) and receive times.
+    """
+    name = topic.encode('utf-8')
+    flags = 0
+    try:
+        data = _pack('d', values)
+    except (TypeError, OverflowError):
+        flags |= STRINGS
+        text = json.dumps(values).encode('utf-8')
+        data = struct.pack('<I', len(text)) + text
+    parts = [struct.pack('<H', len(name)), name, b'', data]
+    if indexes is not None:
+        flags |= INDEXED
+        parts.append(_pack('q', [-1 if i is None else i for i in indexes]))
+    if times is not None:
+        flags |= TIMED
+        parts.append(_pack('d', times))
+    parts[2] = BATCH.pack(flags, len(values), start)
+    return b''.join(parts)
+
+def decode_batch(payload):
+    """
+Returns the batch of `encode_batch` as a dict with the keys topic, values,
+indexes (None for linear samples), start and times (None if not sent).
+    """
+    size, = struct.unpack_from('<H', payload)
+    topic = payload[2:2 + size].decode('utf-8')
+    offset = 2 + size
+    flags, count, start = BATCH.unpack_from(payload, offset)
+    offset += BATCH.size
+    if flags & STRINGS:
+        length, = struct.unpack_from('<I', payload, offset)
+        values = json.loads(payload[offset + 4:offset + 4 + length].decode('utf-8'))
+        offset += 4 + length
+    else:
+        values, offset = _unpack('d', payload, offset, count)
+    indexes = times = None
+    if flags & INDEXED:
+        indexes, offset = _unpack('q', payload, offset, count)
+        indexes = [None if i < 0 else i for i in indexes]
+    if flags & TIMED:
+        times, offset = _unpack('d', payload, offset, count)
+    return dict(topic=topic, values=values, indexes=indexes, start=start, times=times)
+
+def read_frame(stream, limit=None):
+    # Returns (kind, payload) from a binary file-like object, None once closed
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    kind, length = HEADER.unpack(header)
+    if limit is not None and length > limit:
+        raise ValueError("Frame of {0} bytes is too large".format(length))
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return kind, payload
+
+class ClientSession:
+    """
+Connection of a remote client. Requests are answered from the thread of
+the session. Live samples are buffered by a `Subscription` of the topics,
+which is the send buffer of the client : when the client does not keep
+up, its oldest samples are dropped (or coalesced with the 'latest' policy)
+without slowing down ingest or the other clients. A sender thread gathers
+the buffered batches into large writes.
+    """
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.topics = server.topics
+        self.sock = sock
+        self.address = address
+        self.name = "client {0}:{1}".format(*address[:2])
+        self.stream = sock.makefile('rb')
+        self.lock = threading.Lock()
+        self.subscription = None
+        self.sender = None
+        self.sent = 0
+        self.closed = False
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+            self.sent += len(data)
+
+    def run(self):
+        try:
+            while True:
+                frame = read_frame(self.stream, MAX_REQUEST)
+                if frame is None:
+                    break
+                kind, payload = frame
+                if kind != REQUEST:
+                    self.send(encode_json(REPLY, {'error': "Unexpected frame kind {0}".format(kind)}))
+                    continue
+                self.handle(payload)
+        except (IOError, OSError, ValueError) as e:
+            if not self.closed:
+                logger.info("{0} : {1}".format(self.name, e))
+        finally:
+            self.close()
+
+    def handle(self, payload):
+        request = None
+        try:
+            request = json.loads(payload.decode('utf-8'))
+            op = request.get('op')
+            handler = getattr(self, 'op_' + str(op), None)
+            if handler is None:
+                raise ValueError("Unknown request '{0}'".format(op))
+            reply = handler(request)
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            reply = {'error': str(e)}
+        reply['op'] = request.get('op') if isinstance(request, dict) else None
+        self.send(encode_json(REPLY, reply))
+
+    def op_ls(self, request):
+        with self.topics.lock:
+            topics = [{'name': t.name, 'source': t.source, 'received': t.received()}
+                      for t in self.topics.topic_list.values()]
+        return {'topics': topics}
+
+    def op_range(self, request):
+        """
+Sends the stored linear samples of a topic received between `since` and
+`until` (unix times), or the `last` ones, as HISTORY batches with their
+receive time.
+        """
+        name = request['topic']
+        offset = time.time() - time.monotonic()
+        since = request.get('since')
+        until = request.get('until')
+        with self.topics.lock:
+            topic = self.topics.topic_list.get(name)
+            if topic is None:
+                raise ValueError("Topic '{0}' unknown".format(name))
+            start, stop = topic.positions(None if since is None else since - offset,
+                                          None if until is None else until - offset)
+        if request.get('last') is not None:
+            start = max(start, stop - int(request['last']))
+
+        count = 0
+        while start < stop:
+            with self.topics.lock:
+                # Samples may have been evicted meanwhile
+                start = max(start, topic.raw.dropped, topic.times.dropped)
+                end = min(start + HISTORY_CHUNK, stop)
+                values = topic.raw.tolist(start - topic.raw.dropped, end - topic.raw.dropped)
+                times = topic.times.tolist(start - topic.times.dropped, end - topic.times.dropped)
+            if not values:
+                break
+            self.send(encode_frame(HISTORY, encode_batch(name, values, None, start,
+                                                         [t + offset for t in times])))
+            count += len(values)
+            start = end
+        return {'topic': name, 'count': count}
+
+    def op_subscribe(self, request):
+        """
+Sends the samples received from now on under the topics matching the
+`topics` patterns as LIVE batches, replacing the previous subscription.
+        """
+        patterns = request['topics']
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        policy = request.get('policy', self.server.policy)
+        if not policy in REMOTE_POLICIES:
+            raise ValueError("Overflow policy '{0}' not allowed. Use one of : {1}."
+                             .format(policy, ", ".join(REMOTE_POLICIES)))
+        if self.subscription is not None:
+            self.subscription.close()
+        self.subscription = self.topics.subscribe(patterns, self.server.buffer, policy, name=self.name)
+        if self.sender is None:
+            self.sender = threading.Thread(target=self.forward, daemon=True)
+            self.sender.start()
+        return {'topics': patterns, 'policy': policy}
+
+    def op_unsubscribe(self, request):
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+        return {}
+
+    def forward(self):
+        # Sender thread, writes the live batches buffered by the subscription
+        try:
+            while not self.closed:
+                subscription = self.subscription
+                if subscription is None:
+                    time.sleep(POLL_PERIOD)
+                    continue
+                batch = subscription.get(POLL_PERIOD)
+                data = []
+                size = 0
+                while batch is not None:
+                    topic, payloads, indexes, start = batch
+                    data.append(encode_frame(LIVE, encode_batch(topic, payloads, indexes, start)))
+                    size += len(data[-1])
+                    batch = subscription.get_nowait() if size < MAX_WRITE else None
+                if data:
+                    self.send(b''.join(data))
+        except (IOError, OSError) as e:
+            if not self.closed:
+                logger.info("{0} : {1}".format(self.name, e))
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.subscription is not None:
+            self.subscription.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self.server.remove(self)
+        logger.info("{0} disconnected.".format(self.name))
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        session = ClientSession(self.server.stream, self.request, self.client_address)
+        if self.server.stream.add(session):
+            session.run()
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StreamServer:
+    """
+Serves the topics to remote clients over TCP, so several users and
+dashboards can watch the same device at once.
+
+Frames are a `HEADER` (kind, length) followed by the payload. Clients send
+REQUEST frames holding a JSON object :
+  - {"op": "ls"} lists the topics,
+  - {"op": "range", "topic": t, "since": s, "until": u, "last": n} sends
+    the stored samples of a topic (times are unix times),
+  - {"op": "subscribe", "topics": [patterns], "policy": p} sends the new
+    samples of the matching topics,
+  - {"op": "unsubscribe"}.
+Each request is answered with a REPLY frame, after its HISTORY batches.
+Samples are sent in binary batches (see `encode_batch`). Each client has
+its own send buffer of `buffer` samples, handled with the overflow
+`policy` of `Topics.subscribe`, one of `REMOTE_POLICIES`.
+    """
+    def __init__(self, topics, host='127.0.0.1', port=DEFAULT_PORT, buffer=SUBSCRIPTION_SIZE,
+                 policy='drop-oldest'):
+        self.topics = topics
+        self.host = host
+        self.port = port
+        self.buffer = buffer
+        self.policy = policy
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        # Raises IOError if the address is not available
+        self.server = _TCPServer((self.host, self.port), _Handler)
+        self.server.stream = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info("Serving topics on {0}:{1}".format(*self.address()))
+
+    def address(self):
+        return self.server.server_address[:2]
+
+    def add(self, session):
+        # Returns False once the server is stopped
+        with self.lock:
+            if self.server is None:
+                return False
+            self.sessions.append(session)
+        logger.info("{0} connected.".format(session.name))
+        return True
+
+    def remove(self, session):
+        with self.lock:
+            self.sessions = [s for s in self.sessions if s is not session]
+
+    def clients(self):
+        return list(self.sessions)
+
+    def stop(self):
+        # Disconnects all the clients, returns their amount
+        if self.server is None:
+            return 0
+        server = self.server
+        with self.lock:
+            self.server = None
+            sessions = self.sessions
+        server.shutdown()
+        server.server_close()
+        self.thread.join()
+        for session in sessions:
+            session.close()
+        logger.info("Server stopped.")
+        return len(sessions)
+
+class StreamClient:
+    """
+Client of a `StreamServer`. Requests return their REPLY, LIVE batches
+received meanwhile are kept for `receive()`.
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.stream = self.sock.makefile('rb')
+        self.live = deque()
+
+    def request(self, op, **arguments):
+        """
+Sends a request, returns its reply and the HISTORY batches sent before
+it. Raises ValueError if the server replied with an error, IOError if the
+connection is closed.
+        """
+        arguments['op'] = op
+        self.sock.sendall(encode_json(REQUEST, arguments))
+        history = []
+        while True:
+            frame = read_frame(self.stream)
+            if frame is None:
+                raise IOError("Connection closed by the server")
+            kind, payload = frame
+            if kind == REPLY:
+                reply = json.loads(payload.decode('utf-8'))
+                if 'error' in reply:
+                    raise ValueError(reply['error'])
+                return reply, history
+            if kind == HISTORY:
+                history.append(decode_batch(payload))
+            elif kind == LIVE:
+                self.live.append(decode_batch(payload))
+
+    def ls(self):
+        return self.request('ls')[0]['topics']
+
+    def range(self, topic, since=None, until=None, last=None):
+        # Returns the values and receive times (unix times) of the stored samples
+        reply, history = self.request('range', topic=topic, since=since, until=until, last=last)
+        values = []
+        times = []
+        for batch in history:
+            values.extend(batch['values'])
+            times.extend(batch['times'])
+        return values, times
+
+    def subscribe(self, *patterns, policy=None):
+        arguments = {'topics': list(patterns)}
+        if policy is not None:
+            arguments['policy'] = policy
+        return self.request('subscribe', **arguments)[0]
+
+    def unsubscribe(self):
+        return self.request('unsubscribe')[0]
+
+    def receive(self):
+        # Next LIVE batch, waits for it. None once the connection is closed.
+        if self.live:
+            return self.live.popleft()
+        while True:
+            frame = read_frame(self.stream)
+            if frame is None:
+                return None
+            kind, payload = frame
+            if kind == LIVE:
+                return decode_batch(payload)
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
@@ -0,0 +1,553 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+from itertools import islice
+import json
+import mmap
+import os
+import threading
+import time
+
+# Integer typecodes ordered by width, with the range each one can hold
+INT_TYPECODES = ('b', 'h', 'i', 'q')
+INT_RANGES = {'b': (-2**7, 2**7 - 1),
+              'h': (-2**15, 2**15 - 1),
+              'i': (-2**31, 2**31 - 1),
+              'q': (-2**63, 2**63 - 1)}
+
+FIRST_CHUNK_SIZE = 16
+MAX_CHUNK_SIZE = 4096
+# Size of memory-mapped chunks, a multiple of mmap.ALLOCATIONGRANULARITY
+MAPPED_CHUNK_BYTES = 1 << 20
+# Bounds of the amount of chunks mapped at once, each mapping holds a file descriptor
+MIN_MAPPED_CHUNKS = 16
+MAX_MAPPED_CHUNKS = 512
+
+def typecode_for(value, previous=None, float_typecode='d'):
+    """
+Returns the narrowest array typecode able to store `value`, never narrower
+than `previous`. None means the value must be stored as a python object.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+
+    if isinstance(value, float):
+        if previous in ('f', 'd'):
+            return previous
+        # Integers promoted to floats need the full precision of a double
+        return float_typecode if previous is None else 'd'
+
+    start = INT_TYPECODES.index(previous) if previous in INT_TYPECODES else 0
+    for code in INT_TYPECODES[start:]:
+        low, high = INT_RANGES[code]
+        if low <= value <= high:
+            return code
+    return None
+
+class Chunk:
+    """
+A fixed-capacity block of samples sharing the same typecode.
+The underlying array is allocated once and never resized, so memoryviews
+taken on it stay valid while new samples are appended.
+    """
+    __slots__ = ('typecode', 'capacity', 'size', 'data')
+
+    def __init__(self, typecode, capacity):
+        self.typecode = typecode
+        self.capacity = capacity
+        self.size = 0
+        if typecode is None:
+            self.data = []
+        else:
+            self.data = array(typecode, bytes(capacity * array(typecode).itemsize))
+
+    def full(self):
+        return self.size >= self.capacity
+
+    def append(self, value):
+        # Raises TypeError or OverflowError if value does not fit the typecode
+        if self.typecode is None:
+            self.data.append(value)
+        else:
+            self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        # All or nothing, raises TypeError or OverflowError if a value does not fit
+        end = self.size + len(values)
+        if self.typecode is None:
+            self.data.extend(values)
+        else:
+            self.data[self.size:end] = array(self.typecode, values)
+        self.size = end
+
+    def seal(self):
+        # Release the unused capacity of a chunk that won't receive more samples
+        try:
+            del self.data[self.size:]
+            self.capacity = self.size
+        except BufferError:
+            pass # Views are still exported on the data, keep it as is
+
+    def view(self, start=0, stop=None):
+        if stop is None:
+            stop = self.size
+        if self.typecode is None:
+            return self.data[start:stop]
+        return memoryview(self.data)[start:stop]
+
+    def nbytes(self):
+        if self.typecode is None:
+            return 8 * len(self.data)
+        return self.capacity * self.data.itemsize
+
+    def release(self):
+        pass
+
+class MappedChunk(Chunk):
+    """
+A chunk whose samples live in a memory-mapped region of a column file.
+The region is mapped on access, and unmapped by the `MapCache` of the
+column file when other chunks were used more recently.
+    """
+    __slots__ = ('offset', 'columnfile', 'mapping', '_data')
+
+    def __init__(self, typecode, capacity, columnfile, offset, size=0):
+        self.typecode = typecode
+        self.capacity = capacity
+        self.size = size
+        self.offset = offset
+        self.columnfile = columnfile
+        self.mapping = None
+        self._data = None
+
+    @property
+    def data(self):
+        return self.columnfile.maps.get(self)
+
+    def append(self, value):
+        try:
+            Chunk.append(self, value)
+        except ValueError as e:
+            # memoryview reports out of range values with a ValueError
+            raise OverflowError(e)
+
+    def seal(self):
+        pass # The region stays allocated in the file
+
+    def nbytes(self):
+        # Mapped samples are backed by the file, not by process memory
+        return 0
+
+    def map(self):
+        with open(self.columnfile.path, 'r+b') as f:
+            self.mapping = mmap.mmap(f.fileno(), MAPPED_CHUNK_BYTES, offset=self.offset)
+        self._data = memoryview(self.mapping).cast(self.typecode)
+
+    def unmap(self):
+        # Views still exported keep the mapping alive until they are collected
+        self.mapping = None
+        self._data = None
+
+    def release(self):
+        self.columnfile.maps.discard(self)
+        if self._data is None:
+            return
+        self._data.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass # Views are still exported, the mapping is closed once collected
+        self.unmap()
+
+class MapCache:
+    """
+Mapped chunks of the column files of a session, least recently used first.
+At most `limit` chunks are mapped, the oldest ones are unmapped and mapped
+again when accessed. Each mapping holds a file descriptor, the limit keeps
+long captures of many topics below the limit of open files.
+    """
+    def __init__(self, limit=MAX_MAPPED_CHUNKS):
+        self.limit = limit
+        self.chunks = OrderedDict()
+        # Chunks are read from other threads than the one appending samples
+        self.lock = threading.Lock()
+
+    def get(self, chunk):
+        # Returns the data of `chunk`, mapped if needed
+        with self.lock:
+            if chunk._data is None:
+                chunk.map()
+                self.chunks[chunk] = None
+                while len(self.chunks) > self.limit:
+                    self.chunks.popitem(last=False)[0].unmap()
+            elif chunk in self.chunks:
+                self.chunks.move_to_end(chunk)
+            return chunk._data
+
+    def discard(self, chunk):
+        with self.lock:
+            self.chunks.pop(chunk, None)
+
+    def discard_file(self, columnfile):
+        # Unmaps the chunks of a closed column file
+        with self.lock:
+            for chunk in [c for c in self.chunks if c.columnfile is columnfile]:
+                del self.chunks[chunk]
+                chunk.unmap()
+
+def map_limit():
+    """
+Amount of chunks a session can map at once, following the limit of open
+files of the process.
+    """
+    try:
+        import resource
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, ValueError, OSError):
+        return MAX_MAPPED_CHUNKS
+    if soft == resource.RLIM_INFINITY:
+        return MAX_MAPPED_CHUNKS
+    # Leave room for the ports, sockets, plots and exports
+    return max(MIN_MAPPED_CHUNKS, min(MAX_MAPPED_CHUNKS, soft // 2))
+
+class ColumnFile:
+    """
+A file holding the memory-mapped chunks of a column, allocated one after
+the other. The file is only opened to allocate and map chunks, `maps`
+bounds the amount of chunks mapped at once.
+    """
+    def __init__(self, path, maps=None):
+        self.path = path
+        self.maps = MapCache() if maps is None else maps
+        if not os.path.exists(path):
+            open(path, 'w+b').close()
+        self.size = os.path.getsize(path)
+
+    def new_chunk(self, typecode):
+        offset = self.size
+        with open(self.path, 'r+b') as f:
+            f.truncate(offset + MAPPED_CHUNK_BYTES)
+        self.size += MAPPED_CHUNK_BYTES
+        return self.map_chunk(typecode, offset)
+
+    def map_chunk(self, typecode, offset, size=0):
+        # Mapped on first access
+        capacity = MAPPED_CHUNK_BYTES // array(typecode).itemsize
+        return MappedChunk(typecode, capacity, self, offset, size)
+
+    def close(self):
+        self.maps.discard_file(self)
+
+class Column:
+    """
+A growable column of samples stored as a list of typed chunks.
+Numeric samples are packed in `array` chunks whose typecode follows the
+received values (int8 up to int64, float32 or float64). Strings and other
+objects are kept in plain list chunks.
+
+Samples can be dropped from the front of the column with `drop()`. Fully
+dropped chunks are released, so a column trimmed on every append behaves
+as a ring buffer whose memory stays bounded.
+
+With a `ColumnFile`, numeric chunks are memory-mapped regions of that file
+instead of in-memory arrays.
+    """
+    def __init__(self, float_typecode='d', columnfile=None):
+        self.float_typecode = float_typecode
+        self.columnfile = columnfile
+        self.chunks = deque()
+        self.length = 0   # Amount of retained samples
+        self.dropped = 0  # Amount of samples dropped from the front
+        self.head = 0     # Amount of dropped samples still in the first chunk
+
+    def __len__(self):
+        return self.length
+
+    def _new_chunk(self, value, previous):
+        typecode = typecode_for(value, previous, self.float_typecode)
+        if self.columnfile is not None and typecode is not None:
+            chunk = self.columnfile.new_chunk(typecode)
+            self.chunks.append(chunk)
+            return chunk
+
+        if self.chunks:
+            capacity = min(max(self.chunks[-1].capacity * 2, FIRST_CHUNK_SIZE),
+                           MAX_CHUNK_SIZE)
+        else:
+            capacity = FIRST_CHUNK_SIZE
+        chunk = Chunk(typecode, capacity)
+        self.chunks.append(chunk)
+        return chunk
+
+    def append(self, value):
+        if self.chunks:
+            chunk = self.chunks[-1]
+            if chunk.full():
+                chunk = self._new_chunk(value, chunk.typecode)
+        else:
+            chunk = self._new_chunk(value, None)
+
+        try:
+            chunk.append(value)
+        except (TypeError, OverflowError):
+            # Value does not fit the current chunk, open a wider one
+            chunk.seal()
+            chunk = self._new_chunk(value, chunk.typecode)
+            chunk.append(value)
+
+        self.length += 1
+
+    def extend(self, values):
+        """
+Appends a batch of samples. Runs of samples fitting the current chunk are
+copied in a single operation, the rest goes through `append()`.
+        """
+        i = 0
+        n = len(values)
+        while i < n:
+            if not self.chunks or self.chunks[-1].full():
+                self.append(values[i])
+                i += 1
+                continue
+
+            chunk = self.chunks[-1]
+            end = min(n, i + chunk.capacity - chunk.size)
+            try:
+                chunk.extend(values[i:end])
+            except (TypeError, OverflowError):
+                # At least one value does not fit, fallback to one by one
+                for value in values[i:end]:
+                    self.append(value)
+            else:
+                self.length += end - i
+            i = end
+
+    def views(self, start=0, stop=None):
+        """
+Yields zero-copy views (memoryviews, or lists for object chunks) covering
+samples [start, stop) of the column.
+        """
+        if stop is None or stop > self.length:
+            stop = self.length
+        if start < 0:
+            start = max(self.length + start, 0)
+
+        offset = -self.head
+        for chunk in self.chunks:
+            if offset >= stop:
+                break
+            end = offset + chunk.size
+            if end > start:
+                yield chunk.view(max(start - offset, 0), min(stop, end) - offset)
+            offset = end
+
+    def received(self):
+        return self.dropped + self.length
+
+    def first(self):
+        # Oldest retained sample, None if the column is empty
+        if not self.length:
+            return None
+        return self.chunks[0].data[self.head]
+
+    def bisect(self, value, right=False):
+        """
+Returns the position, counted since the creation of the column, of the
+first retained sample greater than or equal to `value` (greater than, with
+`right`), for a column of increasing values. Binary search on the last
+sample of each chunk, then within the chunk.
+        """
+        chunks = self.chunks
+        lo, hi = 0, len(chunks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            chunk = chunks[mid]
+            last = chunk.data[chunk.size - 1] if chunk.size else None
+            if last is None or last < value or (right and last == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(chunks):
+            return self.received()
+
+        position = self.dropped - self.head + sum(c.size for c in islice(chunks, lo))
+        search = bisect_right if right else bisect_left
+        position += search(chunks[lo].view(), value)
+        return max(position, self.dropped)
+
+    def snapshot(self):
+        """
+Returns (start, chunks) : a copy of the list of chunks, and the position
+of the first sample of the first chunk, counted since the creation of the
+column. Can be called while another thread appends samples, the
+positions below `dropped` must be ignored.
+        """
+        while True:
+            dropped, head = self.dropped, self.head
+            chunks = list(self.chunks)
+            if dropped == self.dropped and head == self.head:
+                return dropped - head, chunks
+
+    def drop(self, amount):
+        """
+Drops the `amount` oldest samples of the column. Returns the amount of
+bytes released.
+        """
+        amount = min(amount, self.length)
+        if amount <= 0:
+            return 0
+        self.length -= amount
+        self.dropped += amount
+        self.head += amount
+
+        released = 0
+        while self.chunks and self.head >= self.chunks[0].size:
+            chunk = self.chunks.popleft()
+            self.head -= chunk.size
+            released += chunk.nbytes()
+            chunk.release()
+        return released
+
+    def drop_chunk(self):
+        # Drops all samples still held by the oldest chunk
+        if not self.chunks:
+            return 0
+        return self.drop(self.chunks[0].size - self.head)
+
+    def tolist(self, start=0, stop=None):
+        values = []
+        for view in self.views(start, stop):
+            values.extend(view)
+        return values
+
+    def nbytes(self):
+        return sum(chunk.nbytes() for chunk in self.chunks)
+
+class SessionStore:
+    """
+Stores the samples of a session in a directory, one memory-mapped column
+file per topic and one for their receive times. `session.json` indexes the
+topics and the offsets of their chunks, it is rewritten by `sync()`.
+Strings and indexed samples are saved in the index itself.
+
+Receive times are monotonic times, whose origin changes on reboot. The
+index saves the unix time of that origin, restored times are moved to the
+monotonic clock of the process opening the session.
+    """
+    MANIFEST = 'session.json'
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.columnfiles = dict()
+        self.manifest = {'version': self.VERSION, 'topics': dict()}
+        # Unix time of the origin of time.monotonic()
+        self.epoch = time.time() - time.monotonic()
+        # Chunks mapped at once by all the column files
+        self.maps = MapCache(map_limit())
+
+        manifest = os.path.join(path, self.MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get('version') != self.VERSION:
+                raise IOError("Unsupported session version {0}".format(self.manifest.get('version')))
+
+    def topics(self):
+        # Descriptions of the topics saved in the session
+        return self.manifest['topics']
+
+    def _columnfile(self, name, filename=None):
+        if name not in self.columnfiles:
+            if filename is None:
+                used = set(t['file'] for t in self.topics().values())
+                used.update(t['times']['file'] for t in self.topics().values() if 'times' in t)
+                used.update(os.path.basename(c.path) for c in self.columnfiles.values())
+                i = len(used)
+                while '{0:05d}.col'.format(i) in used:
+                    i += 1
+                filename = '{0:05d}.col'.format(i)
+            self.columnfiles[name] = ColumnFile(os.path.join(self.path, filename), self.maps)
+        return self.columnfiles[name]
+
+    def column(self, name, float_typecode='d', part=None):
+        """
+Returns the column of topic `name`, restored from the session if it was saved.
+`part` selects another column of the topic, like its 'times'.
+        """
+        saved = self.topics().get(name)
+        if saved is not None and part is not None:
+            saved = saved.get(part)
+        key = name if part is None else (name, part)
+        if saved is None:
+            return Column(float_typecode, self._columnfile(key))
+
+        columnfile = self._columnfile(key, saved['file'])
+        column = Column(saved['float_typecode'], columnfile)
+        for chunk in saved['chunks']:
+            if chunk['typecode'] is None:
+                restored = Chunk(None, len(chunk['values']))
+                restored.data = list(chunk['values'])
+                restored.size = len(restored.data)
+            else:
+                restored = columnfile.map_chunk(chunk['typecode'], chunk['offset'], chunk['size'])
+            column.chunks.append(restored)
+            column.length += restored.size
+        column.dropped = saved['dropped']
+        column.head = saved['head']
+        column.length -= column.head
+
+        # Below a millisecond, the difference is only the rounding of the epochs
+        shift = saved.get('epoch', self.epoch) - self.epoch
+        if abs(shift) > 1e-3:
+            for chunk in column.chunks:
+                if chunk.typecode is not None:
+                    chunk.data[:chunk.size] = array(chunk.typecode, [t + shift for t in chunk.data[:chunk.size]])
+        return column
+
+    def _save(self, column):
+        chunks = []
+        for chunk in list(column.chunks):
+            if chunk.typecode is None:
+                chunks.append({'typecode': None, 'values': chunk.data[:chunk.size]})
+            else:
+                mapping = chunk.mapping
+                if mapping is not None:
+                    # Unmapped chunks were written back by the system
+                    mapping.flush()
+                chunks.append({'typecode': chunk.typecode, 'offset': chunk.offset, 'size': chunk.size})
+        return {
+            'file': os.path.basename(column.columnfile.path),
+            'float_typecode': column.float_typecode,
+            'dropped': column.dropped,
+            'head': column.head,
+            'chunks': chunks
+        }
+
+    def sync(self, topics):
+        """
+Writes the index of the session, for a list of `Topic`s.
+        """
+        saved = dict()
+        for topic in topics:
+            if topic.raw.columnfile is None:
+                continue
+            saved[topic.name] = self._save(topic.raw)
+            saved[topic.name]['source'] = topic.source
+            saved[topic.name]['indexes'] = list(topic.indexes.items())
+            saved[topic.name]['times'] = self._save(topic.times)
+            saved[topic.name]['times']['epoch'] = self.epoch
+
+        self.manifest = {'version': self.VERSION, 'topics': saved}
+        # Write then rename, a crash never leaves a partial index
+        manifest = os.path.join(self.path, self.MANIFEST)
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(manifest + '.tmp', manifest)
+
+    def close(self):
+        for columnfile in self.columnfiles.values():
+            columnfile.close()
+        self.columnfiles = dict()
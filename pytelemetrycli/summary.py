@@ -0,0 +1,191 @@
+from itertools import chain
+from math import asin, sin, pi, sqrt
+
+# Compression of the quantile sketch, more centroids give better estimates
+COMPRESSION = 100
+# Amount of values buffered before being merged in the centroids
+BUFFER_SIZE = 5 * COMPRESSION
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+class TDigest:
+    """
+Mergeable sketch of a distribution, for approximate quantiles (merging
+t-digest). Values are buffered, then merged into at most about
+`compression` centroids, smaller towards both tails so that extreme
+quantiles are the most accurate.
+    """
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.compress()
+
+    def extend(self, values):
+        self.buffer.extend(values)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.compress()
+
+    def merge(self, other):
+        other.compress()
+        if not other.count:
+            return
+        self.compress(zip(other.means, other.weights))
+        # Centroid means are within the extremes of the other digest
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _k(self, q):
+        # Scale function, centroids span at most one unit of k
+        return self.compression / (2 * pi) * asin(2 * q - 1)
+
+    def _q(self, k):
+        if k >= self.compression / 4:
+            return 1.0
+        return (sin(k * 2 * pi / self.compression) + 1) / 2
+
+    def compress(self, centroids=()):
+        """
+Merges the buffered values, and the (mean, weight) `centroids` of another
+digest, into the centroids.
+        """
+        added = [(value, 1) for value in self.buffer]
+        added.extend(centroids)
+        self.buffer = []
+        if not added:
+            return
+
+        self.count += sum(w for m, w in added)
+        low = min(m for m, w in added)
+        high = max(m for m, w in added)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+        items = sorted(chain(zip(self.means, self.weights), added))
+        total = float(self.count)
+        means = []
+        weights = []
+        merged = 0
+        mean, weight = items[0]
+        limit = total * self._q(self._k(0.0) + 1)
+        for m, w in items[1:]:
+            if merged + weight + w <= limit:
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                merged += weight
+                limit = total * self._q(self._k(merged / total) + 1)
+                mean, weight = m, w
+        means.append(mean)
+        weights.append(weight)
+        self.means = means
+        self.weights = weights
+
+    def quantile(self, q):
+        # Estimated value at quantile `q` (0 to 1), None if empty
+        self.compress()
+        if not self.count:
+            return None
+        means, weights = self.means, self.weights
+        if len(means) == 1:
+            return means[0]
+
+        # Linear interpolation between the centers of the centroids
+        target = q * self.count
+        if target < weights[0] / 2:
+            return self.min + (means[0] - self.min) * target / (weights[0] / 2)
+        if target > self.count - weights[-1] / 2:
+            return self.max - (self.max - means[-1]) * (self.count - target) / (weights[-1] / 2)
+
+        center = weights[0] / 2
+        for i in range(len(means) - 1):
+            step = (weights[i] + weights[i + 1]) / 2
+            if target <= center + step:
+                return means[i] + (means[i + 1] - means[i]) * (target - center) / step
+            center += step
+        return self.max
+
+class Summary:
+    """
+Running aggregates of the numeric samples of a topic : count, min, max,
+mean and variance (Welford's algorithm, Chan's formula for batches), and
+quantiles from a `TDigest`. They cover all the samples received, even the
+ones evicted from the topic storage. Non numeric samples are ignored.
+    """
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.digest = TDigest()
+
+    def add(self, value):
+        if not isinstance(value, (int, float)):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.digest.add(value)
+
+    def extend(self, values):
+        if not values:
+            return
+        try:
+            mean = sum(values) / len(values)
+        except TypeError:
+            # Batch mixing strings and numbers
+            values = [v for v in values if isinstance(v, (int, float))]
+            if not values:
+                return
+            mean = sum(values) / len(values)
+        n = len(values)
+        self._combine(n, mean, sum((v - mean) ** 2 for v in values), min(values), max(values))
+        self.digest.extend(values)
+
+    def merge(self, other):
+        if other.count:
+            self._combine(other.count, other.mean, other.m2, other.min, other.max)
+            self.digest.merge(other.digest)
+
+    def _combine(self, n, mean, m2, low, high):
+        count = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / count
+        self.m2 += m2 + delta * delta * self.count * n / count
+        self.count = count
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def variance(self):
+        # Sample variance, None below 2 samples
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    def std(self):
+        variance = self.variance()
+        return None if variance is None else sqrt(variance)
+
+    def quantile(self, q):
+        return self.digest.quantile(q)
+
+    def stats(self):
+        s = dict(count=self.count, min=self.min, max=self.max,
+                 mean=self.mean if self.count else None, std=self.std())
+        for q in QUANTILES:
+            s['p{0:g}'.format(q * 100)] = self.quantile(q)
+        return s
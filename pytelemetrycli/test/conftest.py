@@ -0,0 +1,4 @@
+import sys
+
+# The asyncio engine requires python 3.7+
+collect_ignore = ["test_aio.py"] if sys.version_info < (3, 7) else []
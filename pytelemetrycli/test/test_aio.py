@@ -0,0 +1,94 @@
+from pytelemetrycli.aio import Engine, AsyncTopics, Sample
+import asyncio
+import time
+
+class LoopbackTransport:
+    # Published frames are received back
+    def __init__(self):
+        self.buffer = bytearray()
+    def connect(self, options):
+        pass
+    def disconnect(self):
+        pass
+    def read(self, maxbytes=1):
+        data = bytes(self.buffer[:maxbytes])
+        del self.buffer[:maxbytes]
+        return data
+    def readable(self):
+        return len(self.buffer)
+    def write(self, data):
+        self.buffer.extend(data)
+    def writeable(self):
+        return True
+    def resetStats(self, averaging_window=100):
+        pass
+    def stats(self):
+        return {"rx_bytes": 0, "rx_in_waiting": 0, "rx_in_waiting_max": 0, "rx_in_waiting_avg": 0}
+
+def test_stream():
+    async def main():
+        engine = Engine(LoopbackTransport())
+        await engine.connect("loopback")
+        stream = engine.topics.stream("imu")
+
+        for i in range(3):
+            engine.publish("imu", i, "int32")
+        engine.publish("other", 12, "int32")
+        engine.publish("imu:4", 5.0, "float32")
+
+        received = []
+        async for sample in stream:
+            received.append(sample)
+            if len(received) == 4:
+                stream.close()
+
+        await engine.disconnect()
+        assert engine.topics.count("other") == 1
+        return received
+
+    received = asyncio.run(main())
+    assert received == [Sample(0, None), Sample(1, None), Sample(2, None), Sample(5.0, 4)]
+
+def test_stream_drops_oldest():
+    async def main():
+        topics = AsyncTopics()
+        stream = topics.stream("foo", maxsize=2)
+        topics.process_batch("foo", [1, 2, 3])
+        stream.close()
+        # No more samples once closed
+        topics.process("foo", 4)
+        return [s.value async for s in stream], stream.dropped
+
+    assert asyncio.run(main()) == ([2, 3], 1)
+
+def test_block_subscription():
+    async def main():
+        engine = Engine(LoopbackTransport())
+        await engine.connect("loopback")
+        subscription = engine.topics.subscribe("imu", maxsize=1, policy='block', timeout=5)
+        engine.topics.process("imu", 0)
+
+        # The subscription is full, the engine waits for its consumer without blocking the loop
+        engine.publish("imu", 1, "int32")
+        for i in range(100):
+            if engine.throttling is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert engine.throttling is not None
+        start = time.monotonic()
+        await asyncio.sleep(0.01)
+        assert time.monotonic() - start < 0.5
+
+        # Reading goes on once it caught up
+        while subscription.get_nowait() is not None:
+            pass
+        engine.publish("imu", 2, "int32")
+        for i in range(100):
+            if engine.topics.count("imu") == 3:
+                break
+            await asyncio.sleep(0.01)
+        subscription.get_nowait()
+        await engine.disconnect()
+        return engine.topics.samples("imu", amount=0), subscription.dropped
+
+    assert asyncio.run(main()) == ([0, 1, 2], 0)
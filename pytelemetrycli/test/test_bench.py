@@ -0,0 +1,60 @@
+from pytelemetrycli.bench import generate, run, compare, main, SyntheticTransport, bench_startup
+import json
+
+def test_generate_is_reproducible():
+    frames = generate(10, 2, 'int32', indexed=True, seed=1)
+    assert len(frames) == 10
+    assert frames == generate(10, 2, 'int32', indexed=True, seed=1)
+
+def test_synthetic_transport_rate():
+    tr = SyntheticTransport([b'ab', b'cde'], rate=1)
+    tr.connect({})
+    assert tr.readable() == 0
+    tr.start -= 1.5
+    # Whole frames only
+    assert tr.readable() == 2
+    tr.start -= 1
+    assert tr.readable() == 5
+
+def test_run():
+    results = run(samples=500, topics=3, datatype='float32', indexed=True, startup_runs=0)
+    assert results['benchmarks']['ingest']['samples'] == 500
+    assert results['benchmarks']['plot']['samples'] == 500
+    for bench in results['benchmarks'].values():
+        assert bench['samples_per_s'] > 0
+        assert 'us_per_sample' in bench
+        assert 'allocated_blocks' in bench
+
+    # Strings are not plotted
+    results = run(samples=10, topics=1, datatype='string', startup_runs=0)
+    assert list(results['benchmarks']) == ['ingest']
+
+def test_compare(tmpdir):
+    baseline = {'benchmarks': {'ingest': {'samples_per_s': 1000.0}}}
+    results = {'benchmarks': {'ingest': {'samples_per_s': 850.0},
+                              'plot': {'samples_per_s': 10.0}}}
+    assert compare(results, baseline, tolerance=0.2) == []
+    assert compare(results, baseline, tolerance=0.1) == [('ingest', 850.0, 1000.0)]
+
+    baseline = {'benchmarks': {}, 'startup': {'import_s': 0.1}}
+    results = {'benchmarks': {}, 'startup': {'import_s': 0.2}}
+    assert compare(results, baseline) == [('startup', 0.2, 0.1)]
+
+    output = str(tmpdir.join("results.json"))
+    assert main(['-n', '100', '--startup-runs', '1', '-o', output]) == 0
+    with open(output) as f:
+        saved = json.load(f)
+    assert saved['parameters']['samples'] == 100
+
+    # Much faster baseline, fails
+    saved['benchmarks']['ingest']['samples_per_s'] *= 1000
+    with open(output, 'w') as f:
+        json.dump(saved, f)
+    assert main(['-n', '100', '--startup-runs', '0', '--compare', output]) == 1
+
+def test_startup():
+    results = bench_startup(runs=1)
+    assert results['import_s'] > 0
+    assert results['process_s'] >= results['import_s']
+    # The plotting stack is loaded with the first plot only
+    assert results['gui_modules'] == []
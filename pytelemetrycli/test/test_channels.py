@@ -0,0 +1,76 @@
+from pytelemetrycli.ui.channels import SharedRing, PlotFeed
+from types import SimpleNamespace
+import pickle
+import queue
+
+def read_all(ring):
+    xs = []
+    ys = []
+    for x, y in ring.read():
+        xs.extend(x.tolist())
+        ys.extend(y.tolist())
+    return xs, ys
+
+def test_shared_ring():
+    ring = SharedRing(capacity=8)
+    # Consumers attach to the same memory, as in the plot process
+    consumer = pickle.loads(pickle.dumps(ring))
+
+    assert consumer.empty()
+
+    ring.put([0, 1.5])
+    ring.put([[1, 2, 3], [2.5, 3.5, 4.5]])
+    assert consumer.qsize() == 4
+    assert read_all(consumer) == ([0, 1, 2, 3], [1.5, 2.5, 3.5, 4.5])
+    assert consumer.empty()
+
+    # Wrap around the end of the ring
+    ring.put([[4, 5, 6, 7, 8, 9], [0, 0, 0, 0, 0, 9]])
+    segments = consumer.read()
+    assert len(segments) == 2
+    assert [x.tolist() for x, y in segments] == [[4, 5, 6, 7], [8, 9]]
+
+    # Samples overwritten before being read are lost
+    ring.put([list(range(10, 30)), list(range(20))])
+    assert read_all(consumer)[0] == list(range(22, 30))
+    assert consumer.lost == 12
+
+    # Strings cannot be plotted
+    ring.put([[30], ["foo"]])
+    assert ring.rejected == 1
+    assert consumer.empty()
+
+    consumer.close()
+    ring.close()
+    # A runner may still put samples while the curve is removed
+    ring.put([31, 1])
+
+def test_plot_feed():
+    q = queue.Queue()
+    consumed = SimpleNamespace(value=0)
+    feed = PlotFeed(q, consumed, capacity=4, policy='drop')
+
+    feed.put(0, [[0, 1, 2], [0.0, 1.0, 2.0]])
+    feed.put(1, [10, 1.0])
+    # No room left, samples are held back per topic
+    feed.put(0, [3, 3.0])
+    feed.put(0, [[4, 5, 6, 7, 8], [4.0, 5.0, 6.0, 7.0, 8.0]])
+    feed.put(1, [11, 2.0])
+    assert q.qsize() == 2
+    assert feed.depth() == 4 + 5
+    assert feed.skipped == 2
+
+    # The plot receives the first items, held back samples are sent as batches
+    consumed.value = 4
+    feed.flush()
+    assert [q.get_nowait() for i in range(2)][1][1] == [10, 1.0]
+    key, item, stamp, skipped = q.get_nowait()
+    assert (key, item, skipped) == (0, [[5, 6, 7, 8], [5.0, 6.0, 7.0, 8.0]], 2)
+    assert feed.in_flight() == 4
+
+    # Backlogs of removed topics are dropped
+    feed.discard(1)
+    assert feed.depth() == 4
+    consumed.value = 8
+    feed.flush()
+    assert q.empty()
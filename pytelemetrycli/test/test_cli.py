@@ -1,10 +1,13 @@
 from pytelemetrycli.cli import Application
+from pytelemetrycli.recording import ReplayTransport
 import pytest
 from unittest.mock import MagicMock
+from serial import SerialException
 import cmd
 import io
 import sys
 import queue
+import time
 
 class TransportMock:
     def __init__(self):
@@ -204,6 +207,191 @@ def test_print():
 
     clear(outstream)
 
+    tlm.onecmd("print foo --since 1m")
+    assert outstream.getvalue() == "2\n3\n4\n"
+
+    clear(outstream)
+
+    tlm.onecmd("print foo -s 0ms")
+    assert outstream.getvalue() == ""
+
+    clear(outstream)
+
+    tlm.onecmd("print foo -s soon")
+    assert outstream.getvalue() == "Could not parse --since = 'soon'. Use a duration like 10s, 500ms or 2m.\n"
+
+    clear(outstream)
+
+def test_summary():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    for value in (2, 4, 6):
+        tlm.onecmd("pub --i32 foo {0}".format(value))
+    tlm.onecmd("pub --s hello world")
+    tlm.runner.update()
+    clear(outstream)
+
+    tlm.onecmd("summary fo*")
+    assert outstream.getvalue().startswith("foo : count 3, min 2, max 6, mean 4, std 2, p50 ")
+
+    clear(outstream)
+
+    tlm.onecmd("summary hello qux")
+    assert outstream.getvalue() == ("Topic 'qux' unknown. Type 'ls' to list all available topics.\n"
+                                    "hello : no numeric samples\n")
+
+    clear(outstream)
+
+def test_derive():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    tlm.onecmd("pub --i32 voltage 3")
+    tlm.onecmd("pub --i32 current 2")
+    tlm.runner.update()
+    clear(outstream)
+
+    tlm.onecmd("derive power = voltage * current")
+    assert outstream.getvalue() == "Derived topic 'power' = voltage * current\n"
+
+    clear(outstream)
+
+    tlm.onecmd("derive neg = -voltage")
+    tlm.onecmd("derive bad = voltage * nothing")
+    assert outstream.getvalue() == ("Derived topic 'neg' = -voltage\n"
+                                    "Topic 'nothing' unknown.\n")
+
+    clear(outstream)
+
+    tlm.onecmd("pub --i32 voltage 5")
+    tlm.runner.update()
+    clear(outstream)
+
+    tlm.onecmd("print power -l 2")
+    assert outstream.getvalue() == "6.0\n10.0\n"
+
+    clear(outstream)
+
+    tlm.onecmd("ls")
+    assert outstream.getvalue() == "current\nneg\npower\nvoltage\n"
+
+    clear(outstream)
+
+    tlm.onecmd("derive --remove neg")
+    tlm.onecmd("derive")
+    assert outstream.getvalue() == "power = voltage * current\n"
+
+    clear(outstream)
+
+def test_named_connections():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    def factory():
+        t = TransportMock()
+        t.authorizeConnect(True)
+        return t
+    tlm.connections.factory = factory
+
+    tlm.onecmd("serial com3 --as left -b 115200")
+    assert outstream.getvalue() == "Connected left to com3 at 115200 (bauds).\n"
+
+    clear(outstream)
+
+    tlm.onecmd("serial com4 --as 4th")
+    assert outstream.getvalue() == "Invalid connection name '4th', use letters, digits and _.\n"
+
+    clear(outstream)
+
+    tlm.onecmd("connections")
+    assert outstream.getvalue().startswith("left : com3 at 115200 (bauds), ")
+
+    clear(outstream)
+
+    # Published to the device of the connection, received back under its prefix
+    tlm.onecmd("pub --i32 left.foo 7")
+    assert outstream.getvalue() == "Published on topic 'left.foo' : 7 [int32]\n"
+    left = tlm.connections.connections['left']
+    for i in range(500):
+        if tlm.topics.exists("left.foo"):
+            break
+        time.sleep(0.01)
+    assert tlm.topics.samples("left.foo") == [7]
+    assert not tlm.topics.exists("foo")
+
+    clear(outstream)
+
+    # A new session would clear the topics of the named connections
+    tr.authorizeConnect(True)
+    tlm.onecmd("serial com1")
+    assert outstream.getvalue() == ("Named connections are open : left. Disconnect them first, "
+                                    "or connect another device with --as.\n")
+    assert tlm.topics.samples("left.foo") == [7]
+    assert "left.baudspeed" in tlm.topics.ls(source="cli")
+
+    clear(outstream)
+
+    tlm.onecmd("disconnect left")
+    assert outstream.getvalue() == "Disconnected left.\n"
+    assert not left.runner.thread.is_alive()
+
+    clear(outstream)
+
+    tlm.onecmd("disconnect left")
+    assert outstream.getvalue() == "No connection named left.\n"
+
+    clear(outstream)
+
+def test_pub_file(tmpdir):
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+    path = str(tmpdir.join("script.csv"))
+    with open(path, "w") as f:
+        f.write("0,foo,i32,1\n0.01,foo,i32,2\n0.02,bar,f32,0.5\n")
+
+    tlm.onecmd("pub --file {0}".format(path))
+    assert outstream.getvalue() == ("Pub failed because you are not connected to any device. "
+                                    "Connect first using `serial` command.\n")
+
+    clear(outstream)
+
+    tlm.onecmd("pub --file {0}".format(tmpdir.join("missing.csv")))
+    assert outstream.getvalue().startswith("Could not read ")
+
+    clear(outstream)
+
+    tlm.runner.publisher.start()
+    try:
+        tlm.onecmd("pub --rate 1000")
+        assert outstream.getvalue() == "Publish rate limit : 1000 samples/s\n"
+
+        clear(outstream)
+
+        tlm.onecmd("pub --file {0}".format(path))
+        assert outstream.getvalue() == "Publishing 3 samples from {0} over 0.02 s.\n".format(path)
+        for i in range(500):
+            if not tlm.runner.publisher.pending():
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        tlm.runner.update()
+        assert tlm.topics.samples("foo", amount=0) == [1, 2]
+        assert tlm.topics.samples("bar") == [0.5]
+
+        clear(outstream)
+
+        tlm.onecmd("pub --cancel")
+        assert outstream.getvalue() == "Cancelled 0 queued samples.\n"
+    finally:
+        tlm.runner.publisher.stop()
+
+    clear(outstream)
+
 def test_count():
     tr = TransportMock()
     outstream = io.StringIO()
@@ -254,6 +442,43 @@ def test_count():
 
     clear(outstream)
 
+class ClosingTransportMock(TransportMock):
+    # Writing to a closed serial port fails
+    def __init__(self):
+        TransportMock.__init__(self)
+        self.opened = False
+    def connect(self, options):
+        TransportMock.connect(self, options)
+        self.opened = True
+    def disconnect(self):
+        self.opened = False
+    def write(self, data):
+        if not self.opened:
+            raise SerialException("Attempting to use a port that is not open")
+        TransportMock.write(self, data)
+
+def test_pub_disconnected():
+    tr = ClosingTransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+    tr.authorizeConnect(True)
+
+    tlm.onecmd("serial com123")
+    try:
+        clear(outstream)
+        tlm.onecmd("pub --i32 foo 2")
+        assert outstream.getvalue() == "Published on topic 'foo' : 2 [int32]\n"
+
+        tlm.onecmd("disconnect")
+        assert not tlm.runner.publisher.running
+
+        clear(outstream)
+        tlm.onecmd("pub --i32 foo 3")
+        assert outstream.getvalue() == ("Pub failed because you are not connected to any device. "
+                                        "Connect first using `serial` command.")
+    finally:
+        tlm.runner.terminate()
+
 def test_disconnect_quit():
     tr = TransportMock()
     outstream = io.StringIO()
@@ -455,3 +680,209 @@ def test_stats():
     assert "\trx_corrupted_crc : 0\n" in outstream.getvalue()
     assert "\trx_corrupted_eol : 0\n" in outstream.getvalue()
     assert "\trx_corrupted_topic : 0\n" in outstream.getvalue()
+
+def test_retention():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    tlm.onecmd("retention")
+    assert outstream.getvalue().startswith("capacity : unlimited\nmax age : unlimited\nmemory : unlimited")
+
+    clear(outstream)
+
+    tlm.onecmd("retention --capacity 2")
+    assert outstream.getvalue().startswith("capacity : 2 samples\n")
+
+    clear(outstream)
+
+    for i in range(3):
+        tlm.onecmd("pub --i32 foo {0}".format(i))
+        tlm.runner.update()
+
+    clear(outstream)
+
+    tlm.onecmd("count")
+    assert outstream.getvalue() == "foo : 3 (2 retained)\n"
+
+    clear(outstream)
+
+    tlm.onecmd("print foo -a")
+    assert outstream.getvalue() == "(showing 2 retained samples out of 3 received)\n1\n2\n"
+
+    clear(outstream)
+
+    tlm.onecmd("retention foo")
+    assert outstream.getvalue() == "capacity : 2 samples\nmax age : unlimited\nretained : 2 / 3 samples\n"
+
+    clear(outstream)
+
+    tlm.onecmd("retention --policy newest")
+    assert outstream.getvalue() == "Unknown eviction policy 'newest'. Use one of : oldest, lru.\n"
+
+def test_record_replay(tmpdir):
+    path = str(tmpdir.join("session.rec"))
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    tlm.onecmd("record " + path)
+    assert outstream.getvalue() == "Recording received data to {0}.\n".format(path)
+
+    for i in range(3):
+        tlm.onecmd("pub --i32 foo {0}".format(i))
+        tlm.runner.update()
+    tlm.onecmd("pub --s bar hello")
+    tlm.runner.update()
+
+    clear(outstream)
+
+    tlm.onecmd("record --stop")
+    assert outstream.getvalue() == "Stopped recording to {0} (57 bytes).\n".format(path)
+
+    # Decode the recording again, as fast as possible
+    outstream = io.StringIO()
+    tlm = Application(transport=ReplayTransport(speed=0),stdout=outstream)
+    tlm.runner._start_thread = MagicMock() # Mock _start_thread to avoid starting thread
+    tlm.runner.connect(path, 9600)
+
+    while not tlm.transport.finished():
+        tlm.runner.update()
+
+    assert tlm.topics.samples("foo", amount=0) == [0, 1, 2]
+    assert tlm.topics.samples("bar", amount=0) == ["hello"]
+    assert tlm.telemetry.stats()['protocol']['rx_decoded_frames'] == 4
+
+def test_session_open(tmpdir):
+    path = str(tmpdir.join("session"))
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+    tlm.runner._start_thread = MagicMock() # Mock _start_thread to avoid starting thread
+    tr.authorizeConnect(True)
+
+    tlm.onecmd("serial com123 --session " + path)
+    tlm.onecmd("pub --i32 foo 2")
+    tlm.runner.update()
+    tlm.onecmd("disconnect")
+    tlm.onecmd("serial com123")
+
+    clear(outstream)
+
+    tlm.onecmd("count")
+    assert outstream.getvalue() == ""
+
+    tlm.onecmd("open " + path)
+    assert outstream.getvalue() == "Opened session {0} : 1 topics.\n".format(path)
+
+    clear(outstream)
+
+    tlm.onecmd("print foo")
+    assert outstream.getvalue() == "2\n"
+
+    clear(outstream)
+
+    tlm.onecmd("open " + str(tmpdir.join("nothing")))
+    assert outstream.getvalue() == "No session found in {0}.\n".format(tmpdir.join("nothing"))
+
+def test_stats_pipeline():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    tlm.onecmd("pub --i32 foo 2")
+    tlm.runner.update()
+    tlm.onecmd("stats --pipeline")
+
+    assert "Pipeline (us):\n" in outstream.getvalue()
+    assert "\tdecode : count 1, p50 " in outstream.getvalue()
+    assert "\tingest : count 1, p50 " in outstream.getvalue()
+    assert "\thandoff : count 0\n" in outstream.getvalue()
+    assert "Plots:\n" in outstream.getvalue()
+
+def test_export(tmpdir):
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    tlm.onecmd("pub --i32 foo 2")
+    tlm.runner.update()
+
+    clear(outstream)
+    path = str(tmpdir.join("foo.txt"))
+    tlm.onecmd("export {0} foo".format(path))
+    assert outstream.getvalue() == "Unknown export format for {0}. Use one of : .csv, .npz, .parquet.\n".format(path)
+
+    clear(outstream)
+    path = str(tmpdir.join("foo.csv"))
+    tlm.onecmd("export {0} foo --live".format(path))
+    assert outstream.getvalue() == "Exporting 1 topic(s) to {0} until export --stop.\n".format(path)
+
+    tlm.onecmd("pub --i32 foo 3")
+    tlm.runner.update()
+
+    clear(outstream)
+    tlm.onecmd("export --stop")
+    assert outstream.getvalue() == "Export to {0} stopped, 2 samples written.\n".format(path)
+
+    with open(path) as f:
+        assert f.read().splitlines() == ['topic,index,value', 'foo,0,2', 'foo,1,3']
+
+    # Only live exports are stopped
+    path = str(tmpdir.join("bar.csv"))
+    tlm.onecmd("export {0} foo".format(path))
+    clear(outstream)
+    tlm.onecmd("export --stop")
+    assert outstream.getvalue() == "No live export.\n"
+    tlm.exports[0].thread.join()
+    with open(path) as f:
+        assert f.read().splitlines() == ['topic,index,value', 'foo,0,2', 'foo,1,3']
+
+def test_headless():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream,headless=True)
+
+    tlm.onecmd("pub --i32 foo 2")
+    tlm.runner.update()
+    clear(outstream)
+
+    tlm.onecmd("plot foo")
+    assert outstream.getvalue() == "Plots are not available in headless mode.\n"
+    assert tlm.plots.plots() == []
+
+def test_plot_duplicates():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    tlm.onecmd("pub --i32 foo 2")
+    tlm.runner.update()
+    clear(outstream)
+
+    tlm.onecmd("plot foo foo")
+    assert outstream.getvalue() == "Topic 'foo' given more than once.\n"
+    assert tlm.plots.plots() == []
+    assert not tlm.topics.intransfer("foo")
+
+def test_serve():
+    tr = TransportMock()
+    outstream = io.StringIO()
+    tlm = Application(transport=tr,stdout=outstream)
+
+    tlm.onecmd("serve --port 0 --buffer 16")
+    assert outstream.getvalue().startswith("Serving topics on 127.0.0.1:")
+    assert tlm.server.buffer == 16
+    clear(outstream)
+
+    tlm.onecmd("serve")
+    assert outstream.getvalue().endswith(", 0 clients.\n")
+    clear(outstream)
+
+    tlm.onecmd("serve --stop")
+    assert outstream.getvalue() == "Server stopped, 0 clients disconnected.\n"
+    assert tlm.server is None
+    clear(outstream)
+
+    tlm.onecmd("serve --buffer 0")
+    assert outstream.getvalue() == "Invalid serve option : buffer must be positive\n"
@@ -0,0 +1,114 @@
+from pytelemetrycli.connections import ConnectionPool
+from pytelemetrycli.topics import Topics
+from collections import deque
+import threading
+import time
+
+class LoopbackTransport:
+    # Reads back the written bytes
+    def __init__(self):
+        self.data = bytearray()
+        self.lock = threading.Lock()
+        self.rx_bytes = 0
+        self.connected = False
+    def connect(self, options):
+        if options['port'] == 'missing':
+            raise IOError("No such port")
+        self.connected = True
+    def disconnect(self):
+        self.connected = False
+    def read(self, maxbytes=1):
+        with self.lock:
+            data = bytes(self.data[:maxbytes])
+            del self.data[:maxbytes]
+        self.rx_bytes += len(data)
+        return data
+    def readable(self):
+        return len(self.data)
+    def write(self, data):
+        with self.lock:
+            self.data.extend(data)
+    def writeable(self):
+        return True
+    def resetStats(self, averaging_window=1):
+        pass
+    def stats(self):
+        return {"rx_bytes": self.rx_bytes, "tx_bytes": 0, "rx_chunks": 0, "tx_chunks": 0,
+                "rx_in_waiting": 0, "rx_in_waiting_avg": 0, "rx_in_waiting_max": 0}
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_pool():
+    topics = Topics()
+    pool = ConnectionPool(topics, LoopbackTransport)
+    left = pool.open("left", "COM1", 115200)
+    right = pool.open("right", "COM2", 115200)
+    assert pool.names() == ["left", "right"]
+    assert "left" in pool
+    assert left.transport is not right.transport
+
+    try:
+        for i in range(100):
+            left.telemetry.publish("imu", i, "int32")
+            right.telemetry.publish("imu", -i, "int32")
+
+        # Each device has its own namespace in the shared topics
+        assert wait_for(lambda: topics.count("left.imu") == 100 and topics.count("right.imu") == 100)
+        assert topics.samples("left.imu", amount=3) == [97, 98, 99]
+        assert topics.samples("right.imu", amount=3) == [-97, -98, -99]
+        assert "left.baudspeed" in topics.ls(source="cli")
+
+        assert pool.route("left.led") == (left, "led")
+        assert pool.route("other.led") == (None, "other.led")
+        assert pool.route("led") == (None, "led")
+    finally:
+        pool.close_all()
+
+    assert pool.names() == []
+    assert not left.runner.thread.is_alive()
+    assert not left.transport.connected
+    assert not pool.close("left")
+
+def test_pool_connect_fail():
+    pool = ConnectionPool(Topics(), LoopbackTransport)
+    try:
+        pool.open("left", "missing", 9600)
+    except IOError:
+        pass
+    else:
+        assert False
+    assert pool.names() == []
+
+class PlotStub:
+    def __init__(self):
+        self.flushed = 0
+
+    def flush(self):
+        self.flushed += 1
+
+class MonitorStub:
+    def __init__(self):
+        self.plot = PlotStub()
+        self.closed = deque([{'plot': PlotStub()}])
+        self.released = []
+
+    def plots(self):
+        return [{'plot': self.plot}]
+
+    def release_closed(self, topics):
+        while self.closed:
+            self.released.append(self.closed.popleft())
+
+def test_pool_plots():
+    # Without the main connection, the runners of the pool look after the plots
+    monitor = MonitorStub()
+    pool = ConnectionPool(Topics(), LoopbackTransport, monitor)
+    pool.open("left", "COM1", 115200)
+    try:
+        assert wait_for(lambda: monitor.released and monitor.plot.flushed)
+    finally:
+        pool.close_all()
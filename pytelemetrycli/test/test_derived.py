@@ -0,0 +1,80 @@
+from pytelemetrycli.derived import Derived, parse
+from pytelemetrycli.topics import Topics
+import math
+import pytest
+
+def test_parse():
+    code, inputs = parse("sqrt(ax**2 + ay**2) * scale - ax")
+    assert inputs == ["ax", "ay", "scale"]
+
+    # Topics of named connections
+    code, inputs = parse("left.imu - right.imu + left.imu")
+    assert inputs == ["left.imu", "right.imu"]
+
+    for expression in ("__import__('os')", "(a + b).real", "a[0]", "open(a)", "a +", "'a' + b", "lambda: a"):
+        with pytest.raises(ValueError):
+            parse(expression)
+
+    with pytest.raises(ValueError):
+        Derived("c", "2 * pi")
+    with pytest.raises(ValueError):
+        Derived("a", "a + 1")
+
+def test_derive_batches():
+    topics = Topics()
+    topics.process_batch("voltage", [1, 2, 3], now=10.0)
+    topics.process_batch("current", [4, 5, 6], now=10.0)
+    topics.derive("power", "voltage * current")
+    assert topics.ls(source='derived') == ["power"]
+
+    # Samples received together are paired, history is computed
+    topics.update_derived()
+    assert topics.samples("power", amount=0) == [4, 10, 18]
+
+    # Other topics hold their latest sample
+    topics.process_batch("voltage", [10, 20], now=11.0)
+    topics.update_derived()
+    assert topics.samples("power", amount=0) == [4, 10, 18, 60, 120]
+
+    # Samples of the other topic are aligned on the receive times
+    topics.process_batch("current", [1], now=12.0)
+    topics.process_batch("voltage", [2], now=13.0)
+    topics.process_batch("current", [100], now=14.0)
+    topics.update_derived()
+    assert topics.samples("power", amount=2) == [120, 2]
+
+    with pytest.raises(ValueError):
+        topics.derive("power", "voltage")
+    with pytest.raises(ValueError):
+        topics.derive("other", "voltage * unknown")
+
+def test_derive_rates():
+    topics = Topics()
+    topics.create("fast")
+    topics.create("slow")
+    topics.derive("mix", "fast + slow")
+    topics.derive("scaled", "abs(mix) * 10", on="mix")
+
+    # Nothing is computed before all topics received a sample
+    topics.process_batch("fast", [1, 2], now=1.0)
+    topics.update_derived()
+    assert topics.samples("mix", amount=0) == []
+
+    # Two samples of fast for one of slow in the same batch
+    topics.process_batch("fast", [1, 2, 3, 4], now=2.0)
+    topics.process_batch("slow", [100, 200], now=2.0)
+    topics.update_derived(now=2.0)
+    assert topics.samples("mix", amount=0) == [101, 102, 203, 204]
+    assert topics.samples("scaled", amount=0) == [1010, 1020, 2030, 2040]
+
+def test_derive_errors():
+    topics = Topics()
+    topics.process("name", "hello")
+    topics.process("x", 0.0)
+    topics.derive("bad", "name * 2")
+    topics.derive("inv", "1 / x")
+    topics.update_derived()
+
+    # Non numeric inputs stop the derived topic
+    assert [d.name for d in topics.derived] == ["inv"]
+    assert math.isinf(topics.samples("inv")[0])
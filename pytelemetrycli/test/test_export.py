@@ -0,0 +1,82 @@
+from pytelemetrycli.export import Exporter, format_for
+from pytelemetrycli.topics import Topics
+import numpy as np
+import pytest
+import csv
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+def test_format_for():
+    assert format_for("data.CSV") == 'csv'
+    assert format_for("data.npz") == 'npz'
+    assert format_for("data.parquet") == 'parquet'
+    assert format_for("data.txt") is None
+
+def test_export_csv_history(tmpdir):
+    topics = Topics()
+    topics.set_retention(capacity=50)
+    topics.process_batch("foo", list(range(100)))
+    topics.process("bar", 1.5, {'index': 3})
+    topics.process("bar", "hello")
+
+    path = str(tmpdir.join("out.csv"))
+    exporter = Exporter(topics, ["foo", "bar"], path)
+    exporter.start()
+    exporter.thread.join()
+
+    rows = read_csv(path)
+    assert rows[0] == ['topic', 'index', 'value']
+    # Only retained samples, with their position since the start
+    assert rows[1] == ['foo', '50', '50']
+    assert rows[50] == ['foo', '99', '99']
+    assert rows[51:] == [['bar', '0', 'hello'], ['bar', '3', '1.5']]
+    assert exporter.written == 52
+
+def test_export_npz_live(tmpdir):
+    topics = Topics()
+    topics.process_batch("foo", [1.0, 2.0])
+
+    path = str(tmpdir.join("out.npz"))
+    exporter = Exporter(topics, ["foo"], path, live=True)
+    exporter.start()
+    topics.process_batch("foo", [3.0, 4.0], [None, 7])
+    topics.process("foo", 5.0)
+    exporter.stop()
+
+    # No more samples once stopped
+    topics.process("foo", 6.0)
+    assert topics.subscribers == {}
+
+    with np.load(path) as data:
+        assert data['foo/index'].tolist() == [0, 1, 2, 7, 3]
+        assert data['foo/values'].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+def test_export_npz_names(tmpdir):
+    topics = Topics()
+    topics.process_batch("foo", [1.0, 2.0])
+    topics.process_batch("foo_index", [3.0])
+
+    path = str(tmpdir.join("out.npz"))
+    exporter = Exporter(topics, ["foo", "foo_index"], path)
+    exporter.start()
+    exporter.thread.join()
+
+    with np.load(path) as data:
+        assert data['foo/index'].tolist() == [0, 1]
+        assert data['foo/values'].tolist() == [1.0, 2.0]
+        assert data['foo_index/values'].tolist() == [3.0]
+
+def test_export_parquet(tmpdir):
+    pq = pytest.importorskip("pyarrow.parquet")
+    topics = Topics()
+    topics.process_batch("foo", [1, 2, 3])
+
+    path = str(tmpdir.join("out.parquet"))
+    exporter = Exporter(topics, ["foo"], path)
+    exporter.start()
+    exporter.thread.join()
+
+    table = pq.read_table(path)
+    assert table.column('value').to_pylist() == [1.0, 2.0, 3.0]
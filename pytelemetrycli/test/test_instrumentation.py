@@ -0,0 +1,47 @@
+from pytelemetrycli.instrumentation import Histogram, Pipeline, PUBLISH_PERIOD
+from pytelemetrycli.topics import Topics
+from unittest.mock import MagicMock
+
+def test_histogram_percentiles():
+    h = Histogram()
+    assert h.percentile(50) is None
+
+    for i in range(1, 101):
+        h.add(i / 1e6)
+
+    assert h.count == 100
+    assert h.max == 100 / 1e6
+    # Estimates are the upper bound of the bucket, within 20%
+    assert 50e-6 <= h.percentile(50) <= 60e-6
+    assert 99e-6 <= h.percentile(99) <= 100e-6
+    assert h.percentile(100) == 100 / 1e6
+
+def test_pipeline_publish():
+    topics = Topics()
+    pipeline = Pipeline()
+
+    channel = pipeline.timed(MagicMock())
+    channel.put([0, 1])
+    channel.channel.put.assert_called_once_with([0, 1])
+    pipeline.add('decode', 10e-6)
+
+    plot = MagicMock()
+    plot.depth.return_value = 3
+    entry = {'id': '1', 'plot': plot, 'stats': {'lag': 0.02}}
+
+    # Published once per period
+    pipeline.publish(topics, [entry], now=pipeline.last_publish + 0.1)
+    assert topics.ls(source='cli') == []
+    pipeline.publish(topics, [entry], now=pipeline.last_publish + PUBLISH_PERIOD)
+
+    assert 'decode_p50_us' in topics.ls(source='cli')
+    assert 'handoff_p99_us' in topics.ls(source='cli')
+    assert 'ingest_p50_us' not in topics.ls(source='cli')
+    assert 10 <= topics.samples('decode_p50_us')[0] <= 12
+    assert topics.samples('plot1_depth') == [3]
+    assert topics.samples('plot1_lag_ms') == [20.0]
+
+    # Totals are kept once the period is over
+    assert pipeline.window['decode'].count == 0
+    assert pipeline.stats('decode')['count'] == 1
+    assert pipeline.plots == {'plot1': {'depth': 3, 'lag': 0.02, 'skipped': 0}}
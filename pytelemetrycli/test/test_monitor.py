@@ -0,0 +1,44 @@
+from pytelemetrycli.ui.monitor import PlotMonitor
+from unittest.mock import MagicMock
+from multiprocessing import Pipe
+import time
+
+def make_entry(id):
+    ctrl, plot_side = Pipe()
+    plot = MagicMock()
+    plot.channels = {"foo" + id: None}
+    return {'id': id, 'plot': plot, 'ctrl': ctrl}, plot_side
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_monitor_detects_closed_plots():
+    monitor = PlotMonitor()
+    first, first_side = make_entry('1')
+    second, second_side = make_entry('2')
+    monitor.add(first)
+    monitor.add(second)
+    assert [e['id'] for e in monitor.plots()] == ['1', '2']
+    assert monitor.find('id', '2') is second
+
+    first_side.send("closing")
+    assert wait_for(lambda: monitor.closed)
+    assert [e['id'] for e in monitor.plots()] == ['2']
+
+    # Transfers are stopped by the caller of release_closed
+    topics = MagicMock()
+    monitor.release_closed(topics)
+    topics.untransfer.assert_called_once_with("foo1", first['plot'])
+    first['plot'].release.assert_called_once_with()
+    assert not monitor.closed
+
+    # A plot process that died is detected too
+    second_side.close()
+    assert wait_for(lambda: monitor.closed)
+    assert monitor.plots() == []
+
+    monitor.stop()
+    assert not monitor.thread.is_alive()
@@ -0,0 +1,107 @@
+from pytelemetrycli.publisher import Publisher, read_script
+from pytelemetry import Pytelemetry
+import pytest
+import time
+
+class WriteTransport:
+    # Records the writes and decodes them back
+    def __init__(self):
+        self.writes = []
+        self.received = []
+        self.telemetry = Pytelemetry(self)
+        self.telemetry.subscribe(None, lambda topic, data, options: self.received.append((topic, data, time.monotonic())))
+    def write(self, data):
+        self.writes.append(bytes(data))
+        self.telemetry.api.delimiter.decode(data)
+    def writeable(self):
+        return True
+    def readable(self):
+        return 0
+    def read(self, maxbytes=1):
+        return b''
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+def make_publisher(rate=None):
+    transport = WriteTransport()
+    telemetry = Pytelemetry(transport)
+    return Publisher(transport, telemetry, rate), transport, telemetry
+
+def test_publish_sync():
+    publisher, transport, telemetry = make_publisher()
+    publisher.publish("foo", 3, "int32")
+    assert transport.received[0][:2] == ("foo", 3)
+    assert telemetry.stats()['protocol']['tx_encoded_frames'] == 1
+
+    with pytest.raises(IndexError):
+        publisher.publish("foo", 3, "int64")
+
+def test_publish_batched():
+    publisher, transport, telemetry = make_publisher()
+    publisher.start()
+    try:
+        start = time.monotonic() + 0.05
+        publisher.schedule([(0, "a", i, "uint16") for i in range(100)], start)
+        assert wait_for(lambda: len(transport.received) == 100)
+        # Frames due together are sent in a few writes
+        assert len(transport.writes) <= 2
+        assert [data for topic, data, t in transport.received] == list(range(100))
+        assert transport.received[0][2] >= start
+    finally:
+        publisher.stop()
+
+def test_publish_timed():
+    publisher, transport, telemetry = make_publisher()
+    publisher.start()
+    try:
+        start = time.monotonic()
+        publisher.schedule([(0.2, "late", 2.5, "float32"), (0.0, "early", "on", "string")], start)
+        publisher.publish("now", 1, "uint8")
+        assert wait_for(lambda: len(transport.received) == 3)
+        assert [topic for topic, data, t in transport.received] == ["early", "now", "late"]
+        assert transport.received[2][2] - start >= 0.2
+    finally:
+        publisher.stop()
+
+def test_publish_rate():
+    publisher, transport, telemetry = make_publisher(rate=100)
+    publisher.start()
+    try:
+        start = time.monotonic()
+        publisher.schedule([(0, "a", i, "uint8") for i in range(20)], start)
+        assert wait_for(lambda: len(transport.received) == 20)
+        # 20 samples at 100 samples/s
+        assert time.monotonic() - start >= 0.15
+
+        publisher.set_rate(10)
+        publisher.schedule([(0, "a", i, "uint8") for i in range(20)])
+        assert wait_for(lambda: publisher.pending() < 20)
+        assert publisher.cancel() > 0
+        assert publisher.pending() == 0
+    finally:
+        publisher.stop()
+
+def test_read_script(tmpdir):
+    path = tmpdir.join("script.csv")
+    path.write("time,topic,type,value\n"
+               "# setpoints\n"
+               "0.5,speed,f32,1.5\n"
+               "0,speed,i16,-3\n"
+               "\n"
+               "1,msg,s,hello, world\n")
+    assert read_script(str(path)) == [(0.0, "speed", -3, "int16"),
+                                      (0.5, "speed", 1.5, "float32"),
+                                      (1.0, "msg", "hello, world", "string")]
+
+    path.write("0,speed,i64,3\n")
+    with pytest.raises(ValueError) as e:
+        read_script(str(path))
+    assert "line 1" in str(e.value)
+
+    path.write("0,speed\n")
+    with pytest.raises(ValueError):
+        read_script(str(path))
@@ -0,0 +1,51 @@
+from pytelemetrycli.recording import Recorder, ReplayTransport, read_records, MAGIC
+import pytest
+import time
+
+def test_recorder_groups_close_bytes(tmpdir):
+    path = str(tmpdir.join("session.rec"))
+    r = Recorder(path, resolution=10.0)
+    r.write(b'ab')
+    r.write([99, 100])
+    r.close()
+
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC
+        records = list(read_records(f))
+
+    assert len(records) == 1
+    assert records[0][1] == b'abcd'
+
+def test_replay_real_time(tmpdir):
+    path = str(tmpdir.join("session.rec"))
+    r = Recorder(path, resolution=0.0)
+    r.write(b'first')
+    time.sleep(0.2)
+    r.write(b'second')
+    r.close()
+
+    tr = ReplayTransport(speed=1.0)
+    tr.connect({'port': path})
+
+    # The first record is due right after the start, the second one after 0.2 s
+    time.sleep(0.05)
+    assert tr.readable() == 5
+    assert tr.read(maxbytes=3) == b'fir'
+    assert tr.read(maxbytes=10) == b'st'
+    assert tr.readable() == 0
+    assert not tr.finished()
+
+    # Waits until the next record is due
+    tr.wait_readable(1.0)
+    assert tr.readable() == 6
+    assert tr.read(maxbytes=10) == b'second'
+    assert tr.finished()
+    assert tr.stats()['rx_bytes'] == 11
+
+def test_replay_rejects_unknown_files(tmpdir):
+    path = tmpdir.join("notarecording.txt")
+    path.write("hello")
+
+    tr = ReplayTransport()
+    with pytest.raises(IOError):
+        tr.connect({'port': str(path)})
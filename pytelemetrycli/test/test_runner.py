@@ -0,0 +1,76 @@
+from pytelemetrycli.runner import Runner, MIN_READ
+from pytelemetrycli.topics import Topics
+from unittest.mock import MagicMock
+import time
+
+class BufferTransport:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.reads = []
+    def readable(self):
+        return len(self.buffer)
+    def read(self, maxbytes=1):
+        data = bytes(self.buffer[:maxbytes])
+        del self.buffer[:maxbytes]
+        self.reads.append(len(data))
+        return data
+
+def make_runner(transport):
+    telemetry = MagicMock()
+    return Runner(transport, telemetry, None, Topics())
+
+def test_decode_adaptive_block():
+    tr = BufferTransport()
+    runner = make_runner(tr)
+    decode = runner.telemetryWrapper.api.delimiter.decode
+
+    tr.buffer.extend(bytes(1000))
+    runner.decode()
+    # Large backlog, block doubled once, everything waiting is decoded
+    assert runner.block == 2 * MIN_READ
+    assert tr.reads == [128] * 7 + [104]
+    assert sum(len(c[0][0]) for c in decode.call_args_list) == 1000
+
+    # Small backlog, block shrinks back
+    tr.reads = []
+    tr.buffer.extend(bytes(10))
+    runner.decode()
+    assert runner.block == MIN_READ
+    assert tr.reads == [10]
+
+def test_wait():
+    tr = BufferTransport()
+    runner = make_runner(tr)
+
+    # Nothing to block on, sleeps with an increasing back-off
+    start = time.monotonic()
+    assert runner.wait(0.01) == 0
+    assert runner.sleep == 0.002
+    assert time.monotonic() - start < 0.01
+
+    # Data already waiting, no wait
+    tr.buffer.extend(b'abc')
+    assert runner.wait(10) == 3
+    assert runner.sleep == 0.001
+
+    # Transports able to block are waited on
+    tr.buffer = bytearray()
+    tr.wait_readable = MagicMock(side_effect=lambda timeout: tr.buffer.extend(b'x'))
+    assert runner.wait(0.5) == 1
+    tr.wait_readable.assert_called_once_with(0.5)
+
+def test_flush_storage_error(caplog):
+    runner = make_runner(BufferTransport())
+    process_batch = runner.topics.process_batch
+    def failing(topic, payloads, indexes=None, now=None):
+        if topic == "foo":
+            raise OSError(24, "Too many open files")
+        process_batch(topic, payloads, indexes, now)
+    runner.topics.process_batch = failing
+
+    # The failure is reported, the other topics are still stored
+    runner.collect("foo", 1)
+    runner.collect("bar", 2)
+    runner.flush()
+    assert runner.topics.samples("bar") == [2]
+    assert "Could not store 1 samples of 'foo'" in caplog.text
@@ -0,0 +1,114 @@
+from pytelemetrycli.server import StreamServer, StreamClient, encode_batch, decode_batch
+from pytelemetrycli.topics import Topics
+import pytest
+import time
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def start(topics, **options):
+    server = StreamServer(topics, port=0, **options)
+    server.start()
+    return server, StreamClient(*server.address(), timeout=5)
+
+def test_batch_framing():
+    batch = decode_batch(encode_batch("foo", [1, 2.5, -3], [None, 4, None], 7, [10.0, 11.0, 12.0]))
+    assert batch == dict(topic="foo", values=[1.0, 2.5, -3.0], indexes=[None, 4, None],
+                         start=7, times=[10.0, 11.0, 12.0])
+
+    # Strings are sent as JSON
+    batch = decode_batch(encode_batch("bar", ["hello", 1]))
+    assert batch['values'] == ["hello", 1]
+    assert batch['indexes'] is None and batch['times'] is None
+
+def test_ls_and_range():
+    topics = Topics()
+    topics.process_batch("foo", [1, 2, 3])
+    topics.process("bar", "hello")
+    server, client = start(topics)
+    try:
+        listed = client.ls()
+        assert [t['name'] for t in listed] == ["bar", "foo"]
+        assert listed[1]['received'] == 3
+
+        values, times = client.range("foo")
+        assert values == [1, 2, 3]
+        # Receive times are sent as unix times
+        assert abs(times[0] - time.time()) < 60
+
+        assert client.range("foo", last=2)[0] == [2, 3]
+        assert client.range("foo", since=time.time() + 10)[0] == []
+        assert client.range("bar")[0] == ["hello"]
+
+        with pytest.raises(ValueError):
+            client.range("unknown")
+        with pytest.raises(ValueError):
+            client.request("format")
+    finally:
+        client.close()
+        server.stop()
+
+def test_live_subscriptions():
+    topics = Topics()
+    topics.process("foo", 0)
+    server, client = start(topics)
+    other = StreamClient(*server.address(), timeout=5)
+    try:
+        assert client.subscribe("foo", "imu*") == {'op': 'subscribe', 'topics': ["foo", "imu*"],
+                                                   'policy': 'drop-oldest'}
+        other.subscribe("foo")
+
+        topics.process_batch("foo", [1, 2])
+        topics.process("imu1", 5, {'index': 2})
+
+        batch = client.receive()
+        assert (batch['topic'], batch['values'], batch['start']) == ("foo", [1.0, 2.0], 1)
+        batch = client.receive()
+        assert (batch['topic'], batch['values'], batch['indexes']) == ("imu1", [5.0], [2])
+        # Every client receives the samples
+        assert other.receive()['values'] == [1.0, 2.0]
+
+        assert wait_for(lambda: len(server.clients()) == 2)
+        other.close()
+        assert wait_for(lambda: len(server.clients()) == 1)
+        assert len(topics.subscriptions) == 1
+
+        # Remote clients cannot slow down ingest
+        with pytest.raises(ValueError):
+            client.subscribe("foo", policy='block')
+        assert len(topics.subscriptions) == 1
+        assert client.subscribe("foo", policy='latest')['policy'] == 'latest'
+
+        client.unsubscribe()
+        assert topics.subscriptions == []
+    finally:
+        client.close()
+        assert server.stop() <= 1
+    assert server.clients() == []
+
+def test_client_buffer():
+    topics = Topics()
+    topics.process("foo", 0)
+    server, client = start(topics, buffer=4)
+    try:
+        client.subscribe("foo")
+        session = server.clients()[0]
+        assert session.subscription.maxsize == 4
+        # Sending to the client is stuck, its buffer overflows without blocking ingest
+        session.lock.acquire()
+        for i in range(1, 100):
+            topics.process("foo", i)
+        assert session.subscription.pending() <= 4
+        assert session.subscription.dropped > 0
+        session.lock.release()
+
+        received = []
+        while not received or received[-1] != 99:
+            received.extend(client.receive()['values'])
+        assert len(received) < 99
+    finally:
+        client.close()
+        server.stop()
@@ -0,0 +1,91 @@
+from pytelemetrycli.storage import Column, typecode_for
+
+def test_typecode_for():
+    assert typecode_for(12) == 'b'
+    assert typecode_for(1000) == 'h'
+    assert typecode_for(-70000) == 'i'
+    assert typecode_for(2**32) == 'q'
+    assert typecode_for(12, previous='i') == 'i'
+    assert typecode_for(0.5) == 'd'
+    assert typecode_for(0.5, float_typecode='f') == 'f'
+    assert typecode_for(0.5, previous='h', float_typecode='f') == 'd'
+    assert typecode_for("foo") is None
+
+def test_column_append_and_read():
+    c = Column()
+    for i in range(100):
+        c.append(i)
+
+    assert len(c) == 100
+    assert c.tolist() == list(range(100))
+    assert c.tolist(-3) == [97, 98, 99]
+    assert c.tolist(10, 13) == [10, 11, 12]
+    # Chunks grow geometrically
+    assert [chunk.capacity for chunk in c.chunks] == [16, 32, 64]
+
+def test_column_widens_on_overflow():
+    c = Column()
+    c.append(1)
+    c.append(300)
+    c.append(70000)
+    c.append(0.25)
+    c.append("bar")
+    c.append(2)
+
+    assert c.tolist() == [1, 300, 70000, 0.25, "bar", 2]
+    assert [chunk.typecode for chunk in c.chunks] == ['b', 'h', 'i', 'd', None]
+
+def test_column_views_are_zero_copy():
+    c = Column()
+    for i in range(20):
+        c.append(i)
+
+    views = list(c.views(10))
+    assert [type(v) for v in views] == [memoryview, memoryview]
+    assert [list(v) for v in views] == [list(range(10, 16)), list(range(16, 20))]
+
+    # Appending while views are alive must not fail
+    c.append(20)
+    assert c.tolist(-1) == [20]
+
+def test_column_drop():
+    c = Column()
+    for i in range(100):
+        c.append(i)
+
+    c.drop(20)
+    assert len(c) == 80
+    assert c.received() == 100
+    assert c.tolist(0, 3) == [20, 21, 22]
+    # First chunk (16 samples) was released
+    assert [chunk.capacity for chunk in c.chunks] == [32, 64]
+
+    c.drop_chunk()
+    assert c.tolist(0, 1) == [48]
+
+    c.drop(1000)
+    assert len(c) == 0
+    assert c.received() == 100
+    assert c.tolist() == []
+
+    c.append(5)
+    assert c.tolist() == [5]
+
+def test_column_bisect():
+    c = Column('d')
+    assert c.first() is None
+    assert c.bisect(1.0) == 0
+    for i in range(100):
+        c.append(float(i // 2))
+
+    assert c.first() == 0.0
+    assert c.bisect(10.0) == 20
+    assert c.bisect(10.0, right=True) == 22
+    assert c.bisect(-1.0) == 0
+    assert c.bisect(1000.0) == 100
+
+    # Positions are counted since the creation of the column
+    c.drop(30)
+    assert c.first() == 15.0
+    assert c.bisect(20.0) == 40
+    assert c.bisect(0.0) == 30
@@ -0,0 +1,68 @@
+from pytelemetrycli.summary import Summary, TDigest
+from pytelemetrycli.topics import Topics
+import random
+import statistics
+
+def test_summary():
+    values = [random.Random(0).uniform(-10, 10) for i in range(1000)]
+    values = [v * (i % 7) for i, v in enumerate(values)]
+    s = Summary()
+    for v in values[:300]:
+        s.add(v)
+    s.extend(values[300:])
+
+    assert s.count == 1000
+    assert s.min == min(values)
+    assert s.max == max(values)
+    assert abs(s.mean - statistics.mean(values)) < 1e-9
+    assert abs(s.std() - statistics.stdev(values)) < 1e-9
+
+    # Merging two summaries gives the summary of all values
+    a = Summary()
+    b = Summary()
+    a.extend(values[:500])
+    b.extend(values[500:])
+    a.merge(b)
+    assert a.count == 1000
+    assert abs(a.variance() - statistics.variance(values)) < 1e-9
+
+def test_summary_ignores_strings():
+    s = Summary()
+    s.add("hello")
+    s.extend(["a", "b"])
+    assert s.count == 0
+    assert s.stats()['mean'] is None
+    assert s.quantile(0.5) is None
+
+def test_tdigest_quantiles():
+    rng = random.Random(1)
+    values = [rng.random() for i in range(20000)]
+    digest = TDigest()
+    for v in values[:10000]:
+        digest.add(v)
+    other = TDigest()
+    other.extend(values[10000:])
+    digest.merge(other)
+
+    assert digest.count == 20000
+    # Centroids are bounded by the compression
+    assert len(digest.means) < 2 * digest.compression
+    values.sort()
+    for q in (0.01, 0.1, 0.5, 0.9, 0.99):
+        assert abs(digest.quantile(q) - values[int(q * len(values))]) < 0.01
+    assert digest.quantile(0) == values[0]
+    assert digest.quantile(1) == values[-1]
+
+def test_summary_after_eviction():
+    topics = Topics()
+    topics.set_retention(capacity=10)
+    topics.process_batch("foo", list(range(100)))
+    topics.process("foo", 100)
+    topics.process("foo", 5, {'index': 3})
+
+    assert topics.count("foo") == 10
+    stats = topics.summary("foo").stats()
+    assert stats['count'] == 102
+    assert stats['min'] == 0
+    assert stats['max'] == 100
+    assert topics.summary("bar") is None
@@ -0,0 +1,168 @@
+from pytelemetrycli.ui.superplot import Superplot, PlotType, GrowableBuffer, IndexedBuffer, MinMaxPyramid
+from pytelemetrycli.ui.channels import PlotFeed
+from unittest.mock import MagicMock
+from types import SimpleNamespace
+import queue
+import time
+import numpy as np
+
+def test_growable_buffer():
+    b = GrowableBuffer(capacity=4)
+    b.extend([1, 2, 3])
+    b.extend([4, 5])
+    assert len(b) == 5
+    assert len(b.data) == 8
+    assert b.values().tolist() == [1, 2, 3, 4, 5]
+
+    b.extend(list(range(20)))
+    assert len(b.data) == 25
+    assert b.values().tolist()[-3:] == [17, 18, 19]
+
+def test_indexed_buffer():
+    b = IndexedBuffer(capacity=2)
+    b.update([5, 7], [1.0, 2.0])
+    x, y = b.values()
+    assert x.tolist() == [5, 7]
+    assert y.tolist() == [1.0, 2.0]
+
+    # Lower indexes are inserted before, existing indexes are overwritten
+    b.update([2, 7, 10], [3.0, 4.0, 5.0])
+    x, y = b.values()
+    assert x.tolist() == [2, 5, 7, 10]
+    assert y.tolist() == [3.0, 1.0, 4.0, 5.0]
+
+def make_plot(capacity=1000):
+    s = Superplot("test")
+    s.q = queue.Queue()
+    s.consumed = SimpleNamespace(value=0)
+    s.feed = PlotFeed(s.q, s.consumed, capacity)
+    s.win = MagicMock()
+    s.ctrl = MagicMock()
+    s.in_process_pipe = MagicMock()
+    s.in_process_pipe.poll.return_value = False
+    # No graphics in tests
+    def attach(curve):
+        curve.item = MagicMock()
+    s._attach = attach
+    s._detach = MagicMock()
+    return s
+
+def add(s, topic, plottype):
+    # Adds a curve on both the main and the plot process sides
+    channel = s.add_curve(topic, plottype)
+    s._process_msg(s.ctrl.send.call_args[0][0])
+    return channel
+
+def test_update_linear():
+    s = make_plot()
+    q = add(s, "foo", PlotType.linear)
+    q.put([0, 1.0])
+    q.put([[1, 2], [2.0, 3.0]])
+    q.put([3, 4.0])
+    s._update()
+
+    curve = s.curves[0].item
+    x, y = curve.setData.call_args[0]
+    assert x.tolist() == [0, 1, 2, 3]
+    assert y.tolist() == [1.0, 2.0, 3.0, 4.0]
+
+    # Nothing new, nothing to redraw
+    curve.setData.reset_mock()
+    s._update()
+    assert not curve.setData.called
+
+def test_update_indexed():
+    s = make_plot()
+    q = add(s, "foo", PlotType.indexed)
+    q.put([1, 1.0])
+    q.put([[0, 1], [2.0, 3.0]])
+    s._update()
+
+    x, y = s.curves[0].item.setData.call_args[0]
+    assert x.tolist() == [0, 1]
+    assert y.tolist() == [2.0, 3.0]
+
+def test_several_topics():
+    s = make_plot()
+    foo = add(s, "foo", PlotType.linear)
+    bar = add(s, "bar", PlotType.indexed)
+    foo.put([0, 1.0])
+    bar.put([[0, 1], [5.0, 6.0]])
+    foo.put([1, 2.0])
+    s._update()
+
+    x, y = s.curves[0].item.setData.call_args[0]
+    assert y.tolist() == [1.0, 2.0]
+    x, y = s.curves[1].item.setData.call_args[0]
+    assert y.tolist() == [5.0, 6.0]
+
+    # Samples still queued for a removed curve are ignored
+    foo.put([2, 3.0])
+    s.remove_curve("foo")
+    assert s.ctrl.send.call_args[0][0] == ("remove", 0)
+    s._process_msg(("remove", 0))
+    s._update()
+    assert list(s.curves) == [1]
+    assert list(s.channels) == ["bar"]
+
+def test_minmax_pyramid():
+    x = GrowableBuffer()
+    y = GrowableBuffer()
+    pyramid = MinMaxPyramid(x, y)
+
+    x.extend(np.arange(1000))
+    y.extend(np.zeros(1000))
+    pyramid.update()
+    # Levels are completed incrementally
+    x.extend(np.arange(1000, 10000))
+    values = np.zeros(9000)
+    values[5000] = 42.0 # A spike
+    y.extend(values)
+    pyramid.update()
+
+    assert [len(mins) for mins, maxs in pyramid.levels] == [2500, 625, 156, 39, 9, 2]
+    assert pyramid.levels[1][1].values().max() == 42.0
+
+    # Few samples visible, raw data is drawn
+    rx, ry = pyramid.render(100, 200, width=1000)
+    assert rx.tolist() == list(range(99, 202))
+
+    # Whole curve, decimated but the spike is kept
+    rx, ry = pyramid.render(None, None, width=100)
+    assert len(rx) <= 2 * 100 + 2
+    assert ry.max() == 42.0
+    assert rx[0] == 0 and rx[-1] == 9999
+
+def test_reports_lag():
+    s = make_plot()
+    q = add(s, "foo", PlotType.linear)
+    s.q.put((0, [0, 1.0], time.monotonic() - 0.5, 3))
+    s.last_stats = 0
+    s._update()
+
+    msg = s.in_process_pipe.send.call_args[0][0]
+    assert msg[0] == "stats"
+    assert msg[1]['lag'] >= 0.5
+    assert msg[1]['skipped'] == 3
+    assert s.lag is None
+    title = s.win.setWindowTitle.call_args[0][0]
+    assert title.startswith("test (lag ") and title.endswith(" ms, 3 samples skipped)")
+    assert s.title(None, 0) == "test"
+
+def test_bounded_queue():
+    s = make_plot(capacity=4)
+    q = add(s, "foo", PlotType.linear)
+    for i in range(10):
+        q.put([i, float(i)])
+    # The backlog is decimated once it exceeds the capacity
+    assert s.depth() == 8
+    s._update()
+
+    # Samples held back are sent once the plot received the first ones
+    assert s.consumed.value == 4
+    s.flush()
+    s._update()
+    x, y = s.curves[0].item.setData.call_args[0]
+    assert x.tolist() == [0, 1, 2, 3, 4, 6, 8, 9]
+    assert s.curves[0].skipped == 2
+    assert s.depth() == 0
@@ -1,5 +1,13 @@
 from pytelemetrycli.topics import Topics
 from multiprocessing import Queue
+import threading
+import time
+import queue
+import logging
+import mmap
+import pytest
+import json
+import os
 
 def test_process():
     t1 = "testTopic"
@@ -44,9 +52,13 @@ def test_transfert_queue():
 
     assert q.qsize() > 0
 
-    assert q.get() == [0, 123]
-    assert q.get() == [1, 456]
-    assert q.get() == [2, 789]
+    # Received samples are sent as batches, one per storage chunk
+    xs, ys = [], []
+    while len(ys) < 3:
+        x, y = q.get()
+        xs.extend(x)
+        ys.extend(y)
+    assert (xs, ys) == ([0, 1, 2], [123, 456, 789])
 
     topic.process(t1,111)
     topic.process(t1,222)
@@ -73,9 +85,7 @@ def test_transfert_queue_indexed_data():
 
     assert q.qsize() > 0
 
-    assert q.get() == [5, 123]
-    assert q.get() == [6, 456]
-    assert q.get() == [7, 789]
+    assert q.get() == [[5, 6, 7], [123, 456, 789]]
 
     topic.process(t1,111, {'index': 5})
     topic.process(t1,222, {'index': 6})
@@ -126,3 +136,396 @@ def test_different_sources():
     assert t1 not in topics.ls(source="cli")
     assert t2 in topics.ls(source="cli")
     assert len(topics.ls(source="cli")) == 1
+
+def test_retention_capacity():
+    t1 = "testTopic"
+    topics = Topics()
+    topics.set_retention(capacity=10)
+
+    for i in range(100):
+        topics.process(t1, i)
+
+    assert topics.count(t1) == 10
+    assert topics.received(t1) == 100
+    assert topics.samples(t1, amount=0) == list(range(90, 100))
+
+    # Per-topic capacity overrides the session default
+    topics.set_retention(t1, capacity=5)
+    assert topics.samples(t1, amount=0) == list(range(95, 100))
+
+    # And is kept when the session defaults change afterwards
+    topics.process_batch("other", list(range(100)))
+    topics.set_retention(capacity=10, budget=100 * 1024 * 1024)
+    topics.set_retention(capacity=20)
+    topics.process_batch(t1, list(range(100)))
+    topics.process_batch("other", list(range(100)))
+    assert topics.count(t1) == 5
+    assert topics.count("other") == 20
+
+def test_retention_max_age():
+    t1 = "testTopic"
+    topics = Topics()
+    topics.set_retention(max_age=10.0)
+
+    # Pretend the first samples were received 20 seconds ago
+    topics.create(t1)
+    topic = topics.topic_list[t1]
+    topic.new_samples([1, 2], now=time.monotonic() - 20.0)
+    assert topics.samples(t1, amount=0) == [1, 2]
+
+    topics.process(t1, 3)
+    assert topics.samples(t1, amount=0) == [3]
+    assert topics.received(t1) == 3
+
+def test_retention_memory_budget():
+    topics = Topics()
+
+    for i in range(5000):
+        topics.process("old", i * 1000)
+    for i in range(5000):
+        topics.process("new", i * 1000)
+
+    used = topics.nbytes()
+    topics.set_retention(budget=used // 2)
+
+    assert topics.nbytes() <= used // 2
+    # Oldest data is evicted first
+    assert topics.count("old") < 5000
+    assert topics.count("new") == 5000
+
+def test_retention_lru_policy():
+    topics = Topics()
+    q = queue.Queue()
+
+    for i in range(5000):
+        topics.process("plotted", i * 1000)
+    for i in range(5000):
+        topics.process("other", i * 1000)
+
+    topics.transfer("plotted", q)
+
+    used = topics.nbytes()
+    topics.set_retention(budget=used // 2, policy='lru')
+
+    assert topics.count("plotted") == 5000
+    assert topics.count("other") < 5000
+
+def test_process_batch():
+    t1 = "testTopic"
+    topics = Topics()
+    q = queue.Queue()
+
+    topics.process_batch(t1, [1, 2, 3])
+    assert topics.samples(t1, amount=0) == [1, 2, 3]
+
+    topics.transfer(t1, q)
+    assert q.get() == [[0, 1, 2], [1, 2, 3]]
+
+    # A single message per batch
+    topics.process_batch(t1, [4, 5.5, "six"])
+    assert q.qsize() == 1
+    assert q.get() == [[3, 4, 5], [4, 5.5, "six"]]
+    assert topics.samples(t1, amount=0) == [1, 2, 3, 4, 5.5, "six"]
+    assert topics.count(t1) == 6
+
+def test_process_batch_indexed():
+    t1 = "testTopic"
+    topics = Topics()
+    q = queue.Queue()
+
+    topics.process_batch(t1, [10, 11], [0, 1])
+    topics.transfer(t1, q, transfer_type='indexed')
+    assert q.get() == [[0, 1], [10, 11]]
+
+    # Linear samples of a mixed batch are not sent to indexed transfers
+    topics.process_batch(t1, [12, 99, 13], [0, None, 1])
+    assert q.get() == [[0, 1], [12, 13]]
+    assert q.empty()
+    assert topics.samples(t1, amount=0) == [99]
+
+def test_sample_trace(caplog):
+    t1 = "testTopic"
+    topics = Topics()
+
+    with caplog.at_level(logging.DEBUG, logger='topics.samples'):
+        topics.process(t1, 1)
+        assert caplog.records == []
+
+        topics.set_trace(1)
+        topics.process(t1, 2)
+        assert caplog.records[-1].getMessage() == "new sample | testTopic 2"
+
+        caplog.clear()
+        topics.set_trace(3)
+        topics.process_batch(t1, list(range(5)))
+        topics.process_batch(t1, list(range(5, 10)))
+        assert [r.getMessage() for r in caplog.records] == [
+            "new samples | testTopic [0, 3]",
+            "new samples | testTopic [6, 9]"]
+
+def test_session_store(tmpdir):
+    path = str(tmpdir.join("session"))
+    topics = Topics()
+    topics.use_store(path)
+
+    topics.process_batch("foo", list(range(1000)))
+    topics.process("foo", 1.5)
+    topics.process("bar", "hello")
+    topics.process("bar", 12)
+    topics.process("arr", 3, {'index': 0})
+    topics.create("baudspeed", source="cli")
+    topics.process("baudspeed", 100.25)
+
+    # Numeric samples are memory-mapped
+    views = list(topics.views("foo"))
+    assert all(isinstance(v.obj, mmap.mmap) for v in views)
+    del views
+
+    topics.clear()
+
+    other = Topics()
+    other.open_session(path)
+    assert other.ls() == ["arr", "bar", "foo"]
+    assert other.ls(source="cli") == ["baudspeed"]
+    assert other.count("foo") == 1001
+    assert other.samples("foo", amount=3) == [998, 999, 1.5]
+    assert other.samples("bar", amount=0) == ["hello", 12]
+    assert other.samples("baudspeed") == [100.25]
+    assert other.topic_list["arr"].indexes[0] == 3
+
+    # Samples received after opening are appended to the session
+    other.process("foo", 7)
+    other.process("new", 8)
+    other.clear()
+
+    other.open_session(path)
+    assert other.samples("foo", amount=2) == [1.5, 7]
+    assert other.samples("new") == [8]
+    # Receive times are saved along with the samples
+    assert len(other.timestamps("foo")) == 1002
+    assert other.timestamps("foo") == sorted(other.timestamps("foo"))
+    other.clear()
+
+def test_session_times(tmpdir):
+    path = str(tmpdir.join("session"))
+    topics = Topics()
+    topics.use_store(path)
+    topics.process_batch("foo", [1, 2, 3])
+    topics.clear()
+
+    # Reopened after a reboot : the session was saved 1000 s ago, with another monotonic clock
+    manifest = os.path.join(path, "session.json")
+    with open(manifest) as f:
+        saved = json.load(f)
+    saved['topics']['foo']['times']['epoch'] -= 1000.0
+    with open(manifest, 'w') as f:
+        json.dump(saved, f)
+
+    topics.open_session(path)
+    now = time.monotonic()
+    assert topics.samples("foo", since=now - 10) == []
+    assert topics.samples("foo", since=now - 1010, until=now - 990) == [1, 2, 3]
+    # The moved times are saved
+    topics.clear()
+    topics.open_session(path)
+    assert topics.samples("foo", since=now - 1010, until=now - 990) == [1, 2, 3]
+    topics.clear()
+
+def test_time_range():
+    topics = Topics()
+    topics.create("foo")
+    t = topics.topic_list["foo"]
+    for i in range(100):
+        t.new_samples([i, i + 0.5], now=1000.0 + i)
+
+    assert topics.samples("foo", since=1090.0) == [v for i in range(90, 100) for v in (i, i + 0.5)]
+    assert topics.samples("foo", since=1010.0, until=1011.0) == [10, 10.5, 11, 11.5]
+    assert topics.samples("foo", until=1000.5) == [0, 0.5]
+    assert topics.samples("foo", since=2000.0) == []
+    assert topics.timestamps("foo", since=1098.0) == [1098.0, 1098.0, 1099.0, 1099.0]
+
+    # Positions stay valid once older samples are evicted
+    t.set_retention(capacity=50)
+    assert topics.samples("foo", since=0.0) == topics.samples("foo", amount=0)
+    assert topics.samples("foo", since=1080.0, until=1080.0) == [80, 80.5]
+    assert len(t.times) == 50
+
+def test_transfer_time():
+    topics = Topics()
+    q = queue.Queue()
+    topics.process("foo", 1)
+    topics.transfer("foo", q, transfer_type="time")
+    topics.process("foo", 2)
+    topics.process_batch("foo", [3, 4])
+
+    xs, ys = q.get_nowait()
+    assert xs[0] <= 0 and ys == [1]
+    x, y = q.get_nowait()
+    assert x >= 0 and y == 2
+    xs, ys = q.get_nowait()
+    assert len(xs) == 2 and ys == [3, 4]
+
+def test_subscribe():
+    topics = Topics()
+    topics.process("imu1", 0)
+    all_imus = topics.subscribe("imu*")
+    latest = topics.subscribe(["imu1", "other"], maxsize=1, policy='latest')
+    oldest = topics.subscribe("imu1", maxsize=3)
+
+    topics.process_batch("imu1", [1, 2])
+    topics.process_batch("imu2", [10, 11])
+    topics.process_batch("imu1", [3, 4], [None, 7])
+
+    # Each subscriber gets all the batches it can hold, from the position of the sample
+    assert all_imus.get(0) == ("imu1", [1, 2], None, 1)
+    assert all_imus.get(0) == ("imu2", [10, 11], None, 0)
+    assert all_imus.get(0) == ("imu1", [3, 4], [None, 7], 3)
+    assert all_imus.get(0) is None
+    assert all_imus.dropped == 0
+
+    # Overflows only affect the subscriber
+    assert oldest.get(0) == ("imu1", [3, 4], [None, 7], 3)
+    assert oldest.dropped == 2
+    assert latest.get(0) == ("imu1", [4], [7], 4)
+    assert latest.get_nowait() is None
+    assert latest.dropped == 3
+    assert latest.received == 4
+
+    # Subscriptions last until closed, even after a clear
+    topics.clear()
+    topics.process("other", 1)
+    assert latest.get(0) == ("other", [1], None, 0)
+    latest.close()
+    topics.process("other", 2)
+    assert latest.get(0) is None
+    assert len(topics.subscriptions) == 2
+
+def test_subscribe_block():
+    topics = Topics()
+    subscription = topics.subscribe("foo", maxsize=2, policy='block', timeout=5)
+    topics.process_batch("foo", [1, 2])
+
+    # Full, the batch is kept and the feeding thread waits for the consumer
+    topics.process("foo", 3)
+    assert subscription.pending() == 3
+    def consume():
+        time.sleep(0.01)
+        subscription.get(0)
+    thread = threading.Thread(target=consume)
+    thread.start()
+    topics.throttle()
+    thread.join()
+    assert subscription.dropped == 0
+    assert subscription.get(0) == ("foo", [3], None, 2)
+
+def test_subscribe_block_stalled():
+    topics = Topics()
+    subscription = topics.subscribe("foo", maxsize=2, policy='block', timeout=0.2)
+    topics.process_batch("foo", [1, 2])
+
+    # A stalled consumer costs a single timeout, its samples are dropped meanwhile
+    start = time.monotonic()
+    for i in range(5):
+        topics.process("foo", 3 + i)
+        topics.throttle()
+    assert time.monotonic() - start < 0.4
+    assert subscription.stalled
+    assert subscription.pending() == 3
+    assert subscription.dropped == 4
+
+    # Until it read everything
+    while subscription.get_nowait() is not None:
+        pass
+    assert not subscription.stalled
+    topics.process("foo", 8)
+    assert subscription.get(0) == ("foo", [8], None, 7)
+
+def test_multiple_transfers():
+    topics = Topics()
+    first = queue.Queue()
+    second = queue.Queue()
+    topics.process("foo", 1)
+    topics.transfer("foo", first)
+    topics.transfer("foo", second)
+    topics.transfer("foo", second)
+    topics.process("foo", 2)
+
+    assert [first.get_nowait() for i in range(2)] == [[[0], [1]], [1, 2]]
+    assert [second.get_nowait() for i in range(2)] == [[[0], [1]], [1, 2]]
+    assert second.empty()
+
+    topics.untransfer("foo", first)
+    assert not topics.intransfer("foo", first)
+    assert topics.intransfer("foo")
+    topics.process("foo", 3)
+    assert first.empty()
+    assert second.get_nowait() == [2, 3]
+
+    topics.untransfer("foo")
+    assert not topics.intransfer("foo")
+
+def test_concurrent_readers():
+    topics = Topics()
+    topics.set_retention(capacity=500)
+    topics.process_batch("foo", list(range(100)))
+    running = threading.Event()
+    running.set()
+
+    def feed():
+        i = 0
+        while running.is_set():
+            # As the runner does
+            with topics.lock:
+                topics.process_batch("foo", list(range(i, i + 50)))
+            i += 50
+
+    thread = threading.Thread(target=feed)
+    thread.start()
+    try:
+        for i in range(200):
+            assert len(topics.samples("foo", amount=0)) <= 500
+            assert sum(len(view) for view in topics.views("foo")) <= 500
+            q = queue.Queue()
+            topics.transfer("foo", q)
+            topics.untransfer("foo", q)
+    finally:
+        running.clear()
+        thread.join()
+
+def test_session_store_open_files(tmpdir):
+    resource = pytest.importorskip("resource")
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, hard), hard))
+    try:
+        topics = Topics()
+        topics.use_store(str(tmpdir.join("session")))
+        # Each topic maps two columns, far more than the open files allowed
+        for i in range(400):
+            topics.process_batch("topic{0}".format(i), list(range(100)))
+        for i in range(400):
+            assert topics.samples("topic{0}".format(i), amount=2) == [98, 99]
+        topics.clear()
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+def test_transfer_history_unlocked():
+    topics = Topics()
+    topics.process_batch("foo", [1, 2, 3])
+
+    class FeedingQueue(list):
+        # Samples are received while the history is sent, without waiting for the lock
+        def put(self, item):
+            if not self:
+                thread = threading.Thread(target=topics.process_batch, args=("foo", [4, 5]))
+                thread.start()
+                thread.join(1.0)
+                assert not thread.is_alive()
+            self.append(item)
+
+    q = FeedingQueue()
+    topics.transfer("foo", q)
+    topics.process("foo", 6)
+    xs = [x for item in q[:-1] for x in item[0]] + [q[-1][0]]
+    ys = [y for item in q[:-1] for y in item[1]] + [q[-1][1]]
+    assert xs == [0, 1, 2, 3, 4, 5]
+    assert ys == [1, 2, 3, 4, 5, 6]
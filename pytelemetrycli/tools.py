@@ -1,2 +1,13 @@
 def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
     return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
+
+DURATION_UNITS = (('ms', 0.001), ('s', 1.0), ('m', 60.0), ('h', 3600.0))
+
+def parse_duration(text):
+    # Seconds in a duration like '10s', '500ms', '2m', '1h' or '3.5'. Raises ValueError
+    text = text.strip().lower()
+    # 'ms' is checked before 's' and 'm'
+    for unit, factor in DURATION_UNITS:
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * factor
+    return float(text)
@@ -1,24 +1,307 @@
 from sortedcontainers import SortedDict
+from collections import deque
+from fnmatch import fnmatchcase
+from itertools import chain, islice
 from logging import getLogger
+from pytelemetrycli.storage import Column, SessionStore
+from pytelemetrycli.summary import Summary
+import threading
+import time
+
+# Amount of processed samples between two checks of the memory budget
+BUDGET_CHECK_INTERVAL = 1024
+# Minimum delay between two automatic writes of the session index, in seconds
+SESSION_SYNC_PERIOD = 5.0
+# Samples buffered by a subscription
+SUBSCRIPTION_SIZE = 65536
+# Longest time (s) ingest waits for a full subscription with the 'block' policy
+BLOCK_TIMEOUT = 1.0
+
+class Retention:
+    """
+Retention settings of a session.
+
+`capacity` and `max_age` are the defaults applied to new topics and can
+be overridden per topic. `budget` (bytes) bounds the memory used by all
+linear samples, `policy` selects which topics are evicted first when the
+budget is exceeded : 'oldest' data first, or least recently plotted ('lru').
+    """
+    policies = ('oldest', 'lru')
+
+    def __init__(self, capacity=None, max_age=None, budget=None, policy='oldest'):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.budget = budget
+        self.policy = policy
 
 class Topic:
     """
 A class to store and manage all data under a given topic
+
+Linear samples are stored in a typed `Column`, along with a column of their
+monotonic receive times. Indexed samples only keep the last value received
+for each index. A `Summary` aggregates all the numeric samples received.
+
+Linear samples older than `max_age` seconds, or beyond the `capacity` most
+recent ones, are evicted.
     """
-    def __init__(self, name, source='remote'):
-        self.raw = []
+    def __init__(self, name, source='remote', capacity=None, max_age=None, store=None):
+        # Remote floats are float32 on the wire, store them without loss in 4 bytes
+        float_typecode = 'f' if source == 'remote' else 'd'
+        if store is None:
+            self.raw = Column(float_typecode)
+            self.times = Column('d')
+        else:
+            self.raw = store.column(name, float_typecode)
+            self.times = store.column(name, 'd', part='times')
+            if not len(self.times) and self.times.dropped < self.raw.received():
+                # Session saved without receive times, they start with new samples
+                self.times.dropped = self.raw.received()
         self.indexes = SortedDict()
         self.source = source
         self.name = name
+        self.summary = Summary()
+        # Samples restored from a session store are summarized again
+        for view in self.raw.views():
+            self.summary.extend(list(view))
+        self.last_plotted = 0.0
+        # Set once the retention of the topic was changed on its own, session defaults no longer apply
+        self.overridden = False
+        self.set_retention(capacity, max_age)
+
+    def set_retention(self, capacity=None, max_age=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.evict()
 
     def has_indexed_data(self):
         return len(self.indexes) > 0
 
-    def new_sample(self, sample, options):
+    def new_sample(self, sample, options, now=None):
+        self.summary.add(sample)
         if options:
             self.indexes[options['index']] = sample
-        else:
-            self.raw.append(sample)
+            return
+
+        now = time.monotonic() if now is None else now
+        self.raw.append(sample)
+        self.times.append(now)
+        self.evict(now)
+
+    def new_samples(self, samples, indexes=None, now=None):
+        """
+Adds a batch of samples received at `now`. `indexes` holds the index of
+each sample, or None for linear samples. Returns the list of linear samples.
+        """
+        self.summary.extend(samples)
+        if indexes is not None:
+            linear = []
+            for sample, index in zip(samples, indexes):
+                if index is None:
+                    linear.append(sample)
+                else:
+                    self.indexes[index] = sample
+            samples = linear
+
+        if samples:
+            now = time.monotonic() if now is None else now
+            self.raw.extend(samples)
+            self.times.extend([now] * len(samples))
+            self.evict(now)
+
+        return samples
+
+    def evict(self, now=None):
+        if self.capacity and len(self.raw) > self.capacity:
+            self.drop_to(self.raw.received() - self.capacity)
+
+        if self.max_age:
+            cutoff = (time.monotonic() if now is None else now) - self.max_age
+            first = self.times.first()
+            if first is not None and first < cutoff:
+                self.drop_to(self.times.bisect(cutoff))
+
+    def drop_to(self, position):
+        # Drops the samples before `position`, returns the amount of bytes released
+        released = self.raw.drop(position - self.raw.dropped)
+        released += self.times.drop(position - self.times.dropped)
+        return released
+
+    def drop_chunk(self):
+        # Drops the oldest chunk of samples, returns the amount of bytes released
+        released = self.raw.drop_chunk()
+        released += self.times.drop(self.raw.dropped - self.times.dropped)
+        return released
+
+    def positions(self, since=None, until=None):
+        """
+Returns the range of positions of the linear samples received between
+`since` and `until` (monotonic times, both included), by binary search.
+        """
+        start = self.raw.dropped if since is None else self.times.bisect(since)
+        stop = self.raw.received() if until is None else self.times.bisect(until, right=True)
+        return max(start, self.raw.dropped), max(stop, start)
+
+    def oldest_time(self):
+        first = self.times.first()
+        return time.monotonic() if first is None else first
+
+    def count(self):
+        return len(self.raw)
+
+    def received(self):
+        return self.raw.received()
+
+    def nbytes(self):
+        return self.raw.nbytes() + self.times.nbytes()
+
+class Subscription:
+    """
+Consumer of the samples received under the topics matching `patterns`
+(topic names or globs like imu*), created by `Topics.subscribe()`.
+
+Samples are buffered as batches (topic, payloads, indexes, start) :
+`indexes` holds the index of each sample or None for linear samples, and
+`start` is the position of the first linear sample since the creation of
+the topic. The buffer holds at most `maxsize` samples (up to twice as
+many with 'block'). When it is full :
+  - 'drop-oldest' drops the oldest batches,
+  - 'latest' only keeps the latest sample of each topic,
+  - 'block' keeps the new batches, and the thread feeding the topics
+    waits for the consumer in `Topics.throttle()`, once it released the
+    topics lock, up to `timeout` seconds. After a timeout, the new batches
+    are dropped until the consumer emptied the buffer, so a stalled
+    consumer costs a single timeout. Use it for consumers that must not
+    lose samples and keep up on average, like exports.
+Dropped samples are counted in `dropped`. Other consumers are not affected.
+    """
+    policies = ('drop-oldest', 'latest', 'block')
+
+    def __init__(self, patterns, maxsize=SUBSCRIPTION_SIZE, policy='drop-oldest',
+                 timeout=BLOCK_TIMEOUT, name=None):
+        if not policy in self.policies:
+            raise ValueError("Unknown overflow policy '{0}'".format(policy))
+        self.patterns = [patterns] if isinstance(patterns, str) else list(patterns)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.name = name or ",".join(self.patterns)
+        self.batches = deque()
+        self.size = 0
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+        # Set when the consumer did not make room in time, cleared once it read everything
+        self.stalled = False
+        self.topics = None
+        self.condition = threading.Condition()
+
+    def matches(self, topic):
+        return any(fnmatchcase(topic, pattern) for pattern in self.patterns)
+
+    def put(self, topic, payloads, indexes, start):
+        # Called by the thread feeding the topics
+        n = len(payloads)
+        with self.condition:
+            self.received += n
+            if self.size + n > self.maxsize and self.batches:
+                if self.policy == 'drop-oldest':
+                    while self.batches and self.size + n > self.maxsize:
+                        dropped = len(self.batches.popleft()[1])
+                        self.size -= dropped
+                        self.dropped += dropped
+                elif self.policy == 'latest':
+                    # Samples of the new batch are more recent than the buffered ones
+                    self._coalesce(topic)
+                    if self.size + n > self.maxsize:
+                        self.dropped += n - 1
+                        topic, payloads, indexes, start = self._latest(topic, payloads, indexes, start)
+                        n = 1
+                elif self.stalled or self.size >= 2 * self.maxsize:
+                    # The consumer did not catch up, or the feeding thread does not wait for it
+                    self.dropped += n
+                    return
+            self.batches.append((topic, payloads, indexes, start))
+            self.size += n
+            self.condition.notify_all()
+
+    def wait(self):
+        """
+Waits for the consumer of a full 'block' subscription to make room, up
+to `timeout` seconds. Returns False if it stalled. Must not be called
+with the topics lock held.
+        """
+        if self.policy != 'block':
+            return True
+        with self.condition:
+            if self.stalled:
+                return True
+            if not self.condition.wait_for(lambda: self.size < self.maxsize or self.closed,
+                                           self.timeout):
+                self.stalled = True
+                return False
+        return True
+
+    def congested(self):
+        # True if the feeding thread should wait for the consumer, see `wait()`
+        return self.policy == 'block' and not self.stalled and self.size >= self.maxsize
+
+    def _coalesce(self, topic):
+        # Keeps the latest sample of each topic buffered, and none of `topic`
+        latest = dict()
+        for batch in self.batches:
+            latest.pop(batch[0], None)
+            latest[batch[0]] = batch
+        latest.pop(topic, None)
+
+        self.batches = deque(self._latest(*batch) for batch in latest.values())
+        size = len(self.batches)
+        self.dropped += self.size - size
+        self.size = size
+
+    def _latest(self, topic, payloads, indexes, start):
+        # Batch of the last sample of a batch
+        linear = len(payloads) if indexes is None else indexes.count(None)
+        if indexes is None:
+            return (topic, payloads[-1:], None, start + linear - 1)
+        if indexes[-1] is None:
+            return (topic, payloads[-1:], [None], start + linear - 1)
+        return (topic, payloads[-1:], indexes[-1:], start + linear)
+
+    def get(self, timeout=None):
+        """
+Returns the oldest batch, waiting up to `timeout` seconds (forever if
+None). Returns None on timeout, or once closed and empty.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.batches or self.closed, timeout):
+                return None
+            return self._pop()
+
+    def get_nowait(self):
+        with self.condition:
+            return self._pop()
+
+    def _pop(self):
+        if not self.batches:
+            return None
+        batch = self.batches.popleft()
+        self.size -= len(batch[1])
+        if not self.batches:
+            self.stalled = False
+        self.condition.notify_all()
+        return batch
+
+    def pending(self):
+        return self.size
+
+    def close(self):
+        # Stops receiving samples, the buffered ones can still be read
+        if self.topics is not None:
+            self.topics.unsubscribe(self)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
 class Topics:
     """
@@ -28,97 +311,532 @@ A class that manages a collection of `Topic`s.
     def __init__(self):
         self.logger = getLogger('topics')
         self.logger.info('started session')
+        # Received samples are traced on a separate logger, disabled by default
+        self.trace_logger = getLogger('topics.samples')
+        self.set_trace(0)
+        self.retention = Retention()
+        self.store = None
+        # Held by the runners while they add samples, several connections can share the topics,
+        # and by the readers running on other threads (the command prompt, exports, the server)
+        self.lock = threading.RLock()
+        # Subscriptions outlive clear(), topics created later are matched again
+        self.subscriptions = []
         self.clear()
 
+    def set_trace(self, every):
+        """
+Controls the trace of received samples. 0 disables the trace, 1 traces
+every sample, N traces one sample out of N.
+        """
+        self.trace_every = every
+        self.trace_countdown = 1
+
     def clear(self):
         self.logger.info('Cleared all topics and received data')
+        self.close_store()
         self.topic_list = SortedDict()
         self.transfers = dict()
+        self.subscribers = dict()
+        self.derived = []
+        self.budget_countdown = BUDGET_CHECK_INTERVAL
+
+    def use_store(self, path):
+        """
+Stores the samples of topics created from now on in memory-mapped files
+under the session directory `path`.
+        """
+        self.close_store()
+        self.store = SessionStore(path)
+        self.last_sync = time.monotonic()
+        self.logger.info('session store | {0}'.format(path))
+
+    def open_session(self, path):
+        """
+Replaces all topics with the ones saved in the session directory `path`.
+New samples are appended to the session.
+        """
+        self.clear()
+        self.use_store(path)
+        for name, saved in self.store.topics().items():
+            self.create(name, source=saved['source'])
+            for index, value in saved['indexes']:
+                self.topic_list[name].indexes[index] = value
+        # Receive times were moved to the current clock, save it right away
+        self.sync()
+        self.logger.info('opened session | {0}'.format(path))
+
+    def sync(self):
+        # Writes the index of the session store to disk
+        if self.store is not None:
+            self.store.sync(list(self.topic_list.values()))
+            self.last_sync = time.monotonic()
+
+    def close_store(self):
+        if self.store is not None:
+            self.sync()
+            self.store.close()
+            self.store = None
 
     def create(self, topic, source='remote'):
         # Create the topic if it doesn't exist already
         if not topic in self.topic_list:
-            self.topic_list[topic] = Topic(topic,source=source)
+            self.topic_list[topic] = Topic(topic,source=source,
+                                           capacity=self.retention.capacity,
+                                           max_age=self.retention.max_age,
+                                           store=self.store)
             self.logger.info('new:topic ' + topic)
+            for subscription in self.subscriptions:
+                if subscription.matches(topic):
+                    self.subscribers[topic] = self.subscribers.get(topic, []) + [subscription]
+
+    def set_retention(self, topic=None, capacity=None, max_age=None, budget=None, policy=None):
+        """
+Changes the retention settings. With `topic`, only the capacity and max age
+of that topic are changed. Otherwise, capacity and max age become the
+session defaults and are applied to all existing topics, except the ones
+whose retention was changed on their own.
+        """
+        if topic is not None:
+            self.topic_list[topic].overridden = True
+            self.topic_list[topic].set_retention(capacity, max_age)
+            self.logger.info('retention | {0} capacity={1} max_age={2}'.format(topic, capacity, max_age))
+            return
+
+        if policy is not None:
+            if not policy in Retention.policies:
+                raise ValueError("Unknown eviction policy '{0}'".format(policy))
+            self.retention.policy = policy
+
+        self.retention.capacity = capacity
+        self.retention.max_age = max_age
+        self.retention.budget = budget
+
+        for t in self.topic_list.values():
+            if not t.overridden:
+                t.set_retention(capacity, max_age)
+
+        self.logger.info('retention | capacity={0} max_age={1} budget={2} policy={3}'
+                         .format(capacity, max_age, budget, self.retention.policy))
+        self.enforce_budget()
+
+    def housekeeping(self):
+        # Periodic tasks, run every BUDGET_CHECK_INTERVAL samples
+        self.expire()
+        self.enforce_budget()
+        if self.store is not None and time.monotonic() - self.last_sync > SESSION_SYNC_PERIOD:
+            self.sync()
+
+    def expire(self):
+        # Evicts aged samples, including from topics that stopped receiving data
+        if self.retention.max_age or any(t.max_age for t in self.topic_list.values()):
+            now = time.monotonic()
+            for t in self.topic_list.values():
+                if t.max_age:
+                    t.evict(now)
+
+    def nbytes(self):
+        return sum(t.nbytes() for t in self.topic_list.values())
+
+    def enforce_budget(self):
+        """
+Evicts the oldest chunks of samples, topic after topic, until the memory
+used by all topics fits the budget.
+        """
+        self.budget_countdown = BUDGET_CHECK_INTERVAL
+        budget = self.retention.budget
+        if not budget:
+            return
+
+        total = self.nbytes()
+        if total <= budget:
+            return
+
+        now = time.monotonic()
+        if self.retention.policy == 'lru':
+            def key(t):
+                plotted = now if t.name in self.transfers else t.last_plotted
+                return (plotted, t.oldest_time())
+        else:
+            def key(t):
+                return t.oldest_time()
+
+        for t in sorted(self.topic_list.values(), key=key):
+            evicted = 0
+            # Memory-mapped samples do not count in the budget, keep them
+            while total > budget and t.nbytes() > 0:
+                before = len(t.raw)
+                total -= t.drop_chunk()
+                evicted += before - len(t.raw)
+            if evicted:
+                self.logger.info('evicted | {0} {1} samples'.format(t.name, evicted))
+            if total <= budget:
+                break
+
+    def subscribe(self, patterns, maxsize=SUBSCRIPTION_SIZE, policy='drop-oldest',
+                  timeout=BLOCK_TIMEOUT, name=None):
+        """
+Returns a `Subscription` buffering the samples received from now on under
+the topics matching `patterns`, after they are stored. Any number of
+subscriptions can receive the same topic.
+        """
+        subscription = Subscription(patterns, maxsize, policy, timeout, name)
+        subscription.topics = self
+        # Lists are replaced, not modified, the runner thread reads them without locking
+        self.subscriptions = self.subscriptions + [subscription]
+        for topic in self.topic_list:
+            if subscription.matches(topic):
+                self.subscribers[topic] = self.subscribers.get(topic, []) + [subscription]
+        self.logger.info('subscribe | {0} policy={1}'.format(subscription.name, policy))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+        for topic, subscriptions in list(self.subscribers.items()):
+            remaining = [s for s in subscriptions if s is not subscription]
+            if remaining:
+                self.subscribers[topic] = remaining
+            else:
+                self.subscribers.pop(topic, None)
+
+    def throttle(self):
+        """
+Waits for the consumers of the 'block' subscriptions to keep up, see
+`Subscription`. Called by the threads feeding the topics, once they
+released `lock`.
+        """
+        for subscription in self.subscriptions:
+            if not subscription.wait():
+                self.logger.warning('subscription {0} stalled, its samples are dropped until it catches up'
+                                    .format(subscription.name))
+
+    def congested(self):
+        return any(subscription.congested() for subscription in self.subscriptions)
+
+    def _notify(self, topic, payloads, indexes, linear):
+        start = self.topic_list[topic].received() - linear
+        for subscription in self.subscribers.get(topic, ()):
+            subscription.put(topic, payloads, indexes, start)
+
+    def derive(self, name, expression, on=None):
+        """
+Defines the topic `name`, computed from other topics with `expression`
+(see `Derived`). Its samples are added by `update_derived()`, starting
+with the samples already received. Raises ValueError.
+        """
+        # NumPy is only loaded once needed
+        from pytelemetrycli.derived import Derived
+
+        if name in self.topic_list:
+            raise ValueError("Topic '{0}' already exists".format(name))
+        derived = Derived(name, expression, on)
+        for topic in derived.inputs:
+            if not topic in self.topic_list:
+                raise ValueError("Topic '{0}' unknown".format(topic))
+        self.create(name, source='derived')
+        self.derived.append(derived)
+        self.logger.info('derive | {0} = {1}'.format(name, expression))
+
+    def underive(self, name):
+        # Stops computing the derived topic `name`, its samples are kept
+        self.derived = [d for d in self.derived if d.name != name]
+
+    def update_derived(self, now=None):
+        # Computes the samples of the derived topics from the samples received since the last call
+        for derived in list(self.derived):
+            try:
+                values = derived.update(self.topic_list)
+            except ValueError as e:
+                self.logger.warning('derive | {0} stopped : {1}'.format(derived.name, e))
+                self.underive(derived.name)
+                continue
+            self.process_batch(derived.name, values, now=now)
 
     def process(self, topic, payload, options=None):
         # Create the topic if it doesn't exist already
         self.create(topic)
 
         # Add the new sample
-        self.topic_list[topic].new_sample(payload,options)
+        now = time.monotonic()
+        self.topic_list[topic].new_sample(payload,options,now)
 
-        # logging
-        if options:
-            self.logger.debug('new sample | {0} [{1}] {2}'.format(topic, options['index'], payload))
-        else:
-            self.logger.debug('new sample | {0} {1}'.format(topic, payload))
+        if topic in self.subscribers:
+            if options:
+                self._notify(topic, [payload], [options['index']], 0)
+            else:
+                self._notify(topic, [payload], None, 1)
+
+        self.budget_countdown -= 1
+        if self.budget_countdown <= 0:
+            self.housekeeping()
+
+        if self.trace_every:
+            self.trace_countdown -= 1
+            if self.trace_countdown <= 0:
+                self.trace_countdown = self.trace_every
+                if options:
+                    self.trace_logger.debug('new sample | %s [%s] %s', topic, options['index'], payload)
+                else:
+                    self.trace_logger.debug('new sample | %s %s', topic, payload)
 
-        # If there is an active transfer, transfer received data to the queue
-        if topic in self.transfers:
+        # Transfer received data to the queues of the active transfers
+        for transfer in self.transfers.get(topic, ()):
             # If transfer requires indexed data, check there is an index
-            if self.transfers[topic]['type'] == 'indexed' and options is not None:
+            if transfer['type'] == 'indexed' and options is not None:
                 x = options['index']
-                self.transfers[topic]['queue'].put([x, payload])
+                transfer['queue'].put([x, payload])
             # For linear data, provide sample id for x and payload for y
-            elif self.transfers[topic]['type'] == 'linear':
-                x = self.transfers[topic]['lastindex']
-                self.transfers[topic]['queue'].put([x, payload])
-                self.transfers[topic]['lastindex'] += 1
+            elif transfer['type'] == 'linear' and options is None:
+                x = transfer['lastindex']
+                transfer['queue'].put([x, payload])
+                transfer['lastindex'] += 1
+            # For time based plots, x is the receive time
+            elif transfer['type'] == 'time' and options is None:
+                transfer['queue'].put([now - transfer['origin'], payload])
 
-    def ls(self,source='remote'):
-        if source is None:
-            return sorted([t.name for t in self.topic_list.keys()])
+    def process_batch(self, topic, payloads, indexes=None, now=None):
+        """
+Processes a batch of samples received under the same topic, at `now`.
+`indexes` holds the index of each indexed sample and None for linear
+samples. It can be None if the batch only contains linear samples.
+Active transfers receive a single [xs, ys] message for the whole batch.
+        """
+        if not payloads:
+            return
+
+        self.create(topic)
+
+        if indexes is not None and indexes.count(None) == len(indexes):
+            indexes = None
+
+        now = time.monotonic() if now is None else now
+        linear = self.topic_list[topic].new_samples(payloads, indexes, now)
+
+        if topic in self.subscribers:
+            self._notify(topic, payloads, indexes, len(linear))
+
+        self.budget_countdown -= len(payloads)
+        if self.budget_countdown <= 0:
+            self.housekeeping()
+
+        if self.trace_every:
+            self._trace_batch(topic, payloads, indexes)
+
+        for transfer in self.transfers.get(topic, ()):
+            if transfer['type'] == 'indexed' and indexes is not None:
+                xs = []
+                ys = []
+                for payload, index in zip(payloads, indexes):
+                    if index is not None:
+                        xs.append(index)
+                        ys.append(payload)
+                transfer['queue'].put([xs, ys])
+            elif transfer['type'] == 'linear' and linear:
+                x = transfer['lastindex']
+                transfer['queue'].put([list(range(x, x + len(linear))), linear])
+                transfer['lastindex'] += len(linear)
+            elif transfer['type'] == 'time' and linear:
+                transfer['queue'].put([[now - transfer['origin']] * len(linear), linear])
+
+    def _trace_batch(self, topic, payloads, indexes):
+        # Traces the samples of the batch picked by the 1 out of N sampling
+        every = self.trace_every
+        start = self.trace_countdown - 1
+        if start >= len(payloads):
+            self.trace_countdown -= len(payloads)
+            return
+
+        picked = payloads[start::every]
+        last = start + (len(picked) - 1) * every
+        self.trace_countdown = every - (len(payloads) - 1 - last)
+
+        if indexes is None:
+            self.trace_logger.debug('new samples | %s %s', topic, picked)
         else:
-            return sorted([t.name for t in self.topic_list.values() if t.source == source])
+            self.trace_logger.debug('new samples | %s %s %s', topic, indexes[start::every], picked)
+
+    def ls(self,source='remote'):
+        with self.lock:
+            if source is None:
+                return sorted(self.topic_list.keys())
+            else:
+                return sorted([t.name for t in self.topic_list.values() if t.source == source])
+
+    def samples(self,topic,amount=1,since=None,until=None):
+        """
+Returns the `amount` last linear samples of `topic`, all of them if
+`amount` is 0. With `since` and/or `until` (monotonic times, see
+`time.monotonic()`), returns the samples received in that time range.
+        """
+        with self.lock:
+            if not topic in self.topic_list:
+                return None
+
+            t = self.topic_list[topic]
+            if since is not None or until is not None:
+                start, stop = t.positions(since, until)
+                return t.raw.tolist(start - t.raw.dropped, stop - t.raw.dropped)
+
+            if amount == 0 or amount is None:
+                return t.raw.tolist()
 
-    def samples(self,topic,amount=1):
+            return t.raw.tolist(-amount)
+
+    def timestamps(self,topic,since=None,until=None):
+        # Receive times of the linear samples returned by samples(topic, since=, until=)
+        with self.lock:
+            if not topic in self.topic_list:
+                return None
+
+            t = self.topic_list[topic]
+            start, stop = t.positions(since, until)
+            return t.times.tolist(start - t.times.dropped, stop - t.times.dropped)
+
+    def summary(self,topic):
+        # Running aggregates of all numeric samples received under `topic`
         if not topic in self.topic_list:
             return None
 
-        if amount == 0 or amount is None:
-            return self.topic_list[topic].raw
+        return self.topic_list[topic].summary
+
+    def views(self,topic,start=0,stop=None):
+        # Zero-copy access to the stored samples, one view per storage chunk
+        with self.lock:
+            if not topic in self.topic_list:
+                return []
 
-        return self.topic_list[topic].raw[-amount:]
+            # Views are taken at once, the chunks may be evicted while they are read
+            return list(self.topic_list[topic].raw.views(start,stop))
 
     def count(self,topic):
+        # Amount of retained samples
+        if not topic in self.topic_list:
+            return 0
+
+        return self.topic_list[topic].count()
+
+    def received(self,topic):
+        # Amount of received samples, including evicted ones
         if not topic in self.topic_list:
             return 0
 
-        return len(self.topic_list[topic].raw)
+        return self.topic_list[topic].received()
 
     def exists(self,topic):
         return topic in self.topic_list
 
-    def transfer(self, topic, queue, transfer_type = "linear"):
-        # If the topic data is not already transfered to some queue
-        if not topic in self.transfers:
-            self.transfers[topic] = dict()
-            self.transfers[topic]['queue'] = queue
-            self.transfers[topic]['lastindex'] = 0
-            self.transfers[topic]['type'] = transfer_type
-
-            self.logger.info('start transfer | {0}'.format(topic))
-
-            # If there is already existing data under the topic
-            if topic in self.topic_list:
-                if transfer_type == 'indexed':
-                    for key, value in self.topic_list[topic].indexes.iteritems():
-                        queue.put([key, value])
-                elif transfer_type == 'linear':
-                    for item in self.topic_list[topic].raw:
-                        queue.put([self.transfers[topic]['lastindex'], item])
-                        self.transfers[topic]['lastindex'] += 1
-
-    def untransfer(self,topic):
-        # If the topic data is already transfered to some queue
-        if topic in self.transfers:
-            # Remove it from the transfer list
-            del self.transfers[topic]
-            self.logger.info('stop transfer | {0}'.format(topic))
-
-    def intransfer(self,topic):
-        return topic in self.transfers
+    def transfer(self, topic, queue, transfer_type = "linear", owner=None):
+        """
+Sends the samples of `topic`, the ones already received then the new ones,
+to `queue`. Received samples are sent as [xs, ys] batches, one per storage
+chunk, new ones as they arrive. Several transfers can send the same topic,
+`owner` (the queue by default) identifies the transfer in `untransfer()`.
+        """
+        owner = queue if owner is None else owner
+        transfer = dict()
+        transfer['queue'] = queue
+        transfer['owner'] = owner
+        transfer['lastindex'] = 0
+        transfer['type'] = transfer_type
+        # Time based transfers send the receive time relative to now
+        transfer['origin'] = time.monotonic()
+
+        # Only the chunks are taken under the lock, the runners keep storing samples meanwhile
+        with self.lock:
+            if self.intransfer(topic, owner):
+                return
+            history = self._history(topic, transfer_type)
+
+        sent = self._send_history(history, transfer)
+
+        # Then the samples received while sending, and the new ones
+        with self.lock:
+            if self.intransfer(topic, owner):
+                return
+            self._send_history(self._history(topic, transfer_type, sent), transfer)
+            # Lists are replaced, not modified, the runner thread reads them without locking
+            self.transfers[topic] = self.transfers.get(topic, []) + [transfer]
+
+        self.logger.info('start transfer | {0}'.format(topic))
+
+    def _history(self, topic, transfer_type, since=None):
+        """
+Takes the stored samples of `topic` to send to a new transfer, received
+after the position `since` (or the indexes set since the `since` copy)
+when called again. Called with the lock held.
+        """
+        t = self.topic_list.get(topic)
+        if t is None:
+            return None
+        if transfer_type == 'indexed':
+            if since is None:
+                return dict(t.indexes)
+            # Indexes set while sending the first copy
+            return dict((key, value) for key, value in t.indexes.items() if since.get(key) is not value)
+
+        start = max(t.raw.dropped, 0 if since is None else since)
+        stop = t.raw.received()
+        values = list(t.raw.views(start - t.raw.dropped, stop - t.raw.dropped))
+        if transfer_type != 'time':
+            return (stop, values, None)
+        # Samples without receive time are not sent
+        skip = max(t.times.dropped - start, 0)
+        times = list(t.times.views(start + skip - t.times.dropped, stop - t.times.dropped))
+        return (stop, values, (skip, times))
+
+    def _send_history(self, history, transfer):
+        # Sends samples taken by `_history()`, returns what to pass it as `since` next
+        if history is None:
+            return None
+        queue = transfer['queue']
+        if transfer['type'] == 'indexed':
+            if history:
+                queue.put([list(history.keys()), list(history.values())])
+            return history
+
+        stop, values, times = history
+        if times is None:
+            for view in values:
+                ys = list(view)
+                if ys:
+                    x = transfer['lastindex']
+                    queue.put([list(range(x, x + len(ys))), ys])
+                    transfer['lastindex'] += len(ys)
+            return stop
+
+        skip, times = times
+        origin = transfer['origin']
+        received = chain.from_iterable(times)
+        for view in values:
+            ys = list(view)
+            if skip:
+                dropped = min(skip, len(ys))
+                ys = ys[dropped:]
+                skip -= dropped
+            if ys:
+                queue.put([[t - origin for t in islice(received, len(ys))], ys])
+        return stop
+
+    def untransfer(self,topic,owner=None):
+        # Stops the transfer of `topic` to `owner`, or all its transfers
+        with self.lock:
+            transfers = self.transfers.get(topic)
+            if transfers is None:
+                return
+            remaining = [t for t in transfers if owner is not None and t['owner'] is not owner]
+            if remaining:
+                self.transfers[topic] = remaining
+            else:
+                del self.transfers[topic]
+            if len(remaining) < len(transfers):
+                if topic in self.topic_list:
+                    self.topic_list[topic].last_plotted = time.monotonic()
+                self.logger.info('stop transfer | {0}'.format(topic))
+
+    def intransfer(self,topic,owner=None):
+        transfers = self.transfers.get(topic, ())
+        if owner is None:
+            return len(transfers) > 0
+        return any(t['owner'] is owner for t in transfers)
 
     def has_indexed_data(self,topic):
         return self.topic_list[topic].has_indexed_data()
@@ -0,0 +1,266 @@
+import numpy as np
+import threading
+import time
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+# Most samples waiting to be received by a plot, per graph window for queues
+# and per topic for shared memory rings
+PLOT_CAPACITY = 1 << 18
+
+class SharedRing:
+    """
+Single producer, single consumer ring buffer of (x, y) samples in shared
+memory, used as an alternative to a multiprocessing Queue to send plot data.
+
+The memory holds a header followed by the x and y float64 columns. The
+producer writes the samples, then publishes the new total amount of
+written samples in the header. The consumer reads the range written since
+its last read as numpy views, without locking and without pickling.
+If the producer gets more than `capacity` samples ahead of the consumer,
+the oldest samples are lost and counted in `lost`.
+    """
+    HEADER = 8 # bytes, int64 amount of samples written since creation
+
+    def __init__(self, capacity=PLOT_CAPACITY, name=None):
+        if shared_memory is None:
+            raise RuntimeError("Shared memory channels require python 3.8+")
+
+        self.capacity = capacity
+        self.owner = name is None
+        size = self.HEADER + 2 * 8 * capacity
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # The creating process is responsible for unlinking the memory
+            try:
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            except Exception:
+                pass
+
+        buf = self.shm.buf
+        self.written = np.ndarray((1,), dtype=np.int64, buffer=buf)
+        self.x = np.ndarray((capacity,), dtype=np.float64, buffer=buf, offset=self.HEADER)
+        self.y = np.ndarray((capacity,), dtype=np.float64, buffer=buf,
+                            offset=self.HEADER + 8 * capacity)
+        if self.owner:
+            self.written[0] = 0
+
+        self.read_index = 0
+        self.lost = 0
+        self.rejected = 0
+        self.closed = False
+
+    def __reduce__(self):
+        # Processes attach to the same memory by name instead of copying it
+        return (SharedRing, (self.capacity, self.shm.name))
+
+    def put(self, item):
+        """
+Writes a single [x, y] sample or a batch of samples [xs, ys].
+Samples put once closed are ignored.
+        """
+        if self.closed:
+            return
+        xs, ys = item
+        try:
+            if isinstance(xs, list):
+                xs = np.asarray(xs, dtype=np.float64)
+                ys = np.asarray(ys, dtype=np.float64)
+            else:
+                xs = np.array((xs,), dtype=np.float64)
+                ys = np.array((ys,), dtype=np.float64)
+        except (TypeError, ValueError):
+            # Non numeric samples (strings) cannot be plotted
+            self.rejected += len(xs) if isinstance(xs, list) else 1
+            return
+
+        n = len(xs)
+        written = int(self.written[0])
+        if n > self.capacity:
+            # Only the last `capacity` samples would survive anyway
+            written += n - self.capacity
+            xs = xs[-self.capacity:]
+            ys = ys[-self.capacity:]
+            n = self.capacity
+
+        start = written % self.capacity
+        first = min(n, self.capacity - start)
+        self.x[start:start + first] = xs[:first]
+        self.y[start:start + first] = ys[:first]
+        if first < n:
+            self.x[:n - first] = xs[first:]
+            self.y[:n - first] = ys[first:]
+
+        # Publish the samples once they are fully written
+        self.written[0] = written + n
+
+    def qsize(self):
+        return int(self.written[0]) - self.read_index
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def read(self):
+        """
+Returns the samples written since the last read as a list of (xs, ys)
+numpy views (two of them when the range wraps around the ring).
+Views stay valid until the producer writes `capacity` more samples.
+        """
+        written = int(self.written[0])
+        start = self.read_index
+        if written - start > self.capacity:
+            self.lost += written - self.capacity - start
+            start = written - self.capacity
+        self.read_index = written
+
+        if start == written:
+            return []
+
+        begin = start % self.capacity
+        end = written % self.capacity
+        if begin < end:
+            return [(self.x[begin:end], self.y[begin:end])]
+        segments = [(self.x[begin:], self.y[begin:])]
+        if end > 0:
+            segments.append((self.x[:end], self.y[:end]))
+        return segments
+
+    def close(self):
+        # Views on the memory must be released before closing it
+        self.closed = True
+        del self.written, self.x, self.y
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def _size(item):
+    # Amount of samples of a [x, y] sample or a [xs, ys] batch
+    return len(item[0]) if isinstance(item[0], list) else 1
+
+class PlotFeed:
+    """
+Bounded channel sending the samples of all the topics of a graph window to
+the plot process, over a single multiprocessing Queue.
+
+At most `capacity` samples are sent and not received yet by the plot, which
+counts the samples it receives in the shared value `consumed`. When the
+plot falls behind, new samples are held back in a backlog per topic, then
+sent as a single batch as soon as the plot catches up (see `flush()`).
+A backlog holds at most `capacity` samples, beyond that :
+  - 'decimate' keeps every other sample, the curve keeps its shape with a
+    lower resolution,
+  - 'drop' drops the oldest samples, the curve shows a gap.
+Skipped samples are counted and sent along with the next batch of their
+topic. Items are sent as (key, item, time, skipped).
+    """
+    policies = ('decimate', 'drop')
+
+    def __init__(self, queue, consumed, capacity=PLOT_CAPACITY, policy='decimate'):
+        if not policy in self.policies:
+            raise ValueError("Unknown overflow policy '{0}'".format(policy))
+        self.queue = queue
+        self.consumed = consumed
+        self.capacity = capacity
+        self.policy = policy
+        self.sent = 0
+        self.skipped = 0
+        # key -> [xs, ys, skipped, time of the oldest sample]
+        self.backlog = dict()
+        # Topics can be fed from several threads (runners, history of new transfers)
+        self.lock = threading.Lock()
+
+    def in_flight(self):
+        return self.sent - self.consumed.value
+
+    def depth(self):
+        # Samples not received by the plot yet, sent or held back
+        return self.in_flight() + sum(len(b[0]) for b in list(self.backlog.values()))
+
+    def put(self, key, item):
+        n = _size(item)
+        with self.lock:
+            if not key in self.backlog and self.in_flight() + n <= self.capacity:
+                self._send(key, item, n, time.monotonic(), 0)
+                return
+            self._defer(key, item)
+            self._flush()
+
+    def flush(self):
+        # Sends what the plot has room for, called periodically by the thread feeding the topics
+        if not self.backlog:
+            return
+        with self.lock:
+            self._flush()
+
+    def discard(self, key):
+        # Drops the backlog of a removed topic
+        with self.lock:
+            self.backlog.pop(key, None)
+
+    def _send(self, key, item, n, stamp, skipped):
+        self.queue.put((key, item, stamp, skipped))
+        self.sent += n
+
+    def _defer(self, key, item):
+        entry = self.backlog.get(key)
+        if entry is None:
+            entry = self.backlog[key] = [[], [], 0, time.monotonic()]
+        xs, ys = entry[0], entry[1]
+        if isinstance(item[0], list):
+            xs.extend(item[0])
+            ys.extend(item[1])
+        else:
+            xs.append(item[0])
+            ys.append(item[1])
+
+        size = len(xs)
+        if size <= self.capacity:
+            return
+        if self.policy == 'drop':
+            del xs[:size - self.capacity]
+            del ys[:size - self.capacity]
+        else:
+            while len(xs) > self.capacity:
+                # Every other sample, down to the latest one
+                first = (len(xs) - 1) % 2
+                xs[:] = xs[first::2]
+                ys[:] = ys[first::2]
+        skipped = size - len(xs)
+        entry[2] += skipped
+        self.skipped += skipped
+
+    def _flush(self):
+        for key in list(self.backlog):
+            room = self.capacity - self.in_flight()
+            if room <= 0:
+                return
+            xs, ys, skipped, stamp = self.backlog.pop(key)
+            if len(xs) <= room:
+                self._send(key, [xs, ys], len(xs), stamp, skipped)
+            else:
+                self._send(key, [xs[:room], ys[:room]], room, stamp, skipped)
+                # Other topics get the room first next time
+                self.backlog[key] = [xs[room:], ys[room:], 0, stamp]
+
+class TaggedQueue:
+    """
+Data channel of a single topic over the `PlotFeed` of its graph window.
+Items are tagged with the key of the topic so the receiving side can
+dispatch them.
+    """
+    def __init__(self, feed, key):
+        self.feed = feed
+        self.key = key
+
+    def put(self, item):
+        self.feed.put(self.key, item)
+
+    def close(self):
+        # The shared queue is closed by its owner
+        self.feed.discard(self.key)
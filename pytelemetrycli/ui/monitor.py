@@ -0,0 +1,113 @@
+from collections import deque
+from logging import getLogger
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+import threading
+
+logger = getLogger('cli')
+
+class PlotMonitor:
+    """
+Keeps track of the opened graph windows and detects when they close.
+
+A dedicated thread blocks on the control pipes of all the plots at once
+with `multiprocessing.connection.wait`, so detecting a closed window costs
+nothing to the ingest loop.
+
+The registry is only modified by the monitor thread. `add()` hands new
+plots over through a deque and wakes the thread up. Readers get the
+current list, which is replaced instead of modified, without locking.
+Closed plots are queued until `release_closed()` is called from the thread
+feeding the topics, so transfers are stopped where they are used.
+    """
+    def __init__(self):
+        self.entries = []
+        self.pending = deque()
+        self.closed = deque()
+        self.wakeup_reader, self.wakeup_writer = Pipe(duplex=False)
+        self.running = False
+        self.thread = None
+
+    def add(self, entry):
+        """
+Registers a plot. `entry` is a dict holding at least the `plot` and
+its control pipe `ctrl`.
+        """
+        self.pending.append(entry)
+        if not self.running:
+            self.start()
+        self.wakeup_writer.send(None)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup_writer.send(None)
+        self.thread.join()
+
+    def plots(self):
+        # Snapshot of the opened plots, including the ones being registered
+        entries = list(self.entries)
+        for entry in list(self.pending):
+            if entry not in entries:
+                entries.append(entry)
+        return entries
+
+    def find(self, key, value):
+        for entry in self.plots():
+            if entry.get(key) == value:
+                return entry
+        return None
+
+    def run(self):
+        while self.running:
+            conns = [entry['ctrl'] for entry in self.entries]
+            ready = wait(conns + [self.wakeup_reader])
+
+            for conn in ready:
+                if conn is self.wakeup_reader:
+                    self.wakeup_reader.recv()
+                    continue
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    msg = "closing" # Plot process died
+                if msg == "closing":
+                    self._closing(conn)
+                elif isinstance(msg, tuple) and msg[0] == "stats":
+                    self._stats(conn, msg[1])
+
+            while self.pending:
+                self.entries = self.entries + [self.pending[0]]
+                self.pending.popleft()
+
+    def _closing(self, conn):
+        for entry in self.entries:
+            if entry['ctrl'] is conn:
+                self.entries = [e for e in self.entries if e is not entry]
+                conn.close()
+                self.closed.append(entry)
+                logger.info("Plot closed.")
+                return
+
+    def _stats(self, conn, stats):
+        # Latest figures reported by the plot process
+        for entry in self.entries:
+            if entry['ctrl'] is conn:
+                entry['stats'] = stats
+
+    def release_closed(self, topics):
+        """
+Stops the transfers of the closed plots and releases their data channels.
+        """
+        while self.closed:
+            plot = self.closed.popleft()['plot']
+            for topic in plot.channels:
+                topics.untransfer(topic, plot)
+            # No more data will be sent, release the data channels
+            plot.release()
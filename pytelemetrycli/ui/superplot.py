@@ -2,84 +2,447 @@
 from pyqtgraph.Qt import QtGui, QtCore
 import numpy as np
 import pyqtgraph as pg
-from multiprocessing import Process, Queue, Pipe
+from multiprocessing import Process, Queue, Pipe, Value
 import time, threading
-from sortedcontainers import SortedDict
 from enum import Enum
+from pytelemetrycli.ui.channels import SharedRing, TaggedQueue, PlotFeed, PLOT_CAPACITY
+
+# Period (s) at which the plot process reports its lag to the main process
+STATS_PERIOD = 1.0
 
 class PlotType(Enum):
     linear = 0,
     indexed = 1
 
-class Superplot():
+class GrowableBuffer:
     """
-Self-contained plotting class that runs in its own process.
-Plotting functionality (reset the graph, .. ?) can be controlled
-by issuing message-based commands using a multiprocessing Pipe
+A preallocated numpy array that doubles its capacity when full, so that
+appending n samples costs amortized O(n).
+    """
+    def __init__(self, capacity=1024, dtype=np.float64):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, values):
+        n = len(values)
+        if self.size + n > len(self.data):
+            capacity = max(2 * len(self.data), self.size + n)
+            data = np.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:self.size + n] = values
+        self.size += n
+
+    def values(self):
+        # View on the stored samples, valid until the next extend
+        return self.data[:self.size]
+
+class MinMaxPyramid:
+    """
+Level-of-detail decimation of a linear curve with increasing x.
+Level k holds the min and max of the samples of each bin of FACTOR**k
+samples. Levels are extended incrementally with the bins completed since
+the last update. Rendering picks the coarsest level that still draws
+about 2 points per pixel, so spikes stay visible at any zoom level.
+    """
+    FACTOR = 4
+
+    def __init__(self, x, y):
+        # GrowableBuffers of the curve
+        self.x = x
+        self.y = y
+        self.levels = []
+
+    def update(self):
+        mins = maxs = self.y.values()
+        k = 0
+        while len(mins) >= self.FACTOR:
+            if len(self.levels) <= k:
+                self.levels.append((GrowableBuffer(), GrowableBuffer()))
+            level_mins, level_maxs = self.levels[k]
+
+            done = len(level_mins) * self.FACTOR
+            complete = len(mins) // self.FACTOR * self.FACTOR
+            if complete > done:
+                level_mins.extend(mins[done:complete].reshape(-1, self.FACTOR).min(axis=1))
+                level_maxs.extend(maxs[done:complete].reshape(-1, self.FACTOR).max(axis=1))
+
+            mins = level_mins.values()
+            maxs = level_maxs.values()
+            k += 1
+
+    def render(self, x0=None, x1=None, width=1000):
+        """
+Returns the (x, y) arrays to draw for the x range [x0, x1] on `width` pixels.
+        """
+        xs = self.x.values()
+        ys = self.y.values()
+        n = len(xs)
+
+        # Visible samples, with one more on each side to connect the curve
+        i0 = 0 if x0 is None else max(int(np.searchsorted(xs, x0)) - 1, 0)
+        i1 = n if x1 is None else min(int(np.searchsorted(xs, x1, side='right')) + 1, n)
+        visible = i1 - i0
+
+        level = 0
+        while level < len(self.levels) and visible / self.FACTOR ** level > width:
+            level += 1
+
+        if level == 0:
+            return xs[i0:i1], ys[i0:i1]
 
+        size = self.FACTOR ** level
+        mins, maxs = self.levels[level - 1]
+        b0 = i0 // size
+        b1 = min(-(-i1 // size), len(mins))
+        nb = max(b1 - b0, 0)
+
+        # Each bin is drawn from (first x, min) to (last x, max)
+        x = np.empty(2 * nb + 2)
+        y = np.empty(2 * nb + 2)
+        x[0:2 * nb:2] = xs[b0 * size:b1 * size:size]
+        x[1:2 * nb:2] = xs[b0 * size + size - 1:b1 * size:size]
+        y[0:2 * nb:2] = mins.values()[b0:b1]
+        y[1:2 * nb:2] = maxs.values()[b0:b1]
+
+        # Samples after the last complete bin are summarized on the fly
+        tail = max(b1 * size, i0)
+        if tail < i1:
+            x[2 * nb] = xs[tail]
+            x[2 * nb + 1] = xs[i1 - 1]
+            y[2 * nb] = ys[tail:i1].min()
+            y[2 * nb + 1] = ys[tail:i1].max()
+            return x, y
+        return x[:2 * nb], y[:2 * nb]
+
+class IndexedBuffer:
+    """
+Dense storage of indexed samples : the value of index i is stored at
+position i - base, with a validity mask for indexes not received yet.
+    """
+    def __init__(self, capacity=1024):
+        self.base = None
+        self.span = 0
+        self.y = np.zeros(capacity, dtype=np.float64)
+        self.valid = np.zeros(capacity, dtype=bool)
+
+    def _reserve(self, front, span):
+        # Makes room for `front` new positions before the current ones and a total of `span` positions
+        capacity = len(self.y)
+        if front == 0 and span <= capacity:
+            return
+        capacity = max(2 * capacity, span)
+        y = np.zeros(capacity, dtype=np.float64)
+        valid = np.zeros(capacity, dtype=bool)
+        y[front:front + self.span] = self.y[:self.span]
+        valid[front:front + self.span] = self.valid[:self.span]
+        self.y = y
+        self.valid = valid
+
+    def update(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.int64)
+        if len(xs) == 0:
+            return
+        low = int(xs.min())
+        high = int(xs.max())
+        if self.base is None:
+            self.base = low
+
+        front = max(self.base - low, 0)
+        span = max(self.span + front, high - min(self.base, low) + 1)
+        self._reserve(front, span)
+        self.base -= front
+        self.span = span
+
+        positions = xs - self.base
+        self.y[positions] = ys
+        self.valid[positions] = True
+
+    def values(self):
+        valid = self.valid[:self.span]
+        if self.base is None:
+            return np.empty(0), np.empty(0)
+        return np.flatnonzero(valid) + self.base, self.y[:self.span][valid]
+
+class Curve:
+    """
+Data and graphics item of one topic displayed in a `Superplot`.
     """
-    def __init__(self,name,plottype=PlotType.indexed):
+    def __init__(self, name, plottype=PlotType.linear, channel=None):
         self.name = name
         self.plottype = plottype
-        self._clear()
+        # SharedRing the curve reads from, None if data comes from the plot queue
+        self.channel = channel
+        self.plot = None
+        self.item = None
+        self.clear()
 
-    def _clear(self):
+    def clear(self):
         # Process-local buffers used to host the displayed data
         if self.plottype == PlotType.linear:
-            self.set = True
-            self.x = []
-            self.y = []
+            self.x = GrowableBuffer()
+            self.y = GrowableBuffer()
+            self.pyramid = MinMaxPyramid(self.x, self.y)
+        else:
+            self.xy = IndexedBuffer()
+        self.pending_x = []
+        self.pending_y = []
+        self.dirty = True
+        # Samples skipped by the main process while the plot was behind
+        self.skipped = 0
+
+    def put(self, item):
+        # Single samples [x, y] are grouped until the next batch [xs, ys] or flush
+        if isinstance(item[0], list):
+            self.flush()
+            self.add(item[0], item[1])
+        else:
+            self.pending_x.append(item[0])
+            self.pending_y.append(item[1])
+
+    def flush(self):
+        if self.pending_x:
+            self.add(self.pending_x, self.pending_y)
+            self.pending_x = []
+            self.pending_y = []
+
+    def receive(self):
+        # Reads the shared memory channel, if any
+        if self.channel is not None:
+            for xs, ys in self.channel.read():
+                self.add(xs, ys)
+
+    def add(self, xs, ys):
+        # Only the received samples are converted to numpy
+        if self.plottype == PlotType.linear:
+            self.x.extend(xs)
+            self.y.extend(ys)
         else:
-            self.xy = SortedDict()
-            # TODO : use this optimization, but for now raises issue
-            # Can't pickle dict_key views ??
-            #self.x = self.xy.keys()
-            #self.y = self.xy.values()
-            self.set = False
+            self.xy.update(xs, ys)
+        self.dirty = True
+
+    def view(self):
+        # Visible x range and its width in pixels
+        if self.plot is None:
+            return None, None, 1000
+        viewbox = self.plot.getViewBox()
+        x0, x1 = viewbox.viewRange()[0]
+        return x0, x1, max(int(viewbox.width()), 1)
+
+    def redraw(self):
+        # Refresh plot data, only if something changed
+        if not self.dirty:
+            return
+        self.dirty = False
+        if self.plottype == PlotType.linear:
+            self.pyramid.update()
+            self.item.setData(*self.pyramid.render(*self.view()))
+        else:
+            self.item.setData(*self.xy.values())
+
+    def on_range_changed(self, *args):
+        # Zoom and pan require picking another level of detail
+        self.dirty = True
+
+class Superplot():
+    """
+Self-contained plotting class that runs in its own process.
+Plotting functionality (reset the graph, .. ?) can be controlled
+by issuing message-based commands using a multiprocessing Pipe
+
+A single window displays several topics, added and removed with
+`add_curve` and `remove_curve`, either on the same plot or in stacked
+subplots sharing the x axis (layout='stack').
+
+Data is received either through a single multiprocessing Queue shared by
+all topics (channel='queue', see `PlotFeed`), each item being tagged with
+the key of its topic, or through one shared memory ring buffer per topic
+(channel='shm', see `SharedRing`). Either way, at most `capacity` samples
+wait to be received. When the plot falls behind, the samples it could not
+receive in time are skipped (decimated or dropped, following `overflow`)
+and their amount is displayed in the window title, with the lag.
+
+    """
+    def __init__(self,name,channel='queue',layout='shared',capacity=PLOT_CAPACITY,overflow='decimate'):
+        self.name = name
+        self.channel = channel
+        self.layout = layout
+        self.capacity = capacity
+        self.overflow = overflow
+        # Main process side : topic -> (key, data channel)
+        self.channels = dict()
+        self.next_key = 0
+        # Plot process side : key -> Curve
+        self.curves = dict()
+        # Longest time (s) a received item waited in the queue since last report
+        self.lag = None
+        self.last_stats = time.monotonic()
 
     def start(self):
         # The queue that will be used to transfer data from the main process
         # to the plot
         self.q = Queue()
-        main_pipe, self.in_process_pipe = Pipe()
+        # Amount of samples received by the plot process
+        self.consumed = Value('q', 0, lock=False)
+        self.feed = PlotFeed(self.q, self.consumed, self.capacity, self.overflow)
+        self.ctrl, self.in_process_pipe = Pipe()
         self.p = Process(target=self.run)
         self.p.start()
         # Return a handle to the data queue and the control pipe
-        return self.q, main_pipe
+        return self.q, self.ctrl
+
+    def __getstate__(self):
+        # The feed is the main process side of the queue
+        state = self.__dict__.copy()
+        state.pop('feed', None)
+        return state
 
     def join(self):
         self.p.join()
 
-    def _update(self):
-        # Empty data queue and process received data
+    def add_curve(self, topic, plottype=PlotType.linear):
+        """
+Adds a curve for `topic` to the running plot. Returns the data channel to
+send its samples to (anything with a `put` method, see `Topics.transfer`).
+        """
+        key = self.next_key
+        self.next_key += 1
+        if self.channel == 'shm':
+            channel = SharedRing(self.capacity)
+            self.ctrl.send(("add", key, topic, plottype, channel))
+        else:
+            channel = TaggedQueue(self.feed, key)
+            self.ctrl.send(("add", key, topic, plottype, None))
+        self.channels[topic] = (key, channel)
+        return channel
+
+    def remove_curve(self, topic):
+        key, channel = self.channels.pop(topic)
+        try:
+            self.ctrl.send(("remove", key))
+        except (IOError, OSError):
+            pass # Plot already closed
+        channel.close()
+
+    def depth(self):
+        # Amount of samples sent to the plot and not received yet
+        if self.channel == 'shm':
+            return sum(channel.qsize() for key, channel in self.channels.values())
+        return self.feed.depth()
+
+    def flush(self):
+        # Sends the samples held back while the plot was behind
+        self.feed.flush()
+
+    def release(self):
+        # Closes all data channels, once the plot process is done
+        for key, channel in self.channels.values():
+            channel.close()
+        self.channels = dict()
+        self.q.close()
+
+    def _receive(self):
+        # Dispatches all items received since the last update to their curve
+        now = time.monotonic()
         while not self.q.empty():
-            item = self.q.get()
-            if self.plottype == PlotType.linear:
-                self.x.append(item[0])
-                self.y.append(item[1])
-            else:
-                # Seems pretty slow,
-                # TODO : Profile
-                # TODO : Eventually, need to find high performance alternative. Maybe numpy based
-                self.xy[item[0]] = item[1]
-
-        # Initialize view on data dictionnary only once for increased performance
-        if not self.set:
-            self.set = True
-            self.x = self.xy.keys()
-            self.y = self.xy.values()
-
-        # Refresh plot data
-        self.curve.setData(self.x,self.y)
+            key, item, stamp, skipped = self.q.get()
+            self.consumed.value += len(item[0]) if isinstance(item[0], list) else 1
+            if self.lag is None or now - stamp > self.lag:
+                self.lag = now - stamp
+            curve = self.curves.get(key)
+            # Samples of removed curves can still be in the queue
+            if curve is not None:
+                curve.put(item)
+                curve.skipped += skipped
+
+        for curve in self.curves.values():
+            curve.flush()
+            curve.receive()
 
+    def _update(self):
         try:
-            if self.in_process_pipe.poll():
+            while self.in_process_pipe.poll():
                 msg = self.in_process_pipe.recv()
                 self._process_msg(msg)
-        except:
+        except (IOError, OSError, EOFError):
             # If the polling failed, then the application most likely shut down
             # So close the window and terminate as well
             self.app.quit()
+            return
+
+        # Empty data channels and process received data
+        self._receive()
+
+        for curve in self.curves.values():
+            curve.redraw()
+
+        now = time.monotonic()
+        if now - self.last_stats >= STATS_PERIOD:
+            self.last_stats = now
+            skipped = self.skipped()
+            self.win.setWindowTitle(self.title(self.lag, skipped))
+            self.in_process_pipe.send(("stats", {'lag': self.lag, 'skipped': skipped}))
+            self.lag = None
+
+    def skipped(self):
+        # Samples skipped since the plot was opened, for all curves
+        total = 0
+        for curve in self.curves.values():
+            total += curve.skipped
+            if curve.channel is not None:
+                total += curve.channel.lost
+        return total
+
+    def title(self, lag, skipped):
+        # Window title showing how far behind the plot is
+        status = []
+        if lag is not None:
+            status.append("lag {0:.0f} ms".format(lag * 1e3))
+        if skipped:
+            status.append("{0} samples skipped".format(skipped))
+        if not status:
+            return self.name
+        return "{0} ({1})".format(self.name, ", ".join(status))
+
+    def _add_curve(self, key, name, plottype, channel):
+        curve = Curve(name, plottype, channel)
+        self.curves[key] = curve
+        self._attach(curve)
+
+    def _remove_curve(self, key):
+        curve = self.curves.pop(key, None)
+        if curve is None:
+            return
+        self._detach(curve)
+        if curve.channel is not None:
+            curve.channel.close()
+
+    def _attach(self, curve):
+        # Creates the graphics of the curve
+        if self.layout == 'stack' or not self.plots:
+            plot = self.win.addPlot(row=len(self.plots), col=0, title=curve.name)
+            plot.addLegend()
+            if self.plots:
+                plot.setXLink(self.plots[0])
+            self.plots.append(plot)
+        else:
+            plot = self.plots[0]
+            plot.setTitle(self.name)
+        curve.plot = plot
+        curve.item = plot.plot(pen=pg.intColor(len(self.curves) - 1, hues=8), name=curve.name)
+        plot.getViewBox().sigRangeChanged.connect(curve.on_range_changed)
+
+    def _detach(self, curve):
+        if self.layout == 'stack':
+            self.win.removeItem(curve.plot)
+            self.plots.remove(curve.plot)
+        else:
+            curve.plot.removeItem(curve.item)
+            if curve.plot.legend is not None:
+                curve.plot.legend.removeItem(curve.name)
 
     def _process_msg(self, msg):
         if msg == "exit":
@@ -87,15 +450,19 @@ by issuing message-based commands using a multiprocessing Pipe
             self.in_process_pipe.send("closing")
             self.app.quit()
         elif msg == "clear":
-            self._clear()
+            for curve in self.curves.values():
+                curve.clear()
+        elif msg[0] == "add":
+            self._add_curve(*msg[1:])
+        elif msg[0] == "remove":
+            self._remove_curve(msg[1])
 
     def run(self):
         self.app = QtGui.QApplication([])
-        win = pg.GraphicsWindow(title="Basic plotting examples")
-        win.resize(1000,600)
-        win.setWindowTitle('pyqtgraph example: Plotting')
-        plot = win.addPlot(title=self.name)
-        self.curve = plot.plot(pen='y')
+        self.win = pg.GraphicsWindow(title="Basic plotting examples")
+        self.win.resize(1000,600)
+        self.win.setWindowTitle(self.name)
+        self.plots = []
 
         timer = QtCore.QTimer()
         timer.timeout.connect(self._update)
@@ -139,16 +506,21 @@ if __name__ == '__main__':
     run.set()
 
     # create the plot
-    s = Superplot("somePlot",PlotType.linear)
-    #s = Superplot("somePlot",PlotType.indexed)
+    s = Superplot("somePlot")
+    #s = Superplot("somePlot",layout='stack')
 
-    # get the queue used to exchange data
+    # get the control pipe of the plot
     q, ctrlPipe = s.start()
 
-    # start IO thread
-    t = threading.Thread(target=io_linear, args=(run,q))
-    #t = threading.Thread(target=io_indexed, args=(run,q))
+    # add one curve per topic, and get the channel used to send its data
+    linear = s.add_curve("linear", PlotType.linear)
+    indexed = s.add_curve("indexed", PlotType.indexed)
+
+    # start IO threads
+    t = threading.Thread(target=io_linear, args=(run,linear))
     t.start()
+    t2 = threading.Thread(target=io_indexed, args=(run,indexed))
+    t2.start()
 
     while True:
         action = input("Type 'q' to quit. Type 'clear' to reset the graph. Type 'exit' to close the graph but stay on main thread.")
@@ -160,8 +532,9 @@ if __name__ == '__main__':
             break
 
     run.clear()
-    print("Waiting for IO thread to join...")
+    print("Waiting for IO threads to join...")
     t.join()
+    t2.join()
     print("Waiting for graph window process to join...")
     s.join()
     print("Process joined successfully. C YA !")